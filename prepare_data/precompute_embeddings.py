@@ -0,0 +1,193 @@
+"""Precompute the outputs of the frozen encoders for training.
+
+Walks every training dataset of a training config and writes, under
+`--precomputed_dir`:
+    store_info.json                      settings the frames were encoded with
+    text_embeddings.npy / .json          one text embedding per unique instruction
+    <data_dir>/<videoid>/vae_moments.npy       VAE posterior moments per frame
+    <data_dir>/<videoid>/image_embeddings.npy  image embedder tokens per frame
+
+Set `precomputed_dir` in the `data.params.train.params` of the same config to
+train from the store. The frames go through the dataset's own resize, spatial
+transform and normalization, so the store is only valid for a deterministic
+`spatial_transform` and for frozen encoders (`freeze_embedder: True`).
+
+Example:
+    python prepare_data/precompute_embeddings.py \
+        --config configs/train/config.yaml --precomputed_dir ./data/precomputed
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+
+from omegaconf import OmegaConf
+from tqdm import tqdm
+
+from unifolm_wma.utils.train import load_checkpoints
+from unifolm_wma.utils.utils import instantiate_from_config
+
+
+def save_array(path, array):
+    """Write `array` to `path` atomically, so an interrupted run never leaves
+    a truncated shard behind for --resume to skip."""
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def load_frames(dataset, video_reader, indices):
+    """Frames as the dataset feeds them to the encoders: (t, c, h, w) in [-1, 1]."""
+    frames = torch.tensor(video_reader.get_batch(indices).asnumpy())
+    frames = frames.permute(3, 0, 1, 2).float()
+    if dataset.spatial_transform is not None:
+        frames = dataset.spatial_transform(frames)
+    frames = (frames / 255 - 0.5) * 2
+    return frames.permute(1, 0, 2, 3)
+
+
+@torch.no_grad()
+def encode_episode(model, dataset, video_reader, batch_size, dtype):
+    moments, image_embs = [], []
+    device = model.device
+    for start in range(0, len(video_reader), batch_size):
+        indices = list(range(start, min(start + batch_size,
+                                        len(video_reader))))
+        frames = load_frames(dataset, video_reader, indices).to(device)
+        posterior = model.first_stage_model.encode(frames)
+        moments.append(posterior.parameters.cpu().to(dtype))
+        image_embs.append(model.embedder(frames).cpu().to(dtype))
+    return torch.cat(moments).numpy(), torch.cat(image_embs).numpy()
+
+
+@torch.no_grad()
+def encode_instructions(model, instructions, batch_size, dtype):
+    embs = []
+    for start in range(0, len(instructions), batch_size):
+        embs.append(
+            model.get_learned_conditioning(
+                instructions[start:start + batch_size]).cpu().to(dtype))
+    return torch.cat(embs).numpy()
+
+
+def dataset_instructions(dataset):
+    """Every instruction `WMAData.__getitem__` can emit for this dataset."""
+    instructions = list(dataset.metadata['instruction'])
+    if dataset.cond_robot_label_prob > 0.0:
+        instructions += [
+            row['embodiment'] + ' [SEP] ' + row['instruction']
+            for _, row in dataset.metadata.iterrows()
+            if row['embodiment'] != 'x'
+        ]
+    return instructions
+
+
+def main(args):
+    dtype = getattr(torch, args.dtype)
+    config = OmegaConf.load(args.config)
+    dataset_params = config.data.params.train.params
+    # Build the datasets in their raw-frame mode
+    dataset_params.pop('precomputed_dir', None)
+
+    model = instantiate_from_config(config.model)
+    model = load_checkpoints(model, config.model)
+    model = model.to(args.device).eval()
+    assert not model.cond_stage_trainable, 'The text encoder must be frozen.'
+
+    data = instantiate_from_config(config.data)
+    data.setup()
+    os.makedirs(args.precomputed_dir, exist_ok=True)
+
+    # Text embeddings: one row per unique instruction
+    instructions = [""]
+    for dataset in data.train_datasets.values():
+        instructions += dataset_instructions(dataset)
+    instructions = list(dict.fromkeys(instructions))
+    text_embs = encode_instructions(model, instructions, args.batch_size,
+                                    dtype)
+    save_array(os.path.join(args.precomputed_dir, 'text_embeddings.npy'),
+               text_embs)
+    with open(os.path.join(args.precomputed_dir, 'text_embeddings.json'),
+              'w') as f:
+        json.dump({ins: row for row, ins in enumerate(instructions)}, f)
+    print(f'>>> {len(instructions)} instruction embeddings saved.')
+
+    # VAE moments and image embeddings: one shard per episode video
+    for dataname, dataset in data.train_datasets.items():
+        dataset._init_worker_caches()
+        for _, sample in tqdm(dataset.metadata.iterrows(),
+                              total=len(dataset.metadata),
+                              desc=dataname):
+            episode_dir = os.path.join(args.precomputed_dir,
+                                       sample['data_dir'],
+                                       str(sample['videoid']))
+            paths = [
+                os.path.join(episode_dir, f'{key}.npy')
+                for key in ['vae_moments', 'image_embeddings']
+            ]
+            if args.resume and all(os.path.exists(p) for p in paths):
+                continue
+            try:
+                video_reader = dataset._get_video_reader(
+                    dataset._get_video_path(sample))
+            except Exception:
+                print(f'>>> Error: load video failed! path = '
+                      f'{dataset._get_video_path(sample)}')
+                continue
+            moments, image_embs = encode_episode(model, dataset,
+                                                 video_reader,
+                                                 args.batch_size, dtype)
+            os.makedirs(episode_dir, exist_ok=True)
+            for path, array in zip(paths, [moments, image_embs]):
+                save_array(path, array)
+
+    with open(os.path.join(args.precomputed_dir, 'store_info.json'),
+              'w') as f:
+        json.dump(
+            {
+                'resolution': list(dataset_params.resolution),
+                'spatial_transform': dataset_params.get('spatial_transform'),
+                'load_raw_resolution':
+                dataset_params.get('load_raw_resolution', False),
+                'dtype': args.dtype,
+                'datasets': list(data.train_datasets),
+            }, f)
+    print(f'>>> Precomputed store written to {args.precomputed_dir}.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',
+                        action='store',
+                        type=str,
+                        help='Training config whose model and data to use.',
+                        required=True)
+    parser.add_argument('--precomputed_dir',
+                        action='store',
+                        type=str,
+                        help='Directory to write the store to.',
+                        required=True)
+    parser.add_argument('--batch_size',
+                        action='store',
+                        type=int,
+                        default=16,
+                        help='Frames (or instructions) per encoder call.')
+    parser.add_argument('--dtype',
+                        action='store',
+                        type=str,
+                        default='float16',
+                        choices=['float16', 'float32'],
+                        help='Storage dtype of the precomputed arrays.')
+    parser.add_argument(
+        '--device',
+        action='store',
+        type=str,
+        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='Skip episodes whose shards were written by a previous run.')
+    main(parser.parse_args())
@@ -3,10 +3,12 @@ import os
 import shutil
 import h5py
 import argparse
+import numpy as np
 import pandas as pd
 import torch
 import subprocess
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from safetensors.torch import save_file
 from tqdm import tqdm
@@ -46,16 +48,206 @@ def is_av1(file_path):
         return False
 
 
-def convert_to_h264(input_path, output_path):
+def convert_to_h264(input_path, output_path, preset="slow", threads=0):
+    """Transcode with x264; `threads` caps its encoder threads (0: ffmpeg
+    picks, about 1.5 per core)."""
     subprocess.run([
-        "ffmpeg", "-i",
-        str(input_path), "-c:v", "libx264", "-preset", "slow", "-crf", "23",
-        "-c:a", "copy",
+        "ffmpeg", "-y", "-i",
+        str(input_path), "-c:v", "libx264", "-preset", preset, "-crf", "23",
+        "-threads",
+        str(threads), "-c:a", "copy",
         str(output_path)
     ],
                    check=True)
 
 
+def save_packed_transitions(target_transitions_dir, shards, robot_name):
+    """Save all episodes as one contiguous array per modality.
+
+    `shards` holds, per episode in order, the `.npz` file its worker wrote
+    (see `process_episode`). The arrays are preallocated as `.npy` memmaps
+    and filled one episode at a time, so only one episode is ever in memory;
+    the shards are removed once copied.
+
+    Layout under `target_transitions_dir`:
+    ```
+    action.npy                                (N, action_dim)
+    observation.state.npy                     (N, state_dim)
+    meta_data/episode_data_index.safetensors  {"from": (E,), "to": (E,)}
+    meta_data/transition_info.json            action/state/robot types
+    ```
+    Rows of episode `i` are `from[i]:to[i]`, so a sample can be read with a
+    single slice of a memory-mapped array instead of opening an `.h5` file.
+    """
+    target_transitions_dir = Path(target_transitions_dir)
+    keys = ('action', 'observation.state')
+    lengths, shapes = [], {}
+    for shard in shards:
+        with np.load(shard) as episode:
+            lengths.append(len(episode['action']))
+            for key in keys:
+                shapes[key] = (episode[key].shape[1:], episode[key].dtype)
+    lengths = torch.tensor(lengths, dtype=torch.int64)
+    to_idx = torch.cumsum(lengths, dim=0)
+    episode_data_index = {'from': to_idx - lengths, 'to': to_idx}
+
+    packed = {
+        key: np.lib.format.open_memmap(target_transitions_dir / f"{key}.npy",
+                                       mode='w+',
+                                       dtype=dtype,
+                                       shape=(int(to_idx[-1]), *shape))
+        for key, (shape, dtype) in shapes.items()
+    }
+    for shard, start, end in zip(shards, episode_data_index['from'].tolist(),
+                                 to_idx.tolist()):
+        with np.load(shard) as episode:
+            for key in keys:
+                packed[key][start:end] = episode[key]
+    for array in packed.values():
+        array.flush()
+    del packed
+    for shard in shards:
+        os.remove(shard)
+
+    save_file(episode_data_index,
+              target_transitions_dir / "meta_data" /
+              "episode_data_index.safetensors")
+    with open(target_transitions_dir / "meta_data" / "transition_info.json",
+              "w") as f:
+        json.dump(
+            {
+                'action_type': 'joint position',
+                'state_type': 'joint position',
+                'robot_type': robot_name
+            }, f)
+
+
+def episode_stats(x):
+    """Streaming moments of one episode, in float64 to keep merges exact."""
+    x = x.to(torch.float64)
+    mean = x.mean(dim=0)
+    return {
+        'count': x.shape[0],
+        'mean': mean,
+        'm2': ((x - mean)**2).sum(dim=0),
+        'min': x.min(dim=0).values,
+        'max': x.max(dim=0).values
+    }
+
+
+def merge_stats(a, b):
+    """Combine two `episode_stats` results (Chan et al. parallel variance)."""
+    if a is None:
+        return b
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    return {
+        'count': count,
+        'mean': a['mean'] + delta * b['count'] / count,
+        'm2': a['m2'] + b['m2'] + delta**2 * a['count'] * b['count'] / count,
+        'min': torch.minimum(a['min'], b['min']),
+        'max': torch.maximum(a['max'], b['max'])
+    }
+
+
+def finalize_stats(s):
+    return {
+        'max': s['max'].float(),
+        'min': s['min'].float(),
+        'mean': s['mean'].float(),
+        # Unbiased, same as torch.std
+        'std': (s['m2'] / (s['count'] - 1)).sqrt().float()
+    }
+
+
+def is_done(target_file, source_file, manifest):
+    """An output is reusable if it exists and was made from a source file of
+    the same size."""
+    return (Path(target_file).exists()
+            and manifest.get(str(target_file)) == Path(source_file).stat().st_size)
+
+
+def process_episode(idx, source_data_dir, source_view_dirs, target_videos_dir,
+                    target_transitions_dir, robot_name, write_h5, shard_dir,
+                    preset, threads, manifest):
+    """Convert one episode: transcode its videos, write its transitions and
+    return its stats. Runs in a worker process.
+
+    With a `shard_dir`, the transitions also go to `{shard_dir}/{idx}.npz`
+    for `save_packed_transitions`, rather than back to the parent.
+    """
+    done = {}
+
+    for source_view_dir in source_view_dirs:
+        source_video = source_view_dir / f"episode_{idx:06d}.mp4"
+        output_video = target_videos_dir / source_view_dir.name / f"{idx}.mp4"
+        if is_done(output_video, source_video, manifest):
+            pass
+        elif is_av1(source_video):
+            print(f"Converting episode_{idx:06d}.mp4 to H.264...")
+            # Write under a temporary name so an interrupted run never leaves
+            # a truncated video that looks finished
+            tmp_video = output_video.with_suffix('.tmp.mp4')
+            convert_to_h264(source_video, tmp_video, preset, threads)
+            os.replace(tmp_video, output_video)
+        else:
+            print(f"Skipping episode_{idx:06d}.mp4: not AV1 encoded.")
+            continue
+        done[str(output_video)] = source_video.stat().st_size
+
+    # Load parquet file
+    episode_parquet_file = source_data_dir / f"episode_{idx:06d}.parquet"
+    episode_data = pd.read_parquet(episode_parquet_file)
+    actions = torch.tensor(episode_data['action'].tolist())
+    states = torch.tensor(episode_data['observation.state'].tolist())
+
+    # Save action and state into a h5 file
+    target_h5_file = target_transitions_dir / f"{idx}.h5"
+    if write_h5 and not is_done(target_h5_file, episode_parquet_file,
+                                manifest):
+        tmp_h5_file = target_h5_file.with_suffix('.tmp.h5')
+        with h5py.File(str(tmp_h5_file), 'w') as h5f:
+            h5f.create_dataset('observation.state', data=states)
+            h5f.create_dataset('action', data=actions)
+            h5f.attrs['action_type'] = 'joint position'
+            h5f.attrs['state_type'] = 'joint position'
+            h5f.attrs['robot_type'] = robot_name
+        os.replace(tmp_h5_file, target_h5_file)
+    if write_h5:
+        done[str(target_h5_file)] = episode_parquet_file.stat().st_size
+
+    shard = None
+    if shard_dir is not None:
+        shard = shard_dir / f"{idx}.npz"
+        np.savez(shard,
+                 **{
+                     'action': actions.numpy(),
+                     'observation.state': states.numpy()
+                 })
+
+    return {
+        'idx': idx,
+        'done': done,
+        'action': episode_stats(actions),
+        'observation.state': episode_stats(states),
+        'shard': shard
+    }
+
+
+def load_manifest(manifest_file):
+    if manifest_file.exists():
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest_file, manifest):
+    tmp_file = manifest_file.with_suffix('.tmp')
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
+
+
 def main(args):
     source_dir = Path(args.source_dir)
     source_data_dir = source_dir / args.dataset_name / "data" / "chunk-000"
@@ -78,7 +270,6 @@ def main(args):
         'dynamic_confidence', 'dynamic_wording', 'dynamic_source_category',
         'embodiment'
     ]
-    df = pd.DataFrame(columns=COLUMNS)
 
     # Load info.json from source dir
     info_json_path = source_meta_dir / "info.json"
@@ -93,83 +284,78 @@ def main(args):
     instruction = tasks[0]['task']
 
     source_video_views = [d for d in source_videos_dir.iterdir()]
-    for v_idx, source_view_dir in enumerate(source_video_views):
-
-        view_name = source_view_dir.name
-        target_videos_view_dir = target_videos_dir / view_name
-        target_videos_view_dir.mkdir(parents=True, exist_ok=True)
-
-        if v_idx == 0:
-            all_actions = []
-            all_states = []
-
-        for idx in tqdm(range(total_episodes)):
-            # Copy source video to target vidoe dir
-            source_video = source_view_dir / f"episode_{idx:06d}.mp4"
-            if is_av1(source_video):
-                output_video = str(target_videos_view_dir / f"{idx}.mp4")
-                print(f"Converting episode_{idx:06d}.mp4 to H.264...")
-                convert_to_h264(source_video, output_video)
-            else:
-                print(f"Skipping episode_{idx:06d}.mp4: not AV1 encoded.")
-
-            # Load parquet file
-            episode_parquet_file = source_data_dir / f"episode_{idx:06d}.parquet"
-            episode_data = pd.read_parquet(episode_parquet_file)
-            actions = torch.tensor(episode_data['action'].tolist())
-            states = torch.tensor(episode_data['observation.state'].tolist())
-
-            # Save action and state into a h5 file
-            if v_idx == 0:
-                target_h5_file = target_transitions_dir / f"{idx}.h5"
-                with h5py.File(str(target_h5_file), 'w') as h5f:
-                    h5f.create_dataset('observation.state', data=states)
-                    h5f.create_dataset('action', data=actions)
-                    h5f.attrs['action_type'] = 'joint position'
-                    h5f.attrs['state_type'] = 'joint position'
-                    h5f.attrs['robot_type'] = args.robot_name
-
-            # Updata df
-            df = pd.concat([
-                df,
-                pd.DataFrame([{
-                    'videoid': idx,
-                    'contentUrl': 'x',
-                    'duration': 'x',
-                    'data_dir': args.dataset_name + f"/{view_name}",
-                    'instruction': instruction,
-                    'dynamic_confidence': 'x',
-                    'dynamic_wording': 'x',
-                    'dynamic_source_category': 'x',
-                    'embodiment': args.robot_name
-                }])
-            ],
-                           ignore_index=True)
-
-            # Collect action and state
-            if v_idx == 0:
-                all_actions.append(actions)
-                all_states.append(states)
+    for source_view_dir in source_video_views:
+        (target_videos_dir / source_view_dir.name).mkdir(parents=True,
+                                                         exist_ok=True)
 
-    # Create satas.safetensors
-    actions = torch.cat(all_actions, dim=0)
-    states = torch.cat(all_states, dim=0)
+    # Outputs of previous runs, keyed by path, with the size of the source
+    # file they were made from
+    manifest_file = target_meta_dir / "prepare_manifest.json"
+    manifest = load_manifest(manifest_file) if args.resume else {}
 
-    stats = {'action': {}, 'observation.state': {}}
-    stats['action']['max'] = actions.max(dim=0).values
-    stats['action']['min'] = actions.min(dim=0).values
-    stats['action']['mean'] = actions.mean(dim=0)
-    stats['action']['std'] = actions.std(dim=0)
+    write_h5 = args.transition_format in ('h5', 'both')
+    shard_dir = None
+    if args.transition_format in ('npy', 'both'):
+        shard_dir = target_transitions_dir / "shards"
+        shard_dir.mkdir(exist_ok=True)
+    stats = {'action': None, 'observation.state': None}
+    shards = [None] * total_episodes
+    # Split the cores between the transcodes running side by side
+    threads = max(1, (os.cpu_count() or 1) // args.num_workers)
 
-    stats['observation.state']['max'] = states.max(dim=0).values
-    stats['observation.state']['min'] = states.min(dim=0).values
-    stats['observation.state']['mean'] = states.mean(dim=0)
-    stats['observation.state']['std'] = states.std(dim=0)
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        futures = []
+        for idx in range(total_episodes):
+            # Only ship the entries this episode can use to the worker
+            outputs = [
+                str(target_videos_dir / d.name / f"{idx}.mp4")
+                for d in source_video_views
+            ] + [str(target_transitions_dir / f"{idx}.h5")]
+            episode_manifest = {
+                k: manifest[k]
+                for k in outputs if k in manifest
+            }
+            futures.append(
+                executor.submit(process_episode, idx, source_data_dir,
+                                source_video_views, target_videos_dir,
+                                target_transitions_dir, args.robot_name,
+                                write_h5, shard_dir, args.preset, threads,
+                                episode_manifest))
+        for n, future in enumerate(tqdm(as_completed(futures),
+                                        total=total_episodes)):
+            result = future.result()
+            for key in stats:
+                stats[key] = merge_stats(stats[key], result[key])
+            shards[result['idx']] = result['shard']
+            manifest.update(result['done'])
+            if (n + 1) % 100 == 0:
+                save_manifest(manifest_file, manifest)
+    save_manifest(manifest_file, manifest)
 
+    # Create satas.safetensors
+    stats = {key: finalize_stats(value) for key, value in stats.items()}
     flattened_stats = flatten_dict(stats)
     target_stats_file = target_meta_dir / "stats.safetensors"
     save_file(flattened_stats, target_stats_file)
 
+    if shard_dir is not None:
+        save_packed_transitions(target_transitions_dir, shards,
+                                args.robot_name)
+        shard_dir.rmdir()
+
+    df = pd.DataFrame([{
+        'videoid': idx,
+        'contentUrl': 'x',
+        'duration': 'x',
+        'data_dir': args.dataset_name + f"/{source_view_dir.name}",
+        'instruction': instruction,
+        'dynamic_confidence': 'x',
+        'dynamic_wording': 'x',
+        'dynamic_source_category': 'x',
+        'embodiment': args.robot_name
+    } for source_view_dir in source_video_views
+                       for idx in range(total_episodes)],
+                      columns=COLUMNS)
     df.to_csv(csv_file, index=False)
     print(f">>> Finished create {args.dataset_name} dataset ...")
 
@@ -196,4 +382,31 @@ if __name__ == "__main__":
                         type=str,
                         help='robot name',
                         required=True)
+    parser.add_argument(
+        '--transition_format',
+        action='store',
+        type=str,
+        default='h5',
+        choices=['h5', 'npy', 'both'],
+        help=
+        'h5: one .h5 file per episode; npy: one memory-mappable array per modality with an episode index (use transition_format=npy in the data config); both: write both.'
+    )
+    parser.add_argument('--num_workers',
+                        action='store',
+                        type=int,
+                        default=max(1, (os.cpu_count() or 1) // 4),
+                        help=
+                        'Number of episodes converted in parallel; the cores are split between their ffmpeg transcodes.')
+    parser.add_argument('--preset',
+                        action='store',
+                        type=str,
+                        default='slow',
+                        help='x264 preset used when transcoding AV1 videos.')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help=
+        'Skip videos and h5 files already written by a previous run from a source file of the same size.'
+    )
     main(parser.parse_args())
@@ -0,0 +1,82 @@
+"""Microbenchmark of the attention backends on a WMAModel cross-attention layer.
+
+Times `CrossAttention` with the four-way context split (agent state, agent
+action with its block mask, text, image) and plain self-attention, once per
+backend. Runs on CPU by default, where xformers is unavailable.
+
+Example:
+    python scripts/benchmarks/benchmark_attention.py --batch 16 --tokens 640
+"""
+import argparse
+import time
+
+import torch
+
+from unifolm_wma.modules.attention import (XFORMERS_IS_AVAILBLE,
+                                           CrossAttention, attention_backend)
+
+
+def timeit(fn, iters: int, device: torch.device) -> float:
+    """Mean milliseconds per call."""
+    for _ in range(3):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def report(label: str, ms: float) -> None:
+    print(f'{label:<28}: {ms:8.3f} ms/call')
+
+
+@torch.no_grad()
+def main(args: argparse.Namespace) -> None:
+    device = torch.device(args.device)
+    dim = args.heads * args.dim_head
+    cross_attn = CrossAttention(query_dim=dim,
+                                context_dim=args.context_dim,
+                                heads=args.heads,
+                                dim_head=args.dim_head,
+                                video_length=args.image_tokens,
+                                image_cross_attention=True).to(device).eval()
+    self_attn = CrossAttention(query_dim=dim,
+                               heads=args.heads,
+                               dim_head=args.dim_head).to(device).eval()
+
+    x = torch.randn(args.batch, args.tokens, dim, device=device)
+    context_len = (cross_attn.agent_state_context_len +
+                   cross_attn.agent_action_context_len +
+                   cross_attn.text_context_len + args.image_tokens)
+    context = torch.randn(args.batch,
+                          context_len,
+                          args.context_dim,
+                          device=device)
+    print(f'>>> x {tuple(x.shape)}, context {tuple(context.shape)} on {device}')
+
+    backends = ['math', 'sdpa']
+    if XFORMERS_IS_AVAILBLE and device.type == 'cuda':
+        backends.append('xformers')
+    for backend in backends:
+        with attention_backend(backend):
+            ms = timeit(lambda: cross_attn(x, context), args.iters, device)
+            report(f'{backend}, four-way cross', ms)
+            ms = timeit(lambda: self_attn(x), args.iters, device)
+            report(f'{backend}, self', ms)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--tokens', type=int, default=640)
+    parser.add_argument('--heads', type=int, default=8)
+    parser.add_argument('--dim_head', type=int, default=40)
+    parser.add_argument('--context_dim', type=int, default=1024)
+    parser.add_argument('--image_tokens', type=int, default=16)
+    parser.add_argument('--iters', type=int, default=20)
+    main(parser.parse_args())
@@ -0,0 +1,99 @@
+"""Microbenchmark of the EMA update: per-parameter loop vs. foreach kernels.
+
+Example:
+    python scripts/benchmarks/benchmark_ema.py --device cuda --num_blocks 200
+"""
+import argparse
+import copy
+import time
+
+import torch
+import torch.nn as nn
+
+from torch.nn.modules.batchnorm import _BatchNorm
+
+from unifolm_wma.models.diffusion_head.ema_model import EMAModel
+
+
+def build_model(num_blocks: int, width: int) -> nn.Module:
+    """Many small layers, like the action head: launch-bound, not FLOP-bound."""
+    layers = []
+    for _ in range(num_blocks):
+        layers += [nn.Linear(width, width), nn.LayerNorm(width), nn.Mish()]
+    return nn.Sequential(*layers)
+
+
+@torch.no_grad()
+def loop_step(ema_model: nn.Module, new_model: nn.Module,
+              decay: float) -> None:
+    """EMAModel.step before vectorizing: one mul_/add_ pair per parameter."""
+    for module, ema_module in zip(new_model.modules(), ema_model.modules()):
+        for param, ema_param in zip(module.parameters(recurse=False),
+                                    ema_module.parameters(recurse=False)):
+            if isinstance(module, _BatchNorm) or not param.requires_grad:
+                ema_param.copy_(param.to(dtype=ema_param.dtype).data)
+            else:
+                ema_param.mul_(decay)
+                ema_param.add_(param.data.to(dtype=ema_param.dtype),
+                               alpha=1 - decay)
+
+
+def timeit(fn, iters: int, device: torch.device) -> float:
+    """Mean milliseconds per call."""
+    for _ in range(3):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def report(label: str, ms: float) -> None:
+    print(f'{label:<28}: {ms:8.3f} ms/step')
+
+
+def main(args: argparse.Namespace) -> None:
+    device = torch.device(args.device)
+    model = build_model(args.num_blocks, args.width).to(device)
+    n_params = sum(p.numel() for p in model.parameters())
+    n_tensors = len(list(model.parameters()))
+    print(f'>>> {n_tensors} parameter tensors, {n_params / 1e6:.1f}M values '
+          f'on {device}')
+
+    loop_ema = copy.deepcopy(model)
+    ms = timeit(lambda: loop_step(loop_ema, model, 0.999), args.iters, device)
+    report('per-parameter loop', ms)
+
+    ema = EMAModel(copy.deepcopy(model), min_value=0.999)
+    ms = timeit(lambda: ema.step(model), args.iters, device)
+    report('foreach', ms)
+
+    ema = EMAModel(copy.deepcopy(model),
+                   min_value=0.999,
+                   update_every=args.update_every)
+    ms = timeit(lambda: ema.step(model), args.iters, device)
+    report(f'foreach, every {args.update_every}', ms)
+
+    if device.type != 'cpu':
+        ema = EMAModel(copy.deepcopy(model),
+                       min_value=0.999,
+                       update_every=args.update_every,
+                       device='cpu')
+        ms = timeit(lambda: ema.step(model), args.iters, device)
+        report(f'foreach, every {args.update_every}, on cpu', ms)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device',
+                        type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--num_blocks', type=int, default=100)
+    parser.add_argument('--width', type=int, default=256)
+    parser.add_argument('--iters', type=int, default=50)
+    parser.add_argument('--update_every', type=int, default=4)
+    main(parser.parse_args())
@@ -260,6 +260,7 @@ def image_guided_synthesis(model: torch.nn.Module,
                            text_input: bool = False,
                            timestep_spacing: str = 'uniform',
                            guidance_rescale: float = 0.0,
+                           fused_cfg: bool = False,
                            **kwargs) -> torch.Tensor:
     """
     Run DDIM-based image-to-video synthesis with hybrid/text+image guidance.
@@ -276,13 +277,14 @@ def image_guided_synthesis(model: torch.nn.Module,
         text_input (bool, optional): If True, use text guidance.
         timestep_spacing (str, optional): Timestep schedule spacing.
         guidance_rescale (float, optional): Rescale guidance effect.
+        fused_cfg (bool, optional): Run both guidance branches in one pass.
         **kwargs: Additional sampler args.
 
     Returns:
         torch.Tensor: Synthesized videos of shape [B, 1, C, T, H, W].
     """
 
-    ddim_sampler = DDIMSampler(model)
+    ddim_sampler = DDIMSampler(model, fused_cfg=fused_cfg)
     batch_size = noise_shape[0]
     fs = torch.tensor([fs] * batch_size, dtype=torch.long, device=model.device)
 
@@ -307,6 +309,10 @@ def image_guided_synthesis(model: torch.nn.Module,
         cond["c_concat"] = [img_cat_cond]
 
     uc = None
+    if unconditional_guidance_scale != 1.0:
+        # Same inputs with the text dropped
+        uc_emb = model.get_unconditional_conditioning(cond_emb)
+        uc = {**cond, "c_crossattn": [torch.cat([uc_emb, img_emb], dim=1)]}
     cond_mask = None
     kwargs.update({"unconditional_conditioning_img_nonetext": None})
 
@@ -356,6 +362,8 @@ def run_inference(args: argparse.Namespace, gpu_num: int, gpu_no: int) -> None:
     model = instantiate_from_config(config.model)
     model = model.cuda(gpu_no)
     model.perframe_ae = args.perframe_ae
+    if args.ae_chunk_size is not None:
+        model.en_and_decode_n_samples_a_time = args.ae_chunk_size
     assert os.path.exists(args.ckpt_path), "Error: checkpoint Not Found!"
     model = load_model_checkpoint(model, args.ckpt_path)
     model.eval()
@@ -421,7 +429,7 @@ def run_inference(args: argparse.Namespace, gpu_num: int, gpu_no: int) -> None:
                     model, prompts, videos, noise_shape, args.ddim_steps,
                     args.ddim_eta, args.unconditional_guidance_scale,
                     fps[0] // fs[0], args.text_input, args.timestep_spacing,
-                    args.guidance_rescale)
+                    args.guidance_rescale, args.fused_cfg)
                 results.extend(batch_samples)
                 videos = repeat(batch_samples[0][:, :, -1, :, :].unsqueeze(2),
                                 'b c t h w -> b c (repeat t) h w',
@@ -520,6 +528,13 @@ def get_parser() -> argparse.ArgumentParser:
         help=
         "Rescale factor for guidance as discussed in 'Common Diffusion Noise Schedules and Sample Steps are Flawed' (https://huggingface.co/papers/2305.08891)."
     )
+    parser.add_argument(
+        "--fused_cfg",
+        action='store_true',
+        default=False,
+        help=
+        "With --unconditional_guidance_scale != 1, run the conditional and unconditional branches of classifier-free guidance as one model pass over twice the batch. Faster, but needs twice the activation memory."
+    )
     parser.add_argument(
         "--perframe_ae",
         action='store_true',
@@ -527,6 +542,13 @@ def get_parser() -> argparse.ArgumentParser:
         help=
         "Use per-frame autoencoder decoding to reduce GPU memory usage. Recommended for models with resolutions like 576x1024."
     )
+    parser.add_argument(
+        "--ae_chunk_size",
+        type=lambda v: v if v == 'auto' else int(v),
+        default=None,
+        help=
+        "Frames per autoencoder call with --perframe_ae: an integer, or 'auto' to size the chunks from free GPU memory. Defaults to en_and_decode_n_samples_a_time of the config."
+    )
     return parser
 
 
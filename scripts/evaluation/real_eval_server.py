@@ -1,4 +1,11 @@
 import argparse, os, sys
+import asyncio
+import json
+import queue
+import struct
+import threading
+import time
+import numpy as np
 import torch
 import torchvision
 import warnings
@@ -11,16 +18,19 @@ import uvicorn
 
 from omegaconf import OmegaConf
 from einops import rearrange, repeat
-from collections import OrderedDict
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future
 from pytorch_lightning import seed_everything
 from torch import nn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
-from typing import Any, Dict, Optional, Tuple, List
+from starlette.concurrency import run_in_threadpool
+from typing import Any, Callable, Dict, Optional, Tuple, List
 from datetime import datetime
 
 from unifolm_wma.utils.utils import instantiate_from_config
 from unifolm_wma.models.samplers.ddim import DDIMSampler
+from unifolm_wma.utils.cache import FrameLatentCache
 
 
 def get_device_from_parameters(module: nn.Module) -> torch.device:
@@ -114,6 +124,63 @@ def save_results(video: torch.Tensor, filename: str, fps: int = 8) -> None:
                                options={'crf': '10'})
 
 
+# dtype tags of the safetensors layout used by the binary request format
+SAFETENSORS_DTYPES = {
+    'BOOL': torch.bool,
+    'U8': torch.uint8,
+    'I8': torch.int8,
+    'I16': torch.int16,
+    'I32': torch.int32,
+    'I64': torch.int64,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'F32': torch.float32,
+    'F64': torch.float64,
+}
+
+
+def decode_observation_payload(
+        body: bytes) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """Decode a binary observation request into tensors.
+
+    The request body uses the safetensors layout: an 8-byte little-endian
+    header size, a JSON header with the dtype, shape and byte offsets of every
+    tensor (plus an optional `__metadata__` string map), then the raw tensor
+    bytes. Every tensor is a `torch.frombuffer` view into `body`, so no
+    per-element Python objects are created and nothing is copied.
+
+    Args:
+        body (bytes): Raw request body.
+
+    Returns:
+        Tuple[Dict[str, torch.Tensor], Dict[str, str]]: Tensors by key and the
+            metadata map (e.g. `language_instruction`).
+    """
+    header_size = struct.unpack('<Q', body[:8])[0]
+    header = json.loads(body[8:8 + header_size])
+    metadata = header.pop('__metadata__', None) or {}
+    buffer = memoryview(body)[8 + header_size:]
+
+    tensors = {}
+    for key, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info['dtype']]
+        start, end = info['data_offsets']
+        if end == start:
+            tensors[key] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        with warnings.catch_warnings():
+            # The request body is read-only; the tensors are never written in place
+            warnings.filterwarnings("ignore",
+                                    "The given buffer is not writable",
+                                    category=UserWarning)
+            tensor = torch.frombuffer(buffer,
+                                      dtype=dtype,
+                                      count=(end - start) // dtype.itemsize,
+                                      offset=start)
+        tensors[key] = tensor.reshape(info['shape'])
+    return tensors, metadata
+
+
 def get_latent_z(model: nn.Module, videos: torch.Tensor) -> torch.Tensor:
     """Encode videos into latent space.
 
@@ -132,6 +199,46 @@ def get_latent_z(model: nn.Module, videos: torch.Tensor) -> torch.Tensor:
     return z
 
 
+def get_cond_latent_z(model, frame, latent_cache=None):
+    """Encode only the conditioning frame.
+
+    Args:
+        model (nn.Module): Model with `encode_first_stage` method.
+        frame (torch.Tensor): Last observed frame of shape [B, C, H, W].
+        latent_cache (FrameLatentCache | None): Reuse the latents of frames
+            encoded in earlier calls.
+
+    Returns:
+        torch.Tensor: Latent of shape [B, C, 1, H, W].
+    """
+    if latent_cache is None:
+        z = model.encode_first_stage(frame)
+    else:
+        z = latent_cache.encode(model.encode_first_stage, frame)
+    return z.unsqueeze(2)
+
+
+def get_cond_img_emb(model, frame, embedding_cache=None):
+    """Project the conditioning frame into image-prompt tokens.
+
+    Args:
+        model (nn.Module): Model with `embedder` and `image_proj_model`.
+        frame (torch.Tensor): Last observed frame of shape [B, C, H, W].
+        embedding_cache (FrameLatentCache | None): Reuse the embeddings of
+            frames projected in earlier calls.
+
+    Returns:
+        torch.Tensor: Image embedding tokens of shape [B, L, D].
+    """
+
+    def embed(x):
+        return model.image_proj_model(model.embedder(x))
+
+    if embedding_cache is None:
+        return embed(frame)
+    return embedding_cache.encode(embed, frame)
+
+
 def image_guided_synthesis(
         model: torch.nn.Module,
         prompts: list[str],
@@ -143,6 +250,12 @@ def image_guided_synthesis(
         fs: int | None = None,
         timestep_spacing: str = 'uniform',
         guidance_rescale: float = 0.0,
+        fused_cfg: Optional[bool] = None,
+        ddim_sampler: Optional[DDIMSampler] = None,
+        decode: bool = True,
+        latent_cache: Optional[FrameLatentCache] = None,
+        cond_latent: Optional[torch.Tensor] = None,
+        cond_img_emb: Optional[torch.Tensor] = None,
         **kwargs) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     """Run inference with DDIM sampling.
 
@@ -157,6 +270,20 @@ def image_guided_synthesis(
         fs (Optional[int], optional): Frame stride or FPS. Defaults to None.
         timestep_spacing (str, optional): Spacing strategy. Defaults to "uniform".
         guidance_rescale (float, optional): Guidance rescale. Defaults to 0.0.
+        fused_cfg (Optional[bool], optional): Run both guidance branches in
+            one model pass. None uses the sampler's setting. Defaults to None.
+        ddim_sampler (Optional[DDIMSampler], optional): Sampler to reuse. A new
+            one is created when None. Defaults to None.
+        decode (bool, optional): Decode the sampled latents to pixel space.
+            When False the latents are returned instead. Defaults to True.
+        latent_cache (Optional[FrameLatentCache], optional): Reuse the
+            latent of a conditioning frame encoded before. Defaults to None.
+        cond_latent (Optional[torch.Tensor], optional): Latent of the
+            conditioning frame [B, C, 1, h, w], used as is instead of encoding
+            the last observed image. Defaults to None.
+        cond_img_emb (Optional[torch.Tensor], optional): Image embedding of
+            the conditioning frame, used as is instead of projecting the last
+            observed image. Defaults to None.
         **kwargs (Any): Additional arguments.
 
     Returns:
@@ -164,19 +291,20 @@ def image_guided_synthesis(
     """
 
     b, _, t, _, _ = noise_shape
-    ddim_sampler = DDIMSampler(model)
+    if ddim_sampler is None:
+        ddim_sampler = DDIMSampler(model)
     batch_size = noise_shape[0]
     fs = torch.tensor([fs] * batch_size, dtype=torch.long, device=model.device)
 
     img = observation['observation.images.top']
     cond_img = img[:, -1, ...]
-    cond_img_emb = model.embedder(cond_img)
-    cond_img_emb = model.image_proj_model(cond_img_emb)
+    if cond_img_emb is None:
+        cond_img_emb = get_cond_img_emb(model, cond_img)
 
     if model.model.conditioning_key == 'hybrid':
-        z = get_latent_z(model, img.permute(0, 2, 1, 3, 4))
-        img_cat_cond = z[:, :, -1:, :, :]
-        img_cat_cond = repeat(img_cat_cond,
+        if cond_latent is None:
+            cond_latent = get_cond_latent_z(model, cond_img, latent_cache)
+        img_cat_cond = repeat(cond_latent,
                               'b c t h w -> b c (repeat t) h w',
                               repeat=noise_shape[2])
         cond = {"c_concat": [img_cat_cond]}
@@ -199,6 +327,14 @@ def image_guided_synthesis(
     ]
 
     uc = None
+    if unconditional_guidance_scale != 1.0:
+        # Same inputs with the instruction dropped
+        uc_ins_emb = model.get_unconditional_conditioning(cond_ins_emb)
+        uc = {
+            **cond, "c_crossattn": [
+                torch.cat([cond_state_emb, uc_ins_emb, cond_img_emb], dim=1)
+            ]
+        }
 
     kwargs.update({"unconditional_conditioning_img_nonetext": None})
 
@@ -222,11 +358,14 @@ def image_guided_synthesis(
             fs=fs,
             timestep_spacing=timestep_spacing,
             guidance_rescale=guidance_rescale,
+            fused_cfg=fused_cfg,
             **kwargs)
 
         # Reconstruct from latent to pixel space
-        batch_images = model.decode_first_stage(samples)
-        batch_variants = batch_images
+        if decode:
+            batch_variants = model.decode_first_stage(samples)
+        else:
+            batch_variants = samples
 
     return batch_variants, actions, states
 
@@ -250,6 +389,8 @@ def run_inference(args: argparse.Namespace, gpu_num: int,
     config['model']['params']['wma_config']['params']['use_checkpoint'] = False
     model = instantiate_from_config(config.model)
     model.perframe_ae = args.perframe_ae
+    if args.ae_chunk_size is not None:
+        model.en_and_decode_n_samples_a_time = args.ae_chunk_size
     assert os.path.exists(args.ckpt_path), "Error: checkpoint Not Found!"
     model = load_model_checkpoint(model, args.ckpt_path)
     model = model.cuda(gpu_no)
@@ -278,6 +419,302 @@ def run_inference(args: argparse.Namespace, gpu_num: int,
     return model, noise_shape, data
 
 
+class BackgroundVideoWriter:
+    """Decode and save predicted videos off the request path.
+
+    Jobs hold the sampled latents; a single worker thread decodes them with
+    the model's first stage and writes the mp4. The queue is bounded: when it
+    is full the oldest pending job is dropped so the newest video is kept.
+
+    Args:
+        model (nn.Module): Model with `decode_first_stage` method.
+        max_pending (int, optional): Maximum number of queued jobs. Defaults to 2.
+    """
+
+    def __init__(self, model: nn.Module, max_pending: int = 2) -> None:
+        self.model = model
+        self.jobs = queue.Queue(maxsize=max(1, max_pending))
+        self.lock = threading.Lock()
+        self.num_dropped = 0
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, samples: torch.Tensor, filename: str) -> None:
+        """Queue latents to be decoded and saved to `filename`."""
+        with self.lock:
+            if self.jobs.full():
+                try:
+                    _, dropped = self.jobs.get_nowait()
+                    self.num_dropped += 1
+                    logging.warning(
+                        f"Video queue is full, dropped {dropped} "
+                        f"({self.num_dropped} dropped so far)")
+                except queue.Empty:
+                    pass
+            self.jobs.put_nowait((samples.detach(), filename))
+
+    def _run(self) -> None:
+        while True:
+            samples, filename = self.jobs.get()
+            try:
+                with torch.no_grad():
+                    videos = self.model.decode_first_stage(samples)
+                save_results(videos.cpu(), filename)
+            except Exception:
+                logging.error(traceback.format_exc())
+
+
+class ObservationSession:
+    """Observation history of one robot, kept on the model device.
+
+    A session is opened with a full prepared observation: the frame and state
+    history plus the action history. After that, each step only carries the
+    entries observed since the previous request. Frames and states live in
+    rings of 2*T slots: every write goes to slot i and its mirror i+T, so the
+    last T entries are always one contiguous slice. A step with fewer new
+    frames than states (e.g. a slower camera) repeats the newest frame, which
+    keeps both histories aligned in time.
+
+    The latents and image embeddings of the conditioning frame are cached per
+    session, so a repeated frame is not encoded again.
+
+    Args:
+        observation (Dict[str, torch.Tensor]): Prepared batch-of-one
+            observation (see `Server._prepare_request`).
+        action_mask (torch.Tensor): Mask of the robot's dims in the unified
+            action space.
+        counts (Optional[Dict[str, int]]): The client's history write counts
+            at the opening request (see `counts_from_metadata`). With them, a
+            retried step is recognized and its entries aren't pushed twice.
+    """
+
+    HISTORY_KEYS = ('observation.images.top', 'observation.state')
+
+    def __init__(self,
+                 observation: Dict[str, torch.Tensor],
+                 action_mask: torch.Tensor,
+                 counts: Optional[Dict[str, int]] = None) -> None:
+        self.horizons = {
+            key: observation[key].shape[1]
+            for key in self.HISTORY_KEYS
+        }
+        self.rings = {
+            key: torch.cat([observation[key][0]] * 2)
+            for key in self.HISTORY_KEYS
+        }
+        self.counts = {key: 0 for key in self.HISTORY_KEYS}
+        # Client-side write counts of the newest entries held, when sent
+        self.client_counts = counts
+        self.action = observation['action']
+        self.action_mask = action_mask
+        self.latent_cache = FrameLatentCache(capacity=2)
+        self.embedding_cache = FrameLatentCache(capacity=2)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def counts_from_metadata(
+            cls, metadata: Dict[str, str]) -> Optional[Dict[str, int]]:
+        """The client's write counts sent as `count.<key>` metadata, if any."""
+        if not all(f'count.{key}' in metadata for key in cls.HISTORY_KEYS):
+            return None
+        return {
+            key: int(metadata[f'count.{key}'])
+            for key in cls.HISTORY_KEYS
+        }
+
+    def window(self, key: str) -> torch.Tensor:
+        """The last T entries of `key`, oldest first, as a view."""
+        horizon = self.horizons[key]
+        start = self.counts[key] % horizon
+        return self.rings[key][start:start + horizon]
+
+    def _push(self, key: str, entries: torch.Tensor) -> None:
+        horizon = self.horizons[key]
+        ring = self.rings[key]
+        for entry in entries[-horizon:]:
+            pos = self.counts[key] % horizon
+            ring[pos] = entry
+            ring[pos + horizon] = entry
+            self.counts[key] += 1
+
+    def _skip_held(self, key: str, entries: Optional[torch.Tensor],
+                   counts: Optional[Dict[str, int]]) -> Optional[torch.Tensor]:
+        """Drop the leading entries of a step the session already holds."""
+        if entries is None or counts is None or self.client_counts is None:
+            return entries
+        num_new = min(max(0, counts[key] - self.client_counts[key]),
+                      len(entries))
+        return entries[len(entries) - num_new:]
+
+    def step(
+        self,
+        images: Optional[torch.Tensor],
+        states: torch.Tensor,
+        counts: Optional[Dict[str, int]] = None
+    ) -> Dict[str, torch.Tensor]:
+        """Push the new entries and return the observation for one request.
+
+        Args:
+            images (Optional[torch.Tensor]): New prepared frames (k, C, H, W),
+                or None when no new frame was sent.
+            states (torch.Tensor): New prepared states (n, D), n >= k.
+            counts (Optional[Dict[str, int]]): The client's write counts
+                after the newest entry of each history. Entries the session
+                already holds, e.g. from a retry of the same body, are
+                skipped.
+
+        Returns:
+            Dict[str, torch.Tensor]: Batch-of-one observation. The histories
+                are copies, so later steps can't change a queued request.
+        """
+        with self.lock:
+            images = self._skip_held('observation.images.top', images, counts)
+            states = self._skip_held('observation.state', states, counts)
+            if counts is not None:
+                self.client_counts = {
+                    key: max(counts[key], (self.client_counts or counts)[key])
+                    for key in self.HISTORY_KEYS
+                }
+            num_frames = 0 if images is None else len(images)
+            if num_frames < len(states):
+                newest = self.window('observation.images.top')[-1:]
+                newest = newest.expand(len(states) - num_frames,
+                                       *newest.shape[1:])
+                images = newest if images is None else torch.cat(
+                    [newest, images])
+            if len(states) > 0:
+                self._push('observation.images.top', images)
+                self._push('observation.state', states)
+            observation = {
+                key: self.window(key).clone().unsqueeze(0)
+                for key in self.HISTORY_KEYS
+            }
+        observation['action'] = self.action
+        return observation
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'steps': self.counts['observation.state'],
+            'latent_cache': self.latent_cache.stats(),
+            'embedding_cache': self.embedding_cache.stats()
+        }
+
+
+class MicroBatcher:
+    """Group concurrent requests into batched model calls.
+
+    Handlers queue requests with `submit`; a single worker thread waits for
+    the first one, keeps collecting for up to `window_ms` or until
+    `max_batch_size` requests are queued, runs `run_batch` on the list and
+    resolves every caller's future with its own result. The worker is the
+    only thread running the model, so concurrent requests never race on the
+    GPU. Latencies and batch sizes of recent requests are kept for `stats`.
+
+    Args:
+        run_batch (Callable[[List[Any]], List[Any]]): Maps a list of requests
+            to a list of results in the same order.
+        max_batch_size (int, optional): Largest batch to run. Defaults to 4.
+        window_ms (float, optional): How long to wait for more requests after
+            the first one arrives. With 0 only requests that are already queued
+            (e.g. arrived while the previous batch ran) are grouped. Defaults to 0.
+        history (int, optional): Number of recent requests kept for latency
+            statistics. Defaults to 1000.
+    """
+
+    def __init__(self,
+                 run_batch: Callable[[List[Any]], List[Any]],
+                 max_batch_size: int = 4,
+                 window_ms: float = 0.,
+                 history: int = 1000) -> None:
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = window_ms / 1000.
+        self.requests = queue.Queue()
+
+        self.stats_lock = threading.Lock()
+        self.latencies = deque(maxlen=history)
+        self.queue_waits = deque(maxlen=history)
+        self.batch_times = deque(maxlen=history)
+        self.batch_sizes = Counter()
+        self.num_requests = 0
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, request: Any) -> Future:
+        """Queue a request; the returned future resolves to its result."""
+        future = Future()
+        self.requests.put((request, future, time.perf_counter()))
+        return future
+
+    def _collect(self) -> List[Tuple[Any, Future, float]]:
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(self.requests.get(timeout=timeout))
+                else:
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            try:
+                results = self.run_batch([request for request, _, _ in batch])
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+            with self.stats_lock:
+                self.num_requests += len(batch)
+                self.batch_sizes[len(batch)] += 1
+                self.batch_times.append(end - start)
+                for _, _, enqueued in batch:
+                    self.latencies.append(end - enqueued)
+                    self.queue_waits.append(start - enqueued)
+
+    def stats(self) -> Dict[str, Any]:
+        """Latency percentiles (ms) and the batch size histogram."""
+
+        def summarize(values: List[float]) -> Dict[str, float]:
+            if len(values) == 0:
+                return {}
+            values = np.asarray(values) * 1000.
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            return {
+                'mean': float(values.mean()),
+                'p50': float(p50),
+                'p90': float(p90),
+                'p99': float(p99),
+                'max': float(values.max())
+            }
+
+        with self.stats_lock:
+            return {
+                'num_requests': self.num_requests,
+                'latency_ms': summarize(list(self.latencies)),
+                'queue_wait_ms': summarize(list(self.queue_waits)),
+                'batch_time_ms': summarize(list(self.batch_times)),
+                'batch_size_histogram': {
+                    str(k): v
+                    for k, v in sorted(self.batch_sizes.items())
+                },
+                'max_batch_size': self.max_batch_size,
+                'window_ms': self.window * 1000.
+            }
+
+
 def get_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument("--savedir",
@@ -345,6 +782,13 @@ def get_parser() -> argparse.ArgumentParser:
         help=
         "Rescale factor for guidance as discussed in 'Common Diffusion Noise Schedules and Sample Steps are Flawed' (https://huggingface.co/papers/2305.08891)."
     )
+    parser.add_argument(
+        "--fused_cfg",
+        action='store_true',
+        default=False,
+        help=
+        "With --unconditional_guidance_scale != 1, run the conditional and unconditional branches of classifier-free guidance as one model pass over twice the batch. Faster, but needs twice the activation memory."
+    )
     parser.add_argument(
         "--perframe_ae",
         action='store_true',
@@ -352,6 +796,62 @@ def get_parser() -> argparse.ArgumentParser:
         help=
         "Use per-frame autoencoder decoding to reduce GPU memory usage. Recommended for models with resolutions like 576x1024."
     )
+    parser.add_argument(
+        "--ae_chunk_size",
+        type=lambda v: v if v == 'auto' else int(v),
+        default=None,
+        help=
+        "Frames per autoencoder call with --perframe_ae: an integer, or 'auto' to size the chunks from free GPU memory. Defaults to en_and_decode_n_samples_a_time of the config."
+    )
+    parser.add_argument(
+        "--video_queue_size",
+        type=int,
+        default=2,
+        help=
+        "Maximum number of predicted videos waiting to be decoded and saved in the background. The oldest one is dropped when full."
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=4,
+        help=
+        "Maximum number of concurrent requests (e.g. from several robots) sampled together in one DDIM run."
+    )
+    parser.add_argument(
+        "--batch_window_ms",
+        type=float,
+        default=0.0,
+        help=
+        "Time to wait for more requests after the first one arrives before running a batch. With 0 only requests already waiting are batched. Tune it with the /stats endpoint."
+    )
+    parser.add_argument(
+        "--action_ddim_steps",
+        type=int,
+        default=None,
+        help=
+        "Number of denoising steps for the action/state heads on action-only requests (no video requested). Defaults to --ddim_steps."
+    )
+    parser.add_argument(
+        "--trunk_refresh_every",
+        type=int,
+        default=1,
+        help=
+        "On action-only requests, run the video UNet only every N action steps and reuse its features for the action/state heads in between."
+    )
+    parser.add_argument(
+        "--cache_cross_attn_kv",
+        action='store_true',
+        default=False,
+        help=
+        "Compute the cross-attention keys/values of the conditioning context once per request instead of at every DDIM step."
+    )
+    parser.add_argument(
+        "--max_sessions",
+        type=int,
+        default=8,
+        help=
+        "Maximum number of observation sessions (/session/open) kept on the GPU. The least recently used one is dropped when full."
+    )
     return parser
 
 
@@ -363,89 +863,349 @@ class Server:
         self.dataset_name = self.data_.dataset_configs['test']['params'][
             'dataset_name']
         self.device_ = get_device_from_parameters(self.model_)
+        self.samplers_ = {}
+        self.get_sampler(args.ddim_steps, args.ddim_eta,
+                         args.timestep_spacing)
+        self.video_writer_ = BackgroundVideoWriter(self.model_,
+                                                   args.video_queue_size)
+        self.batcher_ = MicroBatcher(self._predict_batch,
+                                     max_batch_size=args.max_batch_size,
+                                     window_ms=args.batch_window_ms)
+        self.sessions_ = OrderedDict()
+        self.sessions_lock_ = threading.Lock()
+
+    def get_sampler(self, ddim_steps: int, ddim_eta: float,
+                    timestep_spacing: str) -> DDIMSampler:
+        """Return the sampler for a schedule, building it on first use.
+
+        The DDIM schedule (and its per-step coefficients on the model device)
+        is computed once per key instead of on every request. The samplers
+        fuse the classifier-free guidance passes with `--fused_cfg`.
+
+        Args:
+            ddim_steps (int): Number of DDIM steps.
+            ddim_eta (float): Sampling eta.
+            timestep_spacing (str): Spacing strategy.
+
+        Returns:
+            DDIMSampler: Sampler with its schedule already made.
+        """
+        key = (ddim_steps, ddim_eta, timestep_spacing)
+        if key not in self.samplers_:
+            sampler = DDIMSampler(self.model_,
+                                  fused_cfg=self.args_.fused_cfg)
+            sampler.make_schedule(ddim_num_steps=ddim_steps,
+                                  ddim_discretize=timestep_spacing,
+                                  ddim_eta=ddim_eta,
+                                  verbose=False)
+            self.samplers_[key] = sampler
+        return self.samplers_[key]
 
     def normalize_image(self, image: torch.Tensor) -> torch.Tensor:
         return (image / 255 - 0.5) * 2
 
     def predict_action(self, payload: Dict[str, Any]) -> Any:
         try:
-            images = payload['observation.images.top']
-            states = payload['observation.state']
-            actions = payload['action']  # Should be all zeros
+            images = torch.tensor(payload['observation.images.top'])
+            states = torch.tensor(payload['observation.state'])
+            actions = torch.tensor(payload['action'])  # Should be all zeros
             language_instruction = payload['language_instruction']
+            return_video = bool(payload.get('return_video', False))
+            request = self._prepare_request(images, states, actions,
+                                            language_instruction, return_video)
+            return JSONResponse(self.batcher_.submit(request).result())
+        except Exception:
+            return self._error_response()
+
+    async def predict_action_binary(self, request: Request) -> Any:
+        """Binary variant of `/predict_action`.
+
+        The body is produced by `LongConnectionClient` with `binary=True`:
+        uint8 frames plus float32 state/action in one safetensors-framed
+        message, with the language instruction (and optional `return_video`
+        flag, "true"/"false") stored in its metadata.
+        """
+        body = await request.body()
+        try:
+            tensors, metadata = decode_observation_payload(body)
+            request = await run_in_threadpool(
+                self._prepare_request, tensors['observation.images.top'],
+                tensors['observation.state'], tensors['action'],
+                metadata['language_instruction'],
+                metadata.get('return_video', 'false').lower() == 'true')
+            result = await asyncio.wrap_future(self.batcher_.submit(request))
+            return JSONResponse(result)
+        except:
+            return self._error_response()
 
-            images = torch.tensor(images).cuda()
-            images = self.data_.test_datasets[
-                self.dataset_name].spatial_transform(images).unsqueeze(0)
-            images = self.normalize_image(images)
-            print(f"images shape: {images.shape} ...")
-            states = torch.tensor(states)
-            states = self.data_.test_datasets[self.dataset_name].normalizer(
-                {'observation.state': states})['observation.state']
-            states, _ = self.data_.test_datasets[
-                self.dataset_name]._map_to_uni_state(states, "joint position")
-            print(f"states shape: {states.shape} ...")
-            actions = torch.tensor(actions)
-            actions, action_mask = self.data_.test_datasets[
-                self.dataset_name]._map_to_uni_action(actions,
-                                                      "joint position")
-            print(f"actions shape: {actions.shape} ...")
-            print("=" * 20)
-            states = states.unsqueeze(0).cuda()
-            actions = actions.unsqueeze(0).cuda()
+    async def open_session(self, request: Request) -> Any:
+        """Open (or replace) an observation session and predict on it.
 
-            observation = {
-                'observation.images.top': images,
-                'observation.state': states,
-                'action': actions
+        Same body as `/predict_action_binary`, with a `session_id` (e.g. the
+        robot's id) in the metadata. Later requests go to `/session/step`.
+        """
+        body = await request.body()
+        try:
+            tensors, metadata = decode_observation_payload(body)
+            request = await run_in_threadpool(self._open_session, tensors,
+                                              metadata)
+            result = await asyncio.wrap_future(self.batcher_.submit(request))
+            return JSONResponse(result)
+        except Exception:
+            return self._error_response()
+
+    async def session_step(self, request: Request) -> Any:
+        """Predict from an open session, sending only the new observations.
+
+        The body holds the states (n, D) and frames (k, C, H, W), k <= n,
+        observed since the previous request of the session; the frames may be
+        left out. Answers 404 when the session is unknown (e.g. evicted, or
+        the server restarted), so the client opens it again. With the
+        client's write counts in the metadata (`count.<key>`), a retried body
+        is predicted on without pushing its entries a second time.
+        """
+        body = await request.body()
+        try:
+            tensors, metadata = decode_observation_payload(body)
+            session_id = metadata['session_id']
+            with self.sessions_lock_:
+                session = self.sessions_.get(session_id)
+                if session is not None:
+                    self.sessions_.move_to_end(session_id)
+            if session is None:
+                return JSONResponse(
+                    {
+                        'result': 'error',
+                        'desc': f'unknown session {session_id}'
+                    },
+                    status_code=404)
+            request = await run_in_threadpool(self._session_step, session,
+                                              tensors, metadata)
+            result = await asyncio.wrap_future(self.batcher_.submit(request))
+            return JSONResponse(result)
+        except Exception:
+            return self._error_response()
+
+    def close_session(self, payload: Dict[str, Any]) -> Any:
+        with self.sessions_lock_:
+            self.sessions_.pop(payload['session_id'], None)
+        return {'result': 'ok', 'desc': 'closed'}
+
+    def stats(self) -> Dict[str, Any]:
+        """Request latency percentiles, batch size histogram and cache counters."""
+        stats = self.batcher_.stats()
+        stats['text_cache'] = self.model_.cond_cache.stats()
+        with self.sessions_lock_:
+            stats['sessions'] = {
+                session_id: session.stats()
+                for session_id, session in self.sessions_.items()
             }
-            observation = {
-                key: observation[key].to(self.device_, non_blocking=True)
-                for key in observation
+        return stats
+
+    def _open_session(self, tensors: Dict[str, torch.Tensor],
+                      metadata: Dict[str, str]) -> Dict[str, Any]:
+        request = self._prepare_request(
+            tensors['observation.images.top'], tensors['observation.state'],
+            tensors['action'], metadata['language_instruction'],
+            metadata.get('return_video', 'false').lower() == 'true')
+        session = ObservationSession(
+            request['observation'], request['action_mask'],
+            ObservationSession.counts_from_metadata(metadata))
+        with self.sessions_lock_:
+            self.sessions_[metadata['session_id']] = session
+            self.sessions_.move_to_end(metadata['session_id'])
+            while len(self.sessions_) > max(1, self.args_.max_sessions):
+                evicted, _ = self.sessions_.popitem(last=False)
+                logging.warning(f"Dropped observation session {evicted}")
+        request['session'] = session
+        return request
+
+    def _session_step(self, session: ObservationSession,
+                      tensors: Dict[str, torch.Tensor],
+                      metadata: Dict[str, str]) -> Dict[str, Any]:
+        states = tensors['observation.state']
+        if len(states) > 0:
+            states = self._prepare_states(states)[0]
+        else:
+            states = states.to(self.device_)
+        images = tensors.get('observation.images.top')
+        if images is not None and len(images) > 0:
+            images = self._prepare_images(images)[0]
+        else:
+            images = None
+        return {
+            'observation': session.step(
+                images, states,
+                ObservationSession.counts_from_metadata(metadata)),
+            'action_mask': session.action_mask,
+            'language_instruction': metadata['language_instruction'],
+            'return_video': metadata.get('return_video',
+                                         'false').lower() == 'true',
+            'session': session
+        }
+
+    def _prepare_images(self, images: torch.Tensor) -> torch.Tensor:
+        """Resize and normalize (T, C, H, W) uint8 frames to (1, T, C, h, w)."""
+        images = images.to(self.device_)
+        images = self.data_.test_datasets[self.dataset_name].spatial_transform(
+            images).unsqueeze(0)
+        return self.normalize_image(images)
+
+    def _prepare_states(self, states: torch.Tensor) -> torch.Tensor:
+        """Normalize (T, D) states into the unified state space, (1, T, D')."""
+        states = self.data_.test_datasets[self.dataset_name].normalizer(
+            {'observation.state': states})['observation.state']
+        states, _ = self.data_.test_datasets[
+            self.dataset_name]._map_to_uni_state(states, "joint position")
+        return states.unsqueeze(0).to(self.device_)
+
+    def _prepare_request(self,
+                         images: torch.Tensor,
+                         states: torch.Tensor,
+                         actions: torch.Tensor,
+                         language_instruction: str,
+                         return_video: bool = False) -> Dict[str, Any]:
+        """Normalize one observation into a batch-of-one model input."""
+        images = self._prepare_images(images)
+        print(f"images shape: {images.shape} ...")
+        states = self._prepare_states(states)
+        print(f"states shape: {states.shape} ...")
+        actions, action_mask = self.data_.test_datasets[
+            self.dataset_name]._map_to_uni_action(actions, "joint position")
+        print(f"actions shape: {actions.shape} ...")
+        print("=" * 20)
+        actions = actions.unsqueeze(0).to(self.device_)
+
+        observation = {
+            'observation.images.top': images,
+            'observation.state': states,
+            'action': actions
+        }
+        observation = {
+            key: observation[key].to(self.device_, non_blocking=True)
+            for key in observation
+        }
+        return {
+            'observation': observation,
+            'action_mask': action_mask,
+            'language_instruction': language_instruction,
+            'return_video': return_video
+        }
+
+    @torch.no_grad()
+    def _predict_batch(self,
+                       requests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Predict action chunks for a batch of prepared requests.
+
+        The observations are stacked into one DDIM run with per-request
+        prompts. The predicted video is only needed for inspection, so by
+        default its latents are dropped; with `return_video` they are handed
+        to the background writer and the response carries the target file
+        path, without waiting for decoding or encoding.
+        """
+        observation = {
+            key: torch.cat([r['observation'][key] for r in requests], dim=0)
+            for key in requests[0]['observation']
+        }
+        prompts = [r['language_instruction'] for r in requests]
+        noise_shape = [len(requests)] + list(self.noise_shape_[1:])
+
+        args = self.args_
+        # Without any video to return the actions can be sampled on their own,
+        # cheaper schedule
+        # (decoupled action sampling has no classifier-free guidance)
+        action_sampling = {}
+        if (not any(r['return_video'] for r in requests)
+                and args.unconditional_guidance_scale == 1.0):
+            action_sampling = {
+                'action_ddim_steps': args.action_ddim_steps,
+                'trunk_refresh_every': args.trunk_refresh_every
             }
-
-            args = self.args_
-            pred_videos, pred_action, _ = image_guided_synthesis(
-                self.model_,
-                language_instruction,
-                observation,
-                self.noise_shape_,
-                ddim_steps=args.ddim_steps,
-                ddim_ets=args.ddim_eta,
-                unconditional_guidance_scale=args.unconditional_guidance_scale,
-                fs=30 / args.frame_stride,
-                timestep_spacing=args.timestep_spacing,
-                guidance_rescale=args.guidance_rescale)
-
-            pred_action = pred_action[..., action_mask[0] == 1.0][0].cpu()
+        # Session requests reuse the latents and image embeddings of
+        # conditioning frames their session has already encoded
+        conditioning = {}
+        if any(r.get('session') is not None for r in requests):
+            conditioning = self._session_conditioning(requests)
+        pred_latents, pred_actions, _ = image_guided_synthesis(
+            self.model_,
+            prompts,
+            observation,
+            noise_shape,
+            ddim_steps=args.ddim_steps,
+            ddim_eta=args.ddim_eta,
+            unconditional_guidance_scale=args.unconditional_guidance_scale,
+            fs=30 / args.frame_stride,
+            timestep_spacing=args.timestep_spacing,
+            guidance_rescale=args.guidance_rescale,
+            ddim_sampler=self.get_sampler(args.ddim_steps, args.ddim_eta,
+                                          args.timestep_spacing),
+            decode=False,
+            cache_cross_attn_kv=args.cache_cross_attn_kv,
+            **conditioning,
+            **action_sampling)
+
+        responses = []
+        for i, request in enumerate(requests):
+            action_mask = request['action_mask']
+            pred_action = pred_actions[i:i + 1][..., action_mask[0] ==
+                                                1.0][0].cpu()
             pred_action = self.data_.test_datasets[
                 self.dataset_name].unnormalizer({'action':
                                                  pred_action})['action']
 
-            os.makedirs(args.savedir, exist_ok=True)
-            current_time = datetime.now().strftime("%H:%M:%S")
-            video_file = f'{args.savedir}/{current_time}.mp4'
-            save_results(pred_videos.cpu(), video_file)
-
             response = {
                 'result': 'ok',
                 'action': pred_action.tolist(),
                 'desc': 'success'
             }
-            return JSONResponse(response)
-
-        except:
-            logging.error(traceback.format_exc())
-            logging.warning(
-                "Your request threw an error; make sure your request complies with the expected format:\n"
-                "{'image': np.ndarray, 'instruction': str}\n"
-                "You can optionally an `unnorm_key: str` to specific the dataset statistics you want to use for "
-                "de-normalizing the output actions.")
-            return {'result': 'error', 'desc': traceback.format_exc()}
+            if request['return_video']:
+                os.makedirs(args.savedir, exist_ok=True)
+                current_time = datetime.now().strftime("%H:%M:%S")
+                video_file = f'{args.savedir}/{current_time}_{i}.mp4' if len(
+                    requests) > 1 else f'{args.savedir}/{current_time}.mp4'
+                self.video_writer_.submit(pred_latents[i:i + 1], video_file)
+                response['video'] = video_file
+            responses.append(response)
+        return responses
+
+    def _session_conditioning(
+            self, requests: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        """Conditioning-frame latents and embeddings, request by request."""
+        latents, embeddings = [], []
+        for request in requests:
+            session = request.get('session')
+            frame = request['observation']['observation.images.top'][:, -1]
+            embeddings.append(
+                get_cond_img_emb(
+                    self.model_, frame,
+                    session.embedding_cache if session is not None else None))
+            if self.model_.model.conditioning_key == 'hybrid':
+                latents.append(
+                    get_cond_latent_z(
+                        self.model_, frame,
+                        session.latent_cache if session is not None else None))
+        conditioning = {'cond_img_emb': torch.cat(embeddings)}
+        if latents:
+            conditioning['cond_latent'] = torch.cat(latents)
+        return conditioning
+
+    def _error_response(self) -> Dict[str, str]:
+        logging.error(traceback.format_exc())
+        logging.warning(
+            "Your request threw an error; make sure your request complies with the expected format:\n"
+            "{'image': np.ndarray, 'instruction': str}\n"
+            "You can optionally an `unnorm_key: str` to specific the dataset statistics you want to use for "
+            "de-normalizing the output actions.")
+        return {'result': 'error', 'desc': traceback.format_exc()}
 
     def run(self, host: str = "127.0.0.1", port: int = 8000) -> None:
         self.app = FastAPI()
         self.app.post("/predict_action")(self.predict_action)
+        self.app.post("/predict_action_binary")(self.predict_action_binary)
+        self.app.post("/session/open")(self.open_session)
+        self.app.post("/session/step")(self.session_step)
+        self.app.post("/session/close")(self.close_session)
+        self.app.get("/stats")(self.stats)
         print(">>> Inference server is ready ... ")
         uvicorn.run(self.app, host=host, port=port)
         print(">>> Inference server stops ... ")
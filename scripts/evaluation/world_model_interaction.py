@@ -24,6 +24,7 @@ from PIL import Image
 
 from unifolm_wma.models.samplers.ddim import DDIMSampler
 from unifolm_wma.utils.utils import instantiate_from_config
+from unifolm_wma.utils.cache import FrameLatentCache
 
 
 def get_device_from_parameters(module: nn.Module) -> torch.device:
@@ -267,6 +268,25 @@ def get_latent_z(model, videos: Tensor) -> Tensor:
     return z
 
 
+def get_cond_latent_z(model, frame, latent_cache=None):
+    """Encode only the conditioning frame.
+
+    Args:
+        model: the world model.
+        frame (Tensor): Last observed frame of shape [B, C, H, W].
+        latent_cache (FrameLatentCache | None): Reuse the latents of frames
+            encoded in earlier calls.
+
+    Returns:
+        Tensor: Latent of shape [B, C, 1, H, W].
+    """
+    if latent_cache is None:
+        z = model.encode_first_stage(frame)
+    else:
+        z = latent_cache.encode(model.encode_first_stage, frame)
+    return z.unsqueeze(2)
+
+
 def preprocess_observation(
         model, observations: dict[str, np.ndarray]) -> dict[str, Tensor]:
     """Convert environment observation to LeRobot format observation.
@@ -326,7 +346,11 @@ def image_guided_synthesis_sim_mode(
         text_input: bool = True,
         timestep_spacing: str = 'uniform',
         guidance_rescale: float = 0.0,
+        fused_cfg: bool = False,
         sim_mode: bool = True,
+        cond_latent: Tensor | None = None,
+        decode: bool = True,
+        latent_cache: FrameLatentCache | None = None,
         **kwargs) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     """
     Performs image-guided video generation in a simulation-style mode with optional multimodal guidance (image, state, action, text).
@@ -349,16 +373,23 @@ def image_guided_synthesis_sim_mode(
         text_input (bool): Whether to use text prompt as conditioning. If False, uses empty strings. Default is True.
         timestep_spacing (str): Timestep sampling method in DDIM sampler. Typically "uniform" or "linspace".
         guidance_rescale (float): Guidance rescaling factor to mitigate overexposure from classifier-free guidance.
+        fused_cfg (bool): Run the conditional and unconditional guidance branches in one model pass. Default is False.
         sim_mode (bool): Whether to perform world-model interaction or decision-making using the world-model.
+        cond_latent (Tensor | None): Latent of the conditioning frame [B, C, 1, h, w]. If given, it is used as is
+            instead of encoding the last observed image. Default is None.
+        decode (bool): Whether to decode the predicted latents to pixels. Default is True.
+        latent_cache (FrameLatentCache | None): Cache for the latent of the conditioning frame, so a frame shared
+            with an earlier call is not encoded again. Default is None.
         **kwargs: Additional arguments passed to the DDIM sampler.
 
     Returns:
-        batch_variants (torch.Tensor): Predicted pixel-space video frames [B, C, T, H, W].
+        batch_variants (torch.Tensor): Predicted pixel-space video frames [B, C, T, H, W], or their latents
+            [B, C, T, h, w] if `decode` is False.
         actions (torch.Tensor): Predicted action sequences [B, T, D] from diffusion decoding.
         states (torch.Tensor): Predicted state sequences [B, T, D] from diffusion decoding.
     """
     b, _, t, _, _ = noise_shape
-    ddim_sampler = DDIMSampler(model)
+    ddim_sampler = DDIMSampler(model, fused_cfg=fused_cfg)
     batch_size = noise_shape[0]
 
     fs = torch.tensor([fs] * batch_size, dtype=torch.long, device=model.device)
@@ -369,9 +400,9 @@ def image_guided_synthesis_sim_mode(
     cond_img_emb = model.image_proj_model(cond_img_emb)
 
     if model.model.conditioning_key == 'hybrid':
-        z = get_latent_z(model, img.permute(0, 2, 1, 3, 4))
-        img_cat_cond = z[:, :, -1:, :, :]
-        img_cat_cond = repeat(img_cat_cond,
+        if cond_latent is None:
+            cond_latent = get_cond_latent_z(model, img[:, -1], latent_cache)
+        img_cat_cond = repeat(cond_latent,
                               'b c t h w -> b c (repeat t) h w',
                               repeat=noise_shape[2])
         cond = {"c_concat": [img_cat_cond]}
@@ -403,6 +434,16 @@ def image_guided_synthesis_sim_mode(
     ]
 
     uc = None
+    if unconditional_guidance_scale != 1.0:
+        # Same inputs with the instruction dropped
+        uc_ins_emb = model.get_unconditional_conditioning(cond_ins_emb)
+        uc = {
+            **cond, "c_crossattn": [
+                torch.cat(
+                    [cond_state_emb, cond_action_emb, uc_ins_emb, cond_img_emb],
+                    dim=1)
+            ]
+        }
     kwargs.update({"unconditional_conditioning_img_nonetext": None})
     cond_mask = None
     cond_z0 = None
@@ -424,9 +465,11 @@ def image_guided_synthesis_sim_mode(
             guidance_rescale=guidance_rescale,
             **kwargs)
 
-        # Reconstruct from latent to pixel space
-        batch_images = model.decode_first_stage(samples)
-        batch_variants = batch_images
+        if decode:
+            # Reconstruct from latent to pixel space
+            batch_variants = model.decode_first_stage(samples)
+        else:
+            batch_variants = samples
 
     return batch_variants, actions, states
 
@@ -459,6 +502,8 @@ def run_inference(args: argparse.Namespace, gpu_num: int, gpu_no: int) -> None:
         'use_checkpoint'] = False
     model = instantiate_from_config(config.model)
     model.perframe_ae = args.perframe_ae
+    if args.ae_chunk_size is not None:
+        model.en_and_decode_n_samples_a_time = args.ae_chunk_size
     assert os.path.exists(args.ckpt_path), "Error: checkpoint Not Found!"
     model = load_model_checkpoint(model, args.ckpt_path)
     model.eval()
@@ -486,6 +531,20 @@ def run_inference(args: argparse.Namespace, gpu_num: int, gpu_no: int) -> None:
     print(f'>>> Generate {n_frames} frames under each generation ...')
     noise_shape = [args.bs, channels, n_frames, h, w]
 
+    save_itr_videos = not args.skip_itr_videos
+
+    def latent_kwargs(cond_obs_queues):
+        # In the latent loop the conditioning frame's latent is taken from the
+        # queue instead of re-encoding the decoded frame, and decoding is left
+        # to the caller
+        if not args.latent_loop:
+            return {}
+        return {
+            'cond_latent':
+            cond_obs_queues['observation.latents'][-1].unsqueeze(2),
+            'decode': False
+        }
+
     # Start inference
     for idx in range(0, len(df)):
         sample = df.iloc[idx]
@@ -526,6 +585,12 @@ def run_inference(args: argparse.Namespace, gpu_num: int, gpu_no: int) -> None:
                 "observation.state": deque(maxlen=model.n_obs_steps_imagen),
                 "action": deque(maxlen=args.video_length),
             }
+            if args.latent_loop:
+                cond_obs_queues["observation.latents"] = deque(
+                    maxlen=model.n_obs_steps_imagen)
+            # The policy and world-model passes of an iteration condition on
+            # the same frame
+            latent_cache = FrameLatentCache(capacity=2)
             # Obtain initial frame and state
             start_idx = 0
             model_input_fs = ori_fps // fs
@@ -549,6 +614,10 @@ def run_inference(args: argparse.Namespace, gpu_num: int, gpu_no: int) -> None:
                 key: observation[key].to(device, non_blocking=True)
                 for key in observation
             }
+            if args.latent_loop:
+                # Encoded once; afterwards the loop carries predicted latents
+                observation['observation.latents'] = model.encode_first_stage(
+                    observation['observation.images.top'])
             # Update observation queues
             cond_obs_queues = populate_queues(cond_obs_queues, observation)
 
@@ -587,7 +656,10 @@ def run_inference(args: argparse.Namespace, gpu_num: int, gpu_no: int) -> None:
                     fs=model_input_fs,
                     timestep_spacing=args.timestep_spacing,
                     guidance_rescale=args.guidance_rescale,
-                    sim_mode=False)
+                    fused_cfg=args.fused_cfg,
+                    sim_mode=False,
+                    latent_cache=latent_cache,
+                    **latent_kwargs(cond_obs_queues))
 
                 # Update future actions in the observation queues
                 for idx in range(len(pred_actions[0])):
@@ -628,7 +700,23 @@ def run_inference(args: argparse.Namespace, gpu_num: int, gpu_no: int) -> None:
                     fs=model_input_fs,
                     text_input=False,
                     timestep_spacing=args.timestep_spacing,
-                    guidance_rescale=args.guidance_rescale)
+                    guidance_rescale=args.guidance_rescale,
+                    fused_cfg=args.fused_cfg,
+                    latent_cache=latent_cache,
+                    **latent_kwargs(cond_obs_queues))
+
+                if args.latent_loop:
+                    # Decode only the frames that are fed back or saved
+                    pred_latents_0, pred_latents_1 = pred_videos_0, pred_videos_1
+                    pred_videos_0 = None
+                    if save_itr_videos:
+                        pred_videos_0 = model.decode_first_stage(
+                            pred_latents_0)
+                        pred_videos_1 = model.decode_first_stage(
+                            pred_latents_1)
+                    else:
+                        pred_videos_1 = model.decode_first_stage(
+                            pred_latents_1[:, :, :args.exe_steps])
 
                 for idx in range(args.exe_steps):
                     observation = {
@@ -641,32 +729,36 @@ def run_inference(args: argparse.Namespace, gpu_num: int, gpu_no: int) -> None:
                         torch.zeros_like(pred_actions[0][-1:])
                     }
                     observation['observation.state'][:, ori_state_dim:] = 0.0
+                    if args.latent_loop:
+                        observation['observation.latents'] = pred_latents_1[:, :,
+                                                                            idx]
                     cond_obs_queues = populate_queues(cond_obs_queues,
                                                       observation)
 
-                # Save the imagen videos for decision-making
-                sample_tag = f"{args.dataset}-vid{sample['videoid']}-dm-fs-{fs}/itr-{itr}"
-                log_to_tensorboard(writer,
-                                   pred_videos_0,
-                                   sample_tag,
-                                   fps=args.save_fps)
-                # Save videos environment changes via world-model interaction
-                sample_tag = f"{args.dataset}-vid{sample['videoid']}-wd-fs-{fs}/itr-{itr}"
-                log_to_tensorboard(writer,
-                                   pred_videos_1,
-                                   sample_tag,
-                                   fps=args.save_fps)
-
-                # Save the imagen videos for decision-making
-                sample_video_file = f'{video_save_dir}/dm/{fs}/itr-{itr}.mp4'
-                save_results(pred_videos_0.cpu(),
-                             sample_video_file,
-                             fps=args.save_fps)
-                # Save videos environment changes via world-model interaction
-                sample_video_file = f'{video_save_dir}/wm/{fs}/itr-{itr}.mp4'
-                save_results(pred_videos_1.cpu(),
-                             sample_video_file,
-                             fps=args.save_fps)
+                if save_itr_videos:
+                    # Save the imagen videos for decision-making
+                    sample_tag = f"{args.dataset}-vid{sample['videoid']}-dm-fs-{fs}/itr-{itr}"
+                    log_to_tensorboard(writer,
+                                       pred_videos_0,
+                                       sample_tag,
+                                       fps=args.save_fps)
+                    # Save videos environment changes via world-model interaction
+                    sample_tag = f"{args.dataset}-vid{sample['videoid']}-wd-fs-{fs}/itr-{itr}"
+                    log_to_tensorboard(writer,
+                                       pred_videos_1,
+                                       sample_tag,
+                                       fps=args.save_fps)
+
+                    # Save the imagen videos for decision-making
+                    sample_video_file = f'{video_save_dir}/dm/{fs}/itr-{itr}.mp4'
+                    save_results(pred_videos_0.cpu(),
+                                 sample_video_file,
+                                 fps=args.save_fps)
+                    # Save videos environment changes via world-model interaction
+                    sample_video_file = f'{video_save_dir}/wm/{fs}/itr-{itr}.mp4'
+                    save_results(pred_videos_1.cpu(),
+                                 sample_video_file,
+                                 fps=args.save_fps)
 
                 print('>' * 24)
                 # Collect the result of world-model interactions
@@ -681,6 +773,8 @@ def run_inference(args: argparse.Namespace, gpu_num: int, gpu_no: int) -> None:
             sample_full_video_file = f"{video_save_dir}/../{sample['videoid']}_full_fs{fs}.mp4"
             save_results(full_video, sample_full_video_file, fps=args.save_fps)
 
+    print(f'>>> Text embedding cache: {model.cond_cache.stats()}')
+
 
 def get_parser():
     parser = argparse.ArgumentParser()
@@ -765,6 +859,13 @@ def get_parser():
         help=
         "Rescale factor for guidance as discussed in 'Common Diffusion Noise Schedules and Sample Steps are Flawed' (https://huggingface.co/papers/2305.08891)."
     )
+    parser.add_argument(
+        "--fused_cfg",
+        action='store_true',
+        default=False,
+        help=
+        "With --unconditional_guidance_scale != 1, run the conditional and unconditional branches of classifier-free guidance as one model pass over twice the batch. Faster, but needs twice the activation memory."
+    )
     parser.add_argument(
         "--perframe_ae",
         action='store_true',
@@ -772,6 +873,13 @@ def get_parser():
         help=
         "Use per-frame autoencoder decoding to reduce GPU memory usage. Recommended for models with resolutions like 576x1024."
     )
+    parser.add_argument(
+        "--ae_chunk_size",
+        type=lambda v: v if v == 'auto' else int(v),
+        default=None,
+        help=
+        "Frames per autoencoder call with --perframe_ae: an integer, or 'auto' to size the chunks from free GPU memory. Defaults to en_and_decode_n_samples_a_time of the config."
+    )
     parser.add_argument(
         "--n_action_steps",
         type=int,
@@ -798,6 +906,20 @@ def get_parser():
                         type=int,
                         default=8,
                         help="fps for the saving video")
+    parser.add_argument(
+        "--latent_loop",
+        action='store_true',
+        default=False,
+        help=
+        "carry predicted latents between iterations instead of decoding and re-encoding the frames; pixels are only decoded for conditioning and saving"
+    )
+    parser.add_argument(
+        "--skip_itr_videos",
+        action='store_true',
+        default=False,
+        help=
+        "only save the full interaction video, not the per-iteration videos; with --latent_loop the decision-making video is then never decoded"
+    )
     return parser
 
 
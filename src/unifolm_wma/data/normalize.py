@@ -15,7 +15,7 @@
 # limitations under the License.
 import torch
 from torch import Tensor, nn
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 
 def create_stats_buffers(
@@ -101,8 +101,22 @@ def _no_stats_error_str(name: str) -> str:
         "pretrained model.")
 
 
-class Normalize(nn.Module):
-    """Normalizes data (e.g. "observation.image") for more stable and faster convergence during training."""
+def _reset_stats_hook(module: nn.Module, incompatible_keys) -> None:
+    # A module-level function rather than a lambda, so the modules pickle
+    module.reset_stats()
+
+
+class _AffineStats(nn.Module):
+    """Shared logic of `Normalize` and `Unnormalize`.
+
+    Both are an affine map `(x - shift) * scale + offset` per modality, with
+    the subtraction first as in the plain formulas, so a tiny `max - min`
+    (a constant dim) doesn't cancel the offset. The statistics are checked
+    for infinity once instead of at every call: again only after a buffer
+    is replaced or changed in place (its `_version`), e.g. by
+    `load_state_dict`. The shift, scale and offset are precomputed from the
+    statistics and modalities of the same leading shape are mapped together.
+    """
 
     def __init__(
         self,
@@ -136,95 +150,127 @@ class Normalize(nn.Module):
         for key, buffer in stats_buffers.items():
             setattr(self, "buffer_" + key.replace(".", "_"), buffer)
 
+        self._validated_version = None
+        self._affine_cache = {}
+        self.register_load_state_dict_post_hook(_reset_stats_hook)
+
+    def _buffer(self, key: str) -> nn.ParameterDict:
+        return getattr(self, "buffer_" + key.replace(".", "_"))
+
+    def _stats_version(self) -> Tuple[Tuple[int, int], ...]:
+        """Storage and in-place version of every statistic; reading them
+        doesn't touch the device."""
+        return tuple((value.data_ptr(), value._version) for key in self.modes
+                     for value in self._buffer(key).values())
+
+    @property
+    def stats_validated(self) -> bool:
+        return self._validated_version == self._stats_version()
+
+    def reset_stats(self) -> None:
+        """Forget the checked statistics, e.g. after new ones were loaded."""
+        self._validated_version = None
+        self._affine_cache = {}
+
+    def validate_stats(self) -> None:
+        """Check that no statistic is still at its infinity placeholder."""
+        self._affine_cache = {}
+        for key in self.modes:
+            for name, value in self._buffer(key).items():
+                assert not torch.isinf(value).any(), _no_stats_error_str(name)
+        self._validated_version = self._stats_version()
+
+    def _shift_scale_offset(self, key: str,
+                            mode: str) -> Tuple[Tensor, Tensor, Tensor]:
+        raise NotImplementedError
+
+    def _get_affine(self,
+                    keys: Tuple[str, ...]) -> Tuple[Tensor, Tensor, Tensor]:
+        """Shift, scale and offset of `keys`, concatenated along the last dim."""
+        affine = self._affine_cache.get(keys)
+        if affine is None:
+            affine = tuple(
+                torch.cat(terms, dim=-1) for terms in zip(*[
+                    self._shift_scale_offset(key, self.modes[key])
+                    for key in keys
+                ]))
+            self._affine_cache[keys] = affine
+        return affine
+
     @torch.no_grad()
     def forward(self, batch: Dict[str, Tensor]) -> Dict[str, Tensor]:
+        """Return a new dict with the modalities in `modes` mapped; the input
+        dict and its tensors are left untouched."""
+        # Also catches a device move, which replaces the buffers
+        if not self.stats_validated:
+            self.validate_stats()
+
+        # Vector modalities with the same leading shape go through one op
+        groups = {}
         for key, mode in self.modes.items():
             if key not in batch:
                 continue
+            if mode not in ["mean_std", "min_max"]:
+                raise ValueError(mode)
+            x = batch[key]
+            if "image" in key:
+                group = (key, )
+            else:
+                group = (x.shape[:-1], x.dtype, x.device)
+            groups.setdefault(group, []).append(key)
 
-            buffer = getattr(self, "buffer_" + key.replace(".", "_"))
+        out = dict(batch)
+        for keys in groups.values():
+            keys = tuple(keys)
+            shift, scale, offset = self._get_affine(keys)
+            if len(keys) == 1:
+                out[keys[0]] = torch.addcmul(offset, batch[keys[0]] - shift,
+                                             scale)
+                continue
+            x = torch.cat([batch[key] for key in keys], dim=-1)
+            y = torch.addcmul(offset, x - shift, scale)
+            sizes = [batch[key].shape[-1] for key in keys]
+            out.update(zip(keys, y.split(sizes, dim=-1)))
+        return out
 
-            if mode == "mean_std":
-                mean = buffer["mean"]
-                std = buffer["std"]
 
-                assert not torch.isinf(mean).any(), _no_stats_error_str("mean")
-                assert not torch.isinf(std).any(), _no_stats_error_str("std")
-                batch[key] = (batch[key] - mean) / (std + 1e-8)
-            elif mode == "min_max":
-                min = buffer["min"]
-                max = buffer["max"]
-
-                assert not torch.isinf(min).any(), _no_stats_error_str("min")
-                assert not torch.isinf(max).any(), _no_stats_error_str("max")
-                # normalize to [0,1]
-                batch[key] = (batch[key] - min) / (max - min + 1e-8)
-                # normalize to [-1, 1]
-                batch[key] = batch[key] * 2 - 1
-            else:
-                raise ValueError(mode)
-        return batch
+class Normalize(_AffineStats):
+    """Normalizes data (e.g. "observation.image") for more stable and faster convergence during training."""
+
+    def _shift_scale_offset(self, key: str,
+                            mode: str) -> Tuple[Tensor, Tensor, Tensor]:
+        buffer = self._buffer(key)
+        if mode == "mean_std":
+            # (x - mean) / (std + eps)
+            shift = buffer["mean"].clone()
+            scale = 1 / (buffer["std"] + 1e-8)
+            offset = torch.zeros_like(scale)
+        else:
+            # normalize to [0,1] with (x - min) / (max - min + eps), then
+            # to [-1, 1]
+            shift = buffer["min"].clone()
+            scale = 2 / (buffer["max"] - buffer["min"] + 1e-8)
+            offset = torch.full_like(scale, -1)
+        return shift, scale, offset
 
 
-class Unnormalize(nn.Module):
+class Unnormalize(_AffineStats):
     """
     Similar to `Normalize` but unnormalizes output data (e.g. `{"action": torch.randn(b,c)}`) in their
     original range used by the environment.
     """
 
-    def __init__(
-        self,
-        shapes: Dict[str, List[int]],
-        modes: Dict[str, str],
-        stats: Dict[str, Dict[str, Tensor]] = None,
-    ):
-        """
-        Args:
-            shapes (Dict): A Dictionary where keys are input modalities (e.g. "observation.image") and values
-            are their shapes (e.g. `[3,96,96]`]). These shapes are used to create the tensor buffer containing
-            mean, std, min, max statistics. If the provided `shapes` contain keys related to images, the shape
-            is adjusted to be invariant to height and width, assuming a channel-first (c, h, w) format.
-            modes (Dict): A Dictionary where keys are output modalities (e.g. "observation.image") and values
-                are their normalization modes among:
-                    - "mean_std": subtract the mean and divide by standard deviation.
-                    - "min_max": map to [-1, 1] range.
-            stats (Dict, optional): A Dictionary where keys are output modalities (e.g. "observation.image")
-                and values are Dictionaries of statistic types and their values (e.g.
-                `{"mean": torch.randn(3,1,1)}, "std": torch.randn(3,1,1)}`). If provided, as expected for
-                training the model for the first time, these statistics will overwrite the default buffers. If
-                not provided, as expected for finetuning or evaluation, the default buffers should to be
-                overwritten by a call to `policy.load_state_Dict(state_Dict)`. That way, initializing the
-                dataset is not needed to get the stats, since they are already in the policy state_Dict.
-        """
-        super().__init__()
-        self.shapes = shapes
-        self.modes = modes
-        self.stats = stats
-        stats_buffers = create_stats_buffers(shapes, modes, stats)
-        for key, buffer in stats_buffers.items():
-            setattr(self, "buffer_" + key.replace(".", "_"), buffer)
-
-    @torch.no_grad()
-    def forward(self, batch: Dict[str, Tensor]) -> Dict[str, Tensor]:
-        for key, mode in self.modes.items():
-            if key not in batch:
-                continue
-
-            buffer = getattr(self, "buffer_" + key.replace(".", "_"))
-
-            if mode == "mean_std":
-                mean = buffer["mean"]
-                std = buffer["std"]
-                assert not torch.isinf(mean).any(), _no_stats_error_str("mean")
-                assert not torch.isinf(std).any(), _no_stats_error_str("std")
-                batch[key] = batch[key] * std + mean
-            elif mode == "min_max":
-                min = buffer["min"]
-                max = buffer["max"]
-                assert not torch.isinf(min).any(), _no_stats_error_str("min")
-                assert not torch.isinf(max).any(), _no_stats_error_str("max")
-                batch[key] = (batch[key] + 1) / 2
-                batch[key] = batch[key] * (max - min) + min
-            else:
-                raise ValueError(mode)
-        return batch
+    def _shift_scale_offset(self, key: str,
+                            mode: str) -> Tuple[Tensor, Tensor, Tensor]:
+        buffer = self._buffer(key)
+        if mode == "mean_std":
+            # x * std + mean
+            scale = buffer["std"].clone()
+            shift = torch.zeros_like(scale)
+            offset = buffer["mean"].clone()
+        else:
+            # (x + 1) / 2 * (max - min) + min
+            scale = (buffer["max"] - buffer["min"]) / 2
+            shift = torch.full_like(scale, -1)
+            offset = buffer["min"].clone()
+        return shift, scale, offset
@@ -1,16 +1,22 @@
 import torch
 import os
+import json
 import random
+import time
+import numpy as np
 import pandas as pd
 import h5py
 
+from collections import defaultdict
+from contextlib import contextmanager
 from decord import VideoReader, cpu
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 from torchvision import transforms
 from pathlib import Path
 
-from unifolm_wma.data.utils import load_stats
+from unifolm_wma.data.utils import load_stats, load_episode_data_index
 from unifolm_wma.data.normalize import Normalize, Unnormalize
+from unifolm_wma.utils.cache import LRUCache
 
 
 class WMAData(Dataset):
@@ -31,6 +37,39 @@ class WMAData(Dataset):
         │        ├── 1.h5
         │        └── ...
         └──  dataset_name.csv
+
+    With `transition_format='npy'` the per-episode `.h5` files are replaced by
+    one memory-mapped array per modality (see
+    `prepare_data/prepare_training_data.py --transition_format npy`):
+        transitions/dataset_name/
+            ├── action.npy
+            ├── observation.state.npy
+            └── meta_data
+                 ├── episode_data_index.safetensors
+                 └── transition_info.json
+
+    Each data-loader worker keeps an LRU of open video readers
+    (`video_reader_cache_size`) and of loaded episode transitions
+    (`transition_cache_size`), since weighted sampling hits the same episodes
+    repeatedly. `loader_stats()` reports their hit rates and the time spent per
+    loading stage; with `stats_log_interval` > 0 every worker prints them
+    every that many samples.
+
+    With `precomputed_dir` the frozen encoders' outputs are read from a store
+    written by `prepare_data/precompute_embeddings.py` instead of being
+    recomputed every step:
+        precomputed_dir/
+            ├── store_info.json
+            ├── text_embeddings.npy
+            ├── text_embeddings.json
+            └── dataset_name/camera_view_dir/0/
+                 ├── vae_moments.npy
+                 └── image_embeddings.npy
+    The target frames are then not decoded at all; samples carry
+    'video_moments', 'observation.image_emb' and 'instruction_emb' instead of
+    'video', and `LatentVisualDiffusion.get_batch_input` skips the VAE, text
+    and image encoders. The raw observation frames are still loaded for the
+    action head.
     """
 
     def __init__(
@@ -56,6 +95,11 @@ class WMAData(Dataset):
         n_obs_steps=1,
         max_action_dim=7,
         max_state_dim=7,
+        video_reader_cache_size=8,
+        transition_cache_size=64,
+        stats_log_interval=0,
+        transition_format='h5',
+        precomputed_dir=None,
     ):
         self.meta_path = meta_path
         self.data_dir = data_dir
@@ -74,6 +118,13 @@ class WMAData(Dataset):
         self.dataset_name = dataset_name
         self.max_action_dim = max_action_dim
         self.max_state_dim = max_state_dim
+        self.video_reader_cache_size = video_reader_cache_size
+        self.transition_cache_size = transition_cache_size
+        self.stats_log_interval = stats_log_interval
+        assert transition_format in ['h5', 'npy'], transition_format
+        self.transition_format = transition_format
+        self.precomputed_dir = precomputed_dir
+        self._cache_pid = None
 
         self._load_metadata()
         if spatial_transform is not None:
@@ -94,6 +145,11 @@ class WMAData(Dataset):
                 raise NotImplementedError
         else:
             self.spatial_transform = None
+        if precomputed_dir is not None:
+            # Precomputed frames must match what the transform produces now
+            assert spatial_transform != "random_crop", \
+                '>>> Precomputed embeddings need a deterministic spatial_transform.'
+            self._load_precomputed_info(spatial_transform)
 
         self.normalization_mode = normalization_mode
         self.individual_normalization = individual_normalization
@@ -139,23 +195,164 @@ class WMAData(Dataset):
         print(
             f">>> {self.metadata['data_dir'].iloc[0]}: normalizer initiated.")
 
+    def _load_precomputed_info(self, spatial_transform):
+        with open(os.path.join(self.precomputed_dir, 'store_info.json')) as f:
+            info = json.load(f)
+        expected = {
+            'resolution': list(self.resolution),
+            'spatial_transform': spatial_transform,
+            'load_raw_resolution': self.load_raw_resolution,
+        }
+        for key, value in expected.items():
+            assert info[key] == value, (
+                f'>>> Precomputed store has {key}={info[key]}, dataset uses {value}.'
+            )
+        with open(os.path.join(self.precomputed_dir,
+                               'text_embeddings.json')) as f:
+            self.text_embedding_index = json.load(f)
+        print(
+            f">>> {self.metadata['data_dir'].iloc[0]}: precomputed embeddings from {self.precomputed_dir}."
+        )
+
+    def _get_precomputed_dir(self, sample):
+        return os.path.join(self.precomputed_dir, sample['data_dir'],
+                            str(sample['videoid']))
+
+    def _get_precomputed(self, sample):
+        episode_dir = self._get_precomputed_dir(sample)
+        store = self.precomputed.get(episode_dir)
+        if store is None:
+            with self._timed('open_precomputed'):
+                # Read-only maps: only the indexed frames are paged in
+                store = {
+                    key: np.load(os.path.join(episode_dir, f'{key}.npy'),
+                                 mmap_mode='r')
+                    for key in ['vae_moments', 'image_embeddings']
+                }
+            self.precomputed.put(episode_dir, store)
+        return store
+
+    def _get_text_embedding(self, instruction):
+        if self.text_embeddings is None:
+            self.text_embeddings = np.load(os.path.join(
+                self.precomputed_dir, 'text_embeddings.npy'),
+                                           mmap_mode='r')
+        row = self.text_embedding_index[instruction]
+        return torch.from_numpy(np.array(self.text_embeddings[row]))
+
     def _get_video_path(self, sample):
         rel_video_fp = os.path.join(sample['data_dir'],
                                     str(sample['videoid']) + '.mp4')
         full_video_fp = os.path.join(self.data_dir, 'videos', rel_video_fp)
         return full_video_fp
 
-    def _get_transition_path(self, sample):
+    def _get_transition_dir(self, sample):
         data_dir = Path(sample['data_dir'])
-        if self.dataset_name == data_dir.name:
-            rel_transition_fp = os.path.join(str(data_dir),
-                                             str(sample['videoid']) + '.h5')
-        else:
-            rel_transition_fp = os.path.join(str(data_dir.parent),
-                                             str(sample['videoid']) + '.h5')
-        full_transition_fp = os.path.join(self.data_dir, 'transitions',
-                                          rel_transition_fp)
-        return full_transition_fp
+        if self.dataset_name != data_dir.name:
+            data_dir = data_dir.parent
+        return os.path.join(self.data_dir, 'transitions', str(data_dir))
+
+    def _get_transition_path(self, sample):
+        return os.path.join(self._get_transition_dir(sample),
+                            str(sample['videoid']) + '.h5')
+
+    def _init_worker_caches(self):
+        # Readers must not be shared across forked data-loader workers, so the
+        # caches are (re)created in every process that uses the dataset
+        if self._cache_pid == os.getpid():
+            return
+        self._cache_pid = os.getpid()
+        self.video_readers = LRUCache(self.video_reader_cache_size)
+        self.transitions = LRUCache(self.transition_cache_size)
+        self.packed_transitions = {}
+        self.precomputed = LRUCache(self.video_reader_cache_size)
+        self.text_embeddings = None
+        self.stage_times = defaultdict(float)
+        self.stage_counts = defaultdict(int)
+        self.num_loaded = 0
+
+    @contextmanager
+    def _timed(self, stage):
+        start = time.perf_counter()
+        yield
+        self.stage_times[stage] += time.perf_counter() - start
+        self.stage_counts[stage] += 1
+
+    def _get_video_reader(self, video_path):
+        video_reader = self.video_readers.get(video_path)
+        if video_reader is None:
+            with self._timed('open_video'):
+                if self.load_raw_resolution:
+                    video_reader = VideoReader(video_path, ctx=cpu(0))
+                else:
+                    video_reader = VideoReader(video_path,
+                                               ctx=cpu(0),
+                                               width=530,
+                                               height=300)
+            self.video_readers.put(video_path, video_reader)
+        return video_reader
+
+    def _get_transitions(self, transition_path):
+        # The whole episode is small; keep it in memory and let the caller
+        # index only the rows it needs
+        transition_dict = self.transitions.get(transition_path)
+        if transition_dict is None:
+            with self._timed('load_transition'):
+                with h5py.File(transition_path, 'r') as h5f:
+                    transition_dict = {}
+                    for key in h5f.keys():
+                        transition_dict[key] = torch.from_numpy(h5f[key][()])
+                    for key in h5f.attrs.keys():
+                        transition_dict[key] = h5f.attrs[key]
+            self.transitions.put(transition_path, transition_dict)
+        return transition_dict
+
+    def _get_packed_transitions(self, sample):
+        transition_dir = self._get_transition_dir(sample)
+        store = self.packed_transitions.get(transition_dir)
+        if store is None:
+            with self._timed('open_transition_store'):
+                # Copy-on-write maps: pages are only read when indexed and the
+                # arrays can back tensors without a copy
+                store = {
+                    key: np.load(os.path.join(transition_dir, f'{key}.npy'),
+                                 mmap_mode='c')
+                    for key in ['action', 'observation.state']
+                }
+                index = load_episode_data_index(
+                    os.path.basename(transition_dir), None,
+                    os.path.dirname(transition_dir))
+                store['from'] = index['from'].tolist()
+                store['to'] = index['to'].tolist()
+                with open(
+                        os.path.join(transition_dir, 'meta_data',
+                                     'transition_info.json')) as f:
+                    store['info'] = json.load(f)
+            self.packed_transitions[transition_dir] = store
+
+        episode = int(sample['videoid'])
+        start, end = store['from'][episode], store['to'][episode]
+        transition_dict = {
+            key: torch.from_numpy(store[key][start:end])
+            for key in ['action', 'observation.state']
+        }
+        transition_dict.update(store['info'])
+        return transition_dict
+
+    def loader_stats(self):
+        """Cache hit rates and per-stage loading times of this process."""
+        self._init_worker_caches()
+        return {
+            'samples': self.num_loaded,
+            'video_reader_cache': self.video_readers.stats(),
+            'transition_cache': self.transitions.stats(),
+            'precomputed_cache': self.precomputed.stats(),
+            'stage_ms': {
+                stage: 1000. * total / self.stage_counts[stage]
+                for stage, total in self.stage_times.items()
+            },
+            'stage_total_s': dict(self.stage_times)
+        }
 
     def get_uni_vec(self, action_state_dict, action_type, state_type):
         if 'pre_action' in action_state_dict:
@@ -195,6 +392,7 @@ class WMAData(Dataset):
         return uni_state, uni_state_mask
 
     def __getitem__(self, index):
+        self._init_worker_caches()
 
         if self.random_fs:
             frame_stride = random.randint(self.frame_stride_min,
@@ -215,13 +413,7 @@ class WMAData(Dataset):
                     instruction = sample['embodiment'] + ' [SEP] ' + sample[
                         'instruction']
             try:
-                if self.load_raw_resolution:
-                    video_reader = VideoReader(video_path, ctx=cpu(0))
-                else:
-                    video_reader = VideoReader(video_path,
-                                               ctx=cpu(0),
-                                               width=530,
-                                               height=300)
+                video_reader = self._get_video_reader(video_path)
                 if len(video_reader) < self.video_length:
                     print(
                         f">>> Video length ({len(video_reader)}) is smaller than target length({self.video_length})"
@@ -270,7 +462,16 @@ class WMAData(Dataset):
                 next_frame_indices = [
                     idx + frame_stride for idx in frame_indices
                 ]
-                frames = video_reader.get_batch(next_frame_indices)
+                if self.precomputed_dir is not None:
+                    precomputed = self._get_precomputed(sample)
+                    with self._timed('load_precomputed'):
+                        # (t, 2c, h, w) -> (2c, t, h, w), like 'video'
+                        frames = torch.from_numpy(
+                            precomputed['vae_moments'][next_frame_indices])
+                        frames = frames.permute(1, 0, 2, 3)
+                else:
+                    with self._timed('decode_frames'):
+                        frames = video_reader.get_batch(next_frame_indices)
                 break
             except:
                 print(
@@ -280,13 +481,11 @@ class WMAData(Dataset):
                 continue
 
         # Load transition data
-        transition_path = self._get_transition_path(sample)
-        with h5py.File(transition_path, 'r') as h5f:
-            transition_dict = {}
-            for key in h5f.keys():
-                transition_dict[key] = torch.tensor(h5f[key][()])
-            for key in h5f.attrs.keys():
-                transition_dict[key] = h5f.attrs[key]
+        if self.transition_format == 'npy':
+            transition_dict = self._get_packed_transitions(sample)
+        else:
+            transition_path = self._get_transition_path(sample)
+            transition_dict = self._get_transitions(transition_path)
 
         # Load observable states
         if start_idx < self.n_obs_steps - 1:
@@ -344,8 +543,9 @@ class WMAData(Dataset):
         # Load observable images
         if start_idx < self.n_obs_steps - 1:
             action_net_frame_indices = list(range(0, start_idx + 1))
-            action_net_frames = video_reader.get_batch(
-                action_net_frame_indices)
+            with self._timed('decode_frames'):
+                action_net_frames = video_reader.get_batch(
+                    action_net_frame_indices)
             action_net_frames = torch.tensor(
                 action_net_frames.asnumpy()).permute(0, 3, 1, 2).float()
             first_slice = action_net_frames[0:1, :]
@@ -359,26 +559,32 @@ class WMAData(Dataset):
         else:
             action_net_frame_indices = list(
                 range(start_idx - self.n_obs_steps + 1, start_idx + 1))
-            action_net_frames = video_reader.get_batch(
-                action_net_frame_indices)
+            with self._timed('decode_frames'):
+                action_net_frames = video_reader.get_batch(
+                    action_net_frame_indices)
             assert (
                 action_net_frames.shape[0] == self.n_obs_steps
             ), f'{len(action_net_frames)}, self.n_obs_steps={self.n_obs_steps}'
             action_net_frames = torch.tensor(
                 action_net_frames.asnumpy()).permute(3, 0, 1, 2).float()
 
-        assert (frames.shape[0] == self.video_length
-                ), f'{len(frames)}, self.video_length={self.video_length}'
-        frames = torch.tensor(frames.asnumpy()).permute(3, 0, 1, 2).float()
+        if self.precomputed_dir is None:
+            assert (frames.shape[0] == self.video_length
+                    ), f'{len(frames)}, self.video_length={self.video_length}'
+            frames = torch.tensor(frames.asnumpy()).permute(3, 0, 1,
+                                                            2).float()
 
         if self.spatial_transform is not None:
-            frames = self.spatial_transform(frames)
-            action_net_frames = self.spatial_transform(action_net_frames)
+            with self._timed('transform'):
+                if self.precomputed_dir is None:
+                    frames = self.spatial_transform(frames)
+                action_net_frames = self.spatial_transform(action_net_frames)
 
         if self.resolution is not None:
-            assert (frames.shape[2], frames.shape[3]) == (
-                self.resolution[0], self.resolution[1]
-            ), f'frames={frames.shape}, self.resolution={self.resolution}'
+            if self.precomputed_dir is None:
+                assert (frames.shape[2], frames.shape[3]) == (
+                    self.resolution[0], self.resolution[1]
+                ), f'frames={frames.shape}, self.resolution={self.resolution}'
             assert (
                 action_net_frames.shape[2], action_net_frames.shape[3]
             ) == (
@@ -386,22 +592,37 @@ class WMAData(Dataset):
             ), f'action_net_frames={action_net_frames.shape}, self.resolution={self.resolution}'
 
         # Normalize frames tensors to [-1,1]
-        frames = (frames / 255 - 0.5) * 2
+        if self.precomputed_dir is None:
+            frames = (frames / 255 - 0.5) * 2
         action_net_frames = (action_net_frames / 255 - 0.5) * 2
         fps_clip = fps_ori // frame_stride
         if self.fps_max is not None and fps_clip > self.fps_max:
             fps_clip = self.fps_max
 
         data = {
-            'video': frames,
             'instruction': instruction,
             'path': video_path,
             'fps': fps_clip,
             'frame_stride': frame_stride,
             'observation.image': action_net_frames,
         }
+        if self.precomputed_dir is None:
+            data['video'] = frames
+        else:
+            data['video_moments'] = frames
+            data['observation.image_emb'] = torch.from_numpy(
+                np.array(precomputed['image_embeddings'][start_idx]))
+            data['instruction_emb'] = self._get_text_embedding(instruction)
         data.update(frames_action_state_dict)
 
+        self.num_loaded += 1
+        if self.stats_log_interval > 0 and self.num_loaded % self.stats_log_interval == 0:
+            worker_info = get_worker_info()
+            worker_id = worker_info.id if worker_info is not None else 0
+            print(
+                f">>> [worker {worker_id}] data loading stats: {self.loader_stats()}"
+            )
+
         return data
 
     def __len__(self):
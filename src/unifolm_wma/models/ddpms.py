@@ -31,6 +31,7 @@ from torch import Tensor
 
 from unifolm_wma.utils.utils import instantiate_from_config
 from unifolm_wma.utils.ema import LitEma
+from unifolm_wma.utils.cache import LRUCache
 from unifolm_wma.utils.distributions import DiagonalGaussianDistribution
 from unifolm_wma.utils.diffusion import make_beta_schedule, rescale_zero_terminal_snr
 from unifolm_wma.utils.basics import disabled_train
@@ -820,7 +821,8 @@ class LatentDiffusion(DDPM):
                  perframe_ae: bool = False,
                  logdir: str | None = None,
                  rand_cond_frame: bool = False,
-                 en_and_decode_n_samples_a_time: int | None = None,
+                 en_and_decode_n_samples_a_time: int | str | None = None,
+                 cond_cache_size: int = 128,
                  *args,
                  **kwargs):
         """
@@ -844,10 +846,15 @@ class LatentDiffusion(DDPM):
             turning_step: Steps to transition from 1.0 to base_scale in dynamic rescaling.
             interp_mode: Flag for interpolation-specific behaviors (reserved).
             fps_condition_type: Frame-per-second conditioning mode label.
-            perframe_ae: If True, encode/decode one frame at a time.
+            perframe_ae: If True, encode/decode frames in chunks of
+                `en_and_decode_n_samples_a_time` instead of all at once.
             logdir: Optional directory for logs.
             rand_cond_frame: If True, randomly select conditioning frames.
-            en_and_decode_n_samples_a_time: Optional per-step batch size for (en|de)code loops.
+            en_and_decode_n_samples_a_time: Frames per first-stage call with `perframe_ae`:
+                an int, 'auto' to size the chunks from free device memory and the measured
+                footprint of one frame, or None for one frame at a time.
+            cond_cache_size: Number of text-prompt embeddings kept by `get_learned_conditioning`
+                (0 disables the cache). Only used with a frozen conditioning model.
         """
 
         self.num_timesteps_cond = default(num_timesteps_cond, 1)
@@ -869,7 +876,10 @@ class LatentDiffusion(DDPM):
 
         self.logdir = logdir
         self.rand_cond_frame = rand_cond_frame
+        assert en_and_decode_n_samples_a_time in (None, 'auto') or int(
+            en_and_decode_n_samples_a_time) > 0, en_and_decode_n_samples_a_time
         self.en_and_decode_n_samples_a_time = en_and_decode_n_samples_a_time
+        self.ae_chunk_sizes = {}
 
         try:
             self.num_downs = len(
@@ -895,6 +905,7 @@ class LatentDiffusion(DDPM):
         self.clip_denoised = False
 
         self.cond_stage_forward = cond_stage_forward
+        self.cond_cache = LRUCache(cond_cache_size)
         self.encoder_type = encoder_type
         assert (encoder_type in ["2d", "3d"])
         self.uncond_prob = uncond_prob
@@ -1014,6 +1025,51 @@ class LatentDiffusion(DDPM):
         Returns:
             Conditioning embedding as a tensor (shape depends on cond model).
         """
+        if self._is_cacheable_conditioning(c):
+            return self._get_cached_conditioning(c)
+        return self._encode_conditioning(c)
+
+    def _is_cacheable_conditioning(self, c: Any) -> bool:
+        """
+        Text prompts to a frozen conditioning model can be served from `cond_cache`.
+        """
+        if self.cond_cache.capacity == 0 or self.cond_stage_trainable:
+            return False
+        if isinstance(c, str):
+            return True
+        return isinstance(c, (list, tuple)) and len(c) > 0 and all(
+            isinstance(p, str) for p in c)
+
+    def _get_cached_conditioning(self, c: str | Sequence[str]) -> Tensor:
+        """
+        Embed text prompts, running the conditioning model only on prompts not in
+        `cond_cache`. Entries are keyed by the prompt and the conditioning model, so
+        swapping `cond_stage_model` never returns stale embeddings.
+
+        Args:
+            c: A prompt or a list of prompts.
+
+        Returns:
+            Embeddings stacked along the batch dim, in the order of `c`.
+        """
+        prompts = [c] if isinstance(c, str) else list(c)
+        encoder_key = (id(self.cond_stage_model), self.cond_stage_forward)
+        embs = [self.cond_cache.get(encoder_key + (p, )) for p in prompts]
+
+        missing = list(
+            dict.fromkeys(p for p, e in zip(prompts, embs) if e is None))
+        if missing:
+            new_embs = self._encode_conditioning(missing).detach()
+            new_embs = dict(zip(missing, new_embs.split(1)))
+            for p, e in new_embs.items():
+                self.cond_cache.put(encoder_key + (p, ), e)
+            embs = [new_embs[p] if e is None else e for p, e in zip(prompts, embs)]
+        return torch.cat([e.to(self.device) for e in embs], dim=0)
+
+    def _encode_conditioning(self, c: Any) -> Tensor:
+        """
+        Run the conditioning model on `c` (see `get_learned_conditioning`).
+        """
         if self.cond_stage_forward is None:
             if hasattr(self.cond_stage_model, 'encode') and callable(
                     self.cond_stage_model.encode):
@@ -1027,6 +1083,21 @@ class LatentDiffusion(DDPM):
             c = getattr(self.cond_stage_model, self.cond_stage_forward)(c)
         return c
 
+    def get_unconditional_conditioning(self, cond_emb: Tensor) -> Tensor:
+        """
+        Text embedding of the unconditional branch of classifier-free guidance,
+        dropped the same way as in training (see `uncond_type`).
+
+        Args:
+            cond_emb: Conditional text embeddings, [B, L, D].
+
+        Returns:
+            Unconditional embeddings shaped like `cond_emb`.
+        """
+        if self.uncond_type == 'zero_embed':
+            return torch.zeros_like(cond_emb)
+        return self.get_learned_conditioning([""] * cond_emb.shape[0])
+
     def get_first_stage_encoding(
             self,
             encoder_posterior: DiagonalGaussianDistribution | Tensor,
@@ -1069,25 +1140,109 @@ class LatentDiffusion(DDPM):
         else:
             reshape_back = False
 
-        ## Consume more GPU memory but faster
-        if not self.perframe_ae:
-            encoder_posterior = self.first_stage_model.encode(x)
-            results = self.get_first_stage_encoding(encoder_posterior).detach()
-        else:  ## Consume less GPU memory but slower
-            results = []
-            for index in range(x.shape[0]):
-                frame_batch = self.first_stage_model.encode(x[index:index +
-                                                              1, :, :, :])
-                frame_result = self.get_first_stage_encoding(
-                    frame_batch).detach()
-                results.append(frame_result)
-            results = torch.cat(results, dim=0)
+        def encode(frames: Tensor) -> Tensor:
+            encoder_posterior = self.first_stage_model.encode(frames)
+            return self.get_first_stage_encoding(encoder_posterior).detach()
+
+        results = self._first_stage_in_chunks('encode', encode, x)
 
         if reshape_back:
             results = rearrange(results, '(b t) c h w -> b c t h w', b=b, t=t)
 
         return results
 
+    def _first_stage_in_chunks(self, kind: str, fn: Callable[[Tensor],
+                                                             Tensor],
+                               x: Tensor) -> Tensor:
+        """
+        Apply a first-stage call to x, in chunks along dim 0 with `perframe_ae`.
+
+        Without `perframe_ae` all frames go in one call (fastest, but the
+        activations of all b*t frames must fit at once). Otherwise the chunk
+        size is `en_and_decode_n_samples_a_time` (1 if unset). With 'auto' on
+        CUDA, the first frame of a new input shape is run alone to measure its peak
+        activation memory, and the chunk size is what fits in the free device
+        memory; it is kept per (kind, shape, dtype, device, grad mode) and
+        halved if a chunk still runs out of memory.
+
+        Args:
+            kind: 'encode' or 'decode', part of the auto-tuning key.
+            fn: Maps a (n, ...) chunk to its (n, ...) result.
+            x: Frames (N, ...).
+
+        Returns:
+            The results of all chunks concatenated along dim 0.
+        """
+        auto = self.en_and_decode_n_samples_a_time == 'auto'
+        # Off CUDA there is no device budget to tune against
+        if not self.perframe_ae or (auto and x.device.type != 'cuda'):
+            return fn(x)
+
+        if auto:
+            key = (kind, tuple(x.shape[1:]), x.dtype, x.device,
+                   torch.is_grad_enabled())
+            chunk_size = self.ae_chunk_sizes.get(key)
+        else:
+            chunk_size = int(self.en_and_decode_n_samples_a_time or 1)
+
+        results = []
+        start = 0
+        if chunk_size is None:
+            result, chunk_size = self._measure_chunk_size(fn, x[:1])
+            self.ae_chunk_sizes[key] = chunk_size
+            results.append(result)
+            start = 1
+        while start < x.shape[0]:
+            try:
+                results.append(fn(x[start:start + chunk_size]))
+            except torch.cuda.OutOfMemoryError:
+                if not auto or chunk_size == 1:
+                    raise
+                chunk_size = max(chunk_size // 2, 1)
+                self.ae_chunk_sizes[key] = chunk_size
+                mainlogger.info(
+                    f"first stage {kind}: out of memory, chunk size -> {chunk_size}"
+                )
+                torch.cuda.empty_cache()
+                continue
+            start += chunk_size
+        return results[0] if len(results) == 1 else torch.cat(results, dim=0)
+
+    def _measure_chunk_size(self, fn: Callable[[Tensor], Tensor],
+                            frame: Tensor) -> tuple[Tensor, int]:
+        """
+        Run fn on a single frame and derive how many frames fit per call.
+
+        The peak memory of the call above what was allocated before it is the
+        footprint of one frame; the chunk holds as many as fit in 90% of the
+        free memory (driver-free plus cached by the allocator). The peak
+        counter is process-wide and is not reset, so that peak-memory logging
+        keeps working: if an earlier peak is higher than the call's own, the
+        footprint is overestimated and the chunks only get smaller.
+
+        Args:
+            fn: First-stage call (see `_first_stage_in_chunks`).
+            frame: One frame (1, ...).
+
+        Returns:
+            (fn(frame), chunk size).
+        """
+        device = frame.device
+        torch.cuda.synchronize(device)
+        allocated = torch.cuda.memory_allocated(device)
+        result = fn(frame)
+        torch.cuda.synchronize(device)
+        footprint = max(torch.cuda.max_memory_allocated(device) - allocated,
+                        1)
+        free, _ = torch.cuda.mem_get_info(device)
+        cached = torch.cuda.memory_reserved(
+            device) - torch.cuda.memory_allocated(device)
+        chunk_size = max(int(0.9 * (free + cached) // footprint), 1)
+        mainlogger.info(
+            f"first stage: {footprint / 2**20:.0f} MiB per frame of {tuple(frame.shape[1:])}, "
+            f"chunk size {chunk_size}")
+        return result, chunk_size
+
     def decode_core(self, z: Tensor, **kwargs: Any) -> Tensor:
         """
         Decode latent z back to pixel space (2D or per-frame).
@@ -1105,16 +1260,11 @@ class LatentDiffusion(DDPM):
         else:
             reshape_back = False
 
-        if not self.perframe_ae:
-            z = 1. / self.scale_factor * z
-            results = self.first_stage_model.decode(z, **kwargs)
-        else:
-            results = []
-            for index in range(z.shape[0]):
-                frame_z = 1. / self.scale_factor * z[index:index + 1, :, :, :]
-                frame_result = self.first_stage_model.decode(frame_z, **kwargs)
-                results.append(frame_result)
-            results = torch.cat(results, dim=0)
+        def decode(frames_z: Tensor) -> Tensor:
+            return self.first_stage_model.decode(
+                1. / self.scale_factor * frames_z, **kwargs)
+
+        results = self._first_stage_in_chunks('decode', decode, z)
 
         if reshape_back:
             results = rearrange(results, '(b t) c h w -> b c t h w', b=b, t=t)
@@ -1264,13 +1414,15 @@ class LatentDiffusion(DDPM):
             key = 'c_concat' if self.model.conditioning_key == 'concat' else 'c_crossattn'
             cond = {key: cond}
 
-        x_recon, x_action_recon, x_state_recon = self.model(
+        x_recon, x_action_recon, x_state_recon, *features = self.model(
             x_noisy, x_action_noisy, x_state_noisy, t, **cond, **kwargs)
 
         if isinstance(x_recon, tuple):
             return x_recon[0]
         else:
-            return x_recon, x_action_recon, x_state_recon
+            # `features` holds the trunk features for the action/state heads
+            # when called with return_action_features=True
+            return (x_recon, x_action_recon, x_state_recon, *features)
 
     def p_losses(
         self,
@@ -1431,6 +1583,21 @@ class LatentDiffusion(DDPM):
             )
         return loss
 
+    def on_train_epoch_end(self) -> None:
+        """
+        Report the text embedding cache once per epoch rather than per step.
+        """
+        stats = self.cond_cache.stats()
+        if stats['hit_rate'] is None:
+            return
+        self.log('cond_cache_hit_rate',
+                 stats['hit_rate'],
+                 logger=True,
+                 on_step=False,
+                 on_epoch=True,
+                 sync_dist=False)
+        mainlogger.info(f"text embedding cache: {stats}")
+
     @torch.no_grad()
     def validation_step(self, batch: Mapping[str, Any],
                         batch_idx: int) -> None:
@@ -1973,6 +2140,23 @@ class LatentVisualDiffusion(LatentDiffusion):
             for param in self.embedder.parameters():
                 param.requires_grad = False
 
+    @torch.no_grad()
+    def _get_null_image_embedding(self, img: Tensor) -> Tensor:
+        """
+        Embedding of the all-zero (dropped) conditioning image, cached per shape.
+
+        Args:
+            img: Conditioning images (B, C, H, W), for shape/device/dtype only.
+
+        Returns:
+            Embedding of one zero image, (1, L, D).
+        """
+        key = (tuple(img.shape[1:]), img.device, img.dtype)
+        if getattr(self, '_null_img_emb', None) is None or self._null_img_emb[0] != key:
+            zeros = torch.zeros_like(img[:1])
+            self._null_img_emb = (key, self.embedder(zeros).detach())
+        return self._null_img_emb[1]
+
     def init_normalizers(self, normalize_config: OmegaConf,
                          dataset_stats: Mapping[str, Any]) -> None:
         """
@@ -2082,7 +2266,9 @@ class LatentVisualDiffusion(LatentDiffusion):
         """
         if self.dp_use_ema:
             if self.dp_ema_model is not None and not self.dp_ema_model_on_device:
-                device = self.model.device
+                # The trainer moves every submodule to the accelerator; put
+                # the EMA copy back where it was asked to live
+                device = self.dp_ema.device or self.model.device
                 self.dp_ema_model.to(device)
                 self.dp_ema_model_on_device = True
             self.dp_ema.step(self.model.diffusion_model.action_unet)
@@ -2125,15 +2311,24 @@ class LatentVisualDiffusion(LatentDiffusion):
             return_original_cond: If True, also return raw instruction text.
             return_fs: If True, return fps or frame_stride per config.
             return_cond_frame: If True, return conditioning frames (obs images).
-            return_original_input: If True, return original x (pre-encoding).
+            return_original_input: If True, return original x (pre-encoding);
+                not available for batches without the video (see below).
             logging: If True, append sim_mode flag at the end.
 
+        Batches from a dataset with `precomputed_dir` carry the outputs of the
+        frozen encoders ('video_moments', 'instruction_emb' and
+        'observation.image_emb'), which are used instead of running them.
+
         Returns:
             A list of inputs
         """
         # x: b c t h w
-        x = super().get_input(batch, self.first_stage_key)
-        b, _, t, _, _ = x.shape
+        if self.first_stage_key in batch:
+            x = super().get_input(batch, self.first_stage_key)
+        else:
+            x = None
+            assert not return_original_input, \
+                'return_original_input needs the video, which precomputed batches do not carry'
         # Get actions: b t d
         action = super().get_input(batch, 'action')
         # Get states: b t d
@@ -2144,12 +2339,20 @@ class LatentVisualDiffusion(LatentDiffusion):
         obs = super().get_input(batch, 'observation.image')
 
         # Encode video frames x to z via a 2D encoder
-        z = self.encode_first_stage(x)
+        if 'video_moments' in batch:
+            moments = super().get_input(batch, 'video_moments')
+            z = self.get_first_stage_encoding(
+                DiagonalGaussianDistribution(moments)).detach()
+        else:
+            z = self.encode_first_stage(x)
+        b = z.shape[0]
 
         cond = {}
         # Get instruction condition
         cond_ins_input = batch[self.cond_stage_key]
-        if isinstance(cond_ins_input, dict) or isinstance(
+        if 'instruction_emb' in batch:
+            cond_ins_emb = super().get_input(batch, 'instruction_emb')
+        elif isinstance(cond_ins_input, dict) or isinstance(
                 cond_ins_input, list):
             cond_ins_emb = self.get_learned_conditioning(cond_ins_input)
         else:
@@ -2158,9 +2361,9 @@ class LatentVisualDiffusion(LatentDiffusion):
         # To support classifier-free guidance, randomly drop out only text conditioning
         # 5%, only image conditioning 5%, and both 5%.
         if random_uncond:
-            random_num = torch.rand(b, device=x.device)
+            random_num = torch.rand(b, device=z.device)
         else:
-            random_num = torch.ones(b, device=x.device)
+            random_num = torch.ones(b, device=z.device)
         prompt_mask = rearrange(random_num < 2 * self.uncond_prob,
                                 "n -> n 1 1")
         null_prompt = self.get_learned_conditioning([""])
@@ -2174,8 +2377,16 @@ class LatentVisualDiffusion(LatentDiffusion):
             (random_num >= self.uncond_prob).float() *
             (random_num < 3 * self.uncond_prob).float(), "n -> n 1 1 1")
 
-        cond_img = input_mask * img
-        cond_img_emb = self.embedder(cond_img)
+        if 'observation.image_emb' in batch:
+            # Dropped images are zeros, whose embedding is computed only once
+            cond_img_emb = super().get_input(batch, 'observation.image_emb')
+            null_img_emb = self._get_null_image_embedding(img)
+            cond_img_emb = torch.where(
+                rearrange(input_mask, "n 1 1 1 -> n 1 1") > 0, cond_img_emb,
+                null_img_emb)
+        else:
+            cond_img = input_mask * img
+            cond_img_emb = self.embedder(cond_img)
         cond_img_emb = self.image_proj_model(cond_img_emb)
 
         if self.model.conditioning_key == 'hybrid':
@@ -2410,6 +2621,17 @@ class LatentVisualDiffusion(LatentDiffusion):
         return [optimizer]
 
 
+def _cat_crossattn(c_crossattn: Sequence[Tensor]) -> Tensor:
+    """
+    Concatenate the cross-attention context. A single tensor is passed through
+    as is, so the model sees the same object at every sampling step and its
+    context caches can match it by identity.
+    """
+    if len(c_crossattn) == 1:
+        return c_crossattn[0]
+    return torch.cat(c_crossattn, 1)
+
+
 class DiffusionWrapper(pl.LightningModule):
     """Thin wrapper that routes inputs/conditions to the underlying diffusion model."""
 
@@ -2464,11 +2686,11 @@ class DiffusionWrapper(pl.LightningModule):
             xc = torch.cat([x] + c_concat, dim=1)
             out = self.diffusion_model(xc, t, **kwargs)
         elif self.conditioning_key == 'crossattn':
-            cc = torch.cat(c_crossattn, 1)
+            cc = _cat_crossattn(c_crossattn)
             out = self.diffusion_model(x, t, context=cc, **kwargs)
         elif self.conditioning_key == 'hybrid':
             xc = torch.cat([x] + c_concat, dim=1)
-            cc = torch.cat(c_crossattn, 1)
+            cc = _cat_crossattn(c_crossattn)
             cc_action = c_crossattn_action
             out = self.diffusion_model(xc,
                                        x_action,
@@ -2486,12 +2708,12 @@ class DiffusionWrapper(pl.LightningModule):
         elif self.conditioning_key == 'hybrid-adm':
             assert c_adm is not None
             xc = torch.cat([x] + c_concat, dim=1)
-            cc = torch.cat(c_crossattn, 1)
+            cc = _cat_crossattn(c_crossattn)
             out = self.diffusion_model(xc, t, context=cc, y=c_adm, **kwargs)
         elif self.conditioning_key == 'hybrid-time':
             assert s is not None
             xc = torch.cat([x] + c_concat, dim=1)
-            cc = torch.cat(c_crossattn, 1)
+            cc = _cat_crossattn(c_crossattn)
             out = self.diffusion_model(xc, t, context=cc, s=s)
         elif self.conditioning_key == 'concat-time-mask':
             xc = torch.cat([x] + c_concat, dim=1)
@@ -2503,7 +2725,7 @@ class DiffusionWrapper(pl.LightningModule):
                 xc = x
             out = self.diffusion_model(xc, t, context=None, y=s, mask=mask)
         elif self.conditioning_key == 'hybrid-adm-mask':
-            cc = torch.cat(c_crossattn, 1)
+            cc = _cat_crossattn(c_crossattn)
             if c_concat is not None:
                 xc = torch.cat([x] + c_concat, dim=1)
             else:
@@ -2512,11 +2734,11 @@ class DiffusionWrapper(pl.LightningModule):
         elif self.conditioning_key == 'hybrid-time-adm':
             assert c_adm is not None
             xc = torch.cat([x] + c_concat, dim=1)
-            cc = torch.cat(c_crossattn, 1)
+            cc = _cat_crossattn(c_crossattn)
             out = self.diffusion_model(xc, t, context=cc, s=s, y=c_adm)
         elif self.conditioning_key == 'crossattn-adm':
             assert c_adm is not None
-            cc = torch.cat(c_crossattn, 1)
+            cc = _cat_crossattn(c_crossattn)
             out = self.diffusion_model(x, t, context=cc, y=c_adm)
         else:
             raise NotImplementedError()
@@ -1,8 +1,10 @@
 import logging
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import einops
 
+from contextlib import contextmanager
 from einops import rearrange, repeat
 from typing import Union
 
@@ -10,8 +12,10 @@ from unifolm_wma.models.diffusion_head.conv1d_components import (
     Downsample1d, Upsample1d, Conv1dBlock)
 from unifolm_wma.models.diffusion_head.positional_embedding import SinusoidalPosEmb
 from unifolm_wma.models.diffusion_head.base_nets import SpatialSoftmax
+from unifolm_wma.modules.attention import attention
 
 from unifolm_wma.utils.basics import zero_module
+from unifolm_wma.utils.cache import same_tensor
 from unifolm_wma.utils.common import (
     checkpoint,
     exists,
@@ -73,13 +77,12 @@ class CrossAttention(nn.Module):
         self.to_out = nn.Sequential(nn.Linear(inner_dim, query_dim),
                                     nn.Dropout(dropout))
 
-    def efficient_forward(self, x, context=None):
-        spatial_self_attn = (context is None)
-        k_ip, v_ip, out_ip = None, None, None
+    def forward(self, x, context=None, mask=None):
+        if exists(mask):
+            raise NotImplementedError
 
         q = self.to_q(x)
-        if spatial_self_attn:
-            context = default(context, x)
+        context = default(context, x)
         k = self.to_k(context)
         v = self.to_v(context)
 
@@ -91,11 +94,7 @@ class CrossAttention(nn.Module):
             (q, k, v),
         )
         # actually compute the attention, what we cannot get enough of
-        out = xformers.ops.memory_efficient_attention(q,
-                                                      k,
-                                                      v,
-                                                      attn_bias=None,
-                                                      op=None)
+        out = attention(q, k, v)
         out = (out.unsqueeze(0).reshape(
             b, self.heads, out.shape[1],
             self.dim_head).permute(0, 2, 1,
@@ -284,6 +283,27 @@ class ConditionalResidualBlock1D(nn.Module):
         return out
 
 
+@contextmanager
+def cache_global_cond(model):
+    """
+    Compute the observation encoding of every ConditionalUnet1D in `model`
+    once and reuse it while the observation stays the same, e.g. across the
+    denoising steps of one sampling call. Each head keeps its own entry since
+    the action and state heads have separate encoders.
+    """
+    heads = [
+        m for m in model.modules()
+        if isinstance(m, ConditionalUnet1D) and m.global_cond_cache is None
+    ]
+    for head in heads:
+        head.global_cond_cache = {'hits': 0, 'misses': 0}
+    try:
+        yield
+    finally:
+        for head in heads:
+            head.global_cond_cache = None
+
+
 class ConditionalUnet1D(nn.Module):
 
     def __init__(self,
@@ -314,6 +334,8 @@ class ConditionalUnet1D(nn.Module):
 
         self.n_obs_steps = n_obs_steps
         self.obs_encoder = instantiate_from_config(obs_encoder_config)
+        # Set by `cache_global_cond` while sampling
+        self.global_cond_cache = None
 
         all_dims = [input_dim] + list(down_dims)
         start_dim = down_dims[0]
@@ -501,6 +523,25 @@ class ConditionalUnet1D(nn.Module):
         self.last_frame_only = last_frame_only
         self.horizon = horizon
 
+    def encode_obs(self, obs, cond):
+        """
+        obs: the raw (image, agent_pos) observation, used as cache key
+        cond: the same observation prepared for `obs_encoder`
+        """
+        cache = self.global_cond_cache
+        if cache is None:
+            return self.obs_encoder(cond)
+        if 'obs' in cache and all(
+                same_tensor(a, b, v)
+                for a, (b, v) in zip(obs, cache['obs'])):
+            cache['hits'] += 1
+            return cache['global_cond']
+        global_cond = self.obs_encoder(cond)
+        cache['obs'] = [(x, x._version) for x in obs]
+        cache['global_cond'] = global_cond
+        cache['misses'] += 1
+        return global_cond
+
     def forward(self,
                 sample: torch.Tensor,
                 timestep: Union[torch.Tensor, float, int],
@@ -520,6 +561,7 @@ class ConditionalUnet1D(nn.Module):
         if not self.imagen_cond_gradient:
             imagen_cond = [c.detach() for c in imagen_cond]
 
+        obs = cond
         cond = {'image': cond[0], 'agent_pos': cond[1]}
 
         cond['image'] = cond['image'].permute(0, 2, 1, 3,
@@ -530,7 +572,7 @@ class ConditionalUnet1D(nn.Module):
         B, T, D = sample.shape
         if self.use_linear_act_proj:
             sample = self.proj_in_action(sample.unsqueeze(-1))
-            global_cond = self.obs_encoder(cond)
+            global_cond = self.encode_obs(obs, cond)
             global_cond = rearrange(global_cond,
                                     '(b t) d -> b 1 (t d)',
                                     b=B,
@@ -14,7 +14,9 @@ class EMAModel:
                  inv_gamma=1.0,
                  power=2 / 3,
                  min_value=0.0,
-                 max_value=0.9999):
+                 max_value=0.9999,
+                 update_every=1,
+                 device=None):
         """
         @crowsonkb's notes on EMA Warmup:
             If gamma=1 and power=1, implements a simple average. gamma=1, power=2/3 are good values for models you plan
@@ -25,6 +27,12 @@ class EMAModel:
             inv_gamma (float): Inverse multiplicative factor of EMA warmup. Default: 1.
             power (float): Exponential factor of EMA warmup. Default: 2/3.
             min_value (float): The minimum EMA decay rate. Default: 0.
+            update_every (int): Update the averaged weights every N steps only,
+                with the decay raised to the N-th power to keep the same
+                horizon. Default: 1.
+            device (str): Keep the averaged weights on this device, e.g. 'cpu'
+                to free accelerator memory. Default: None, the device of the
+                averaged model.
         """
 
         self.averaged_model = model
@@ -37,8 +45,16 @@ class EMAModel:
         self.min_value = min_value
         self.max_value = max_value
 
+        self.update_every = update_every
+        self.device = None if device is None else torch.device(device)
+        if self.device is not None:
+            self.averaged_model.to(self.device)
+
         self.decay = 0.0
         self.optimization_step = 0
+        # Flat parameter lists, built on the first step
+        self._param_groups = None
+        self._param_groups_key = None
 
     def get_decay(self, optimization_step):
         """
@@ -52,11 +68,18 @@ class EMAModel:
 
         return max(self.min_value, min(value, self.max_value))
 
-    @torch.no_grad()
-    def step(self, new_model):
-        self.decay = self.get_decay(self.optimization_step)
+    def _get_param_groups(self, new_model):
+        """
+        Pair the parameters of `new_model` with the averaged ones: those to
+        average and those copied as is (batchnorms and frozen parameters).
+        The pairing is cached until the model or its frozen set changes.
+        """
+        params = list(new_model.parameters())
+        key = (id(new_model), tuple(p.requires_grad for p in params))
+        if key == self._param_groups_key:
+            return self._param_groups
 
-        all_dataptrs = set()
+        avg_ema, avg_src, copy_ema, copy_src = [], [], [], []
         for module, ema_module in zip(new_model.modules(),
                                       self.averaged_model.modules()):
             for param, ema_param in zip(module.parameters(recurse=False),
@@ -65,16 +88,56 @@ class EMAModel:
                 if isinstance(param, dict):
                     raise RuntimeError('Dict parameter not supported')
 
-                if isinstance(module, _BatchNorm):
+                if isinstance(module, _BatchNorm) or not param.requires_grad:
                     # skip batchnorms
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
-                elif not param.requires_grad:
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
+                    copy_ema.append(ema_param)
+                    copy_src.append(param)
                 else:
-                    ema_param.mul_(self.decay)
-                    ema_param.add_(param.data.to(dtype=ema_param.dtype),
-                                   alpha=1 - self.decay)
+                    avg_ema.append(ema_param)
+                    avg_src.append(param)
+
+        self._param_groups = (avg_ema, avg_src, copy_ema, copy_src)
+        self._param_groups_key = key
+        return self._param_groups
+
+    @staticmethod
+    def _to_like(src, dst):
+        """
+        `src` tensors cast to the dtype and device of `dst`. Tensors moved
+        across devices are packed into one buffer per dtype so that each
+        dtype needs a single transfer.
+        """
+        out = [None] * len(src)
+        moves = {}
+        for i, (s, d) in enumerate(zip(src, dst)):
+            if s.device == d.device:
+                out[i] = s.detach().to(dtype=d.dtype)
+            else:
+                moves.setdefault((d.dtype, d.device), []).append(i)
+        for (dtype, device), idx in moves.items():
+            flat = torch.cat([src[i].detach().reshape(-1).to(dtype)
+                              for i in idx]).to(device)
+            chunks = flat.split([src[i].numel() for i in idx])
+            for i, chunk in zip(idx, chunks):
+                out[i] = chunk.view_as(src[i])
+        return out
+
+    @torch.no_grad()
+    def step(self, new_model):
+        self.decay = self.get_decay(self.optimization_step)
+
+        if self.optimization_step % self.update_every == 0:
+            # The skipped steps are made up for by decaying N times at once
+            decay = self.decay**self.update_every
+            avg_ema, avg_src, copy_ema, copy_src = self._get_param_groups(
+                new_model)
+            if copy_ema:
+                torch._foreach_copy_(copy_ema,
+                                     self._to_like(copy_src, copy_ema))
+            if avg_ema:
+                torch._foreach_mul_(avg_ema, decay)
+                torch._foreach_add_(avg_ema,
+                                    self._to_like(avg_src, avg_ema),
+                                    alpha=1 - decay)
 
-        # verify that iterating over module and then parameters is identical to parameters recursively.
-        # assert old_all_dataptrs == all_dataptrs
         self.optimization_step += 1
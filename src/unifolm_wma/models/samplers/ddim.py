@@ -2,25 +2,34 @@ import numpy as np
 import torch
 import copy
 
+from contextlib import contextmanager, nullcontext
+
 from unifolm_wma.utils.diffusion import make_ddim_sampling_parameters, make_ddim_timesteps, rescale_noise_cfg
 from unifolm_wma.utils.common import noise_like
 from unifolm_wma.utils.common import extract_into_tensor
+from unifolm_wma.models.diffusion_head.conditional_unet1d import cache_global_cond
+from unifolm_wma.modules.networks.wma_model import cache_cross_attention_context
 from tqdm import tqdm
 
 
 class DDIMSampler(object):
 
-    def __init__(self, model, schedule="linear", **kwargs):
+    def __init__(self, model, schedule="linear", fused_cfg=False, **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        # Default of `sample(fused_cfg=...)`
+        self.fused_cfg = fused_cfg
         self.counter = 0
+        self.schedule_key = None
+        # (cond, uncond, stacked) of the fused CFG pass, see `_stacked_for_cfg`
+        self._cfg_stack = None
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
         setattr(self, name, attr)
 
     def make_schedule(self,
@@ -28,6 +37,13 @@ class DDIMSampler(object):
                       ddim_discretize="uniform",
                       ddim_eta=0.,
                       verbose=True):
+        # The schedule only depends on these, so a sampler that is reused
+        # across calls (e.g. by the inference server) builds it once
+        schedule_key = (ddim_num_steps, ddim_discretize, ddim_eta,
+                        self.model.device)
+        if schedule_key == self.schedule_key:
+            return
+
         self.ddim_timesteps = make_ddim_timesteps(
             ddim_discr_method=ddim_discretize,
             num_ddim_timesteps=ddim_num_steps,
@@ -78,6 +94,49 @@ class DDIMSampler(object):
         self.register_buffer('ddim_sigmas_for_original_num_steps',
                              sigmas_for_original_sampling_steps)
 
+        self.ddim_step_coefs = self.make_step_coefs(self.ddim_timesteps,
+                                                    ddim_eta)
+        self.ddim_discretize = ddim_discretize
+        self.ddim_eta = ddim_eta
+        self.schedule_key = schedule_key
+
+    def make_step_coefs(self, ddim_timesteps, ddim_eta):
+        """Per-step scalars used by p_sample_ddim, kept on the model device.
+
+        Args:
+            ddim_timesteps: Ascending DDPM timesteps of the schedule.
+            ddim_eta: Sampling eta.
+
+        Returns:
+            dict of float32 tensors indexed by step, like `self.ddim_alphas`.
+        """
+        ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(
+            alphacums=self.model.alphas_cumprod.cpu(),
+            ddim_timesteps=ddim_timesteps,
+            eta=ddim_eta,
+            verbose=False)
+
+        def to_step(x):
+            return torch.as_tensor(x, dtype=torch.float32).to(
+                self.model.device)
+
+        a_t = to_step(ddim_alphas)
+        a_prev = to_step(ddim_alphas_prev)
+        sigma_t = to_step(ddim_sigmas)
+        step_coefs = {
+            'sqrt_a_t': a_t.sqrt(),
+            'sqrt_a_prev': a_prev.sqrt(),
+            'sigma_t': sigma_t,
+            'sqrt_one_minus_at': to_step(np.sqrt(1. - ddim_alphas)),
+            'dir_xt': (1. - a_prev - sigma_t**2).sqrt(),
+        }
+        if self.model.use_dynamic_rescale:
+            scale_arr = self.model.scale_arr[ddim_timesteps]
+            scale_arr_prev = torch.cat([scale_arr[0:1], scale_arr[:-1]])
+            step_coefs['rescale'] = to_step(scale_arr_prev) / to_step(
+                scale_arr)
+        return step_coefs
+
     @torch.no_grad()
     def sample(
             self,
@@ -106,7 +165,30 @@ class DDIMSampler(object):
             fs=None,
             timestep_spacing='uniform',  #uniform_trailing for starting from last timestep
             guidance_rescale=0.0,
+            fused_cfg=None,
+            action_ddim_steps=None,
+            trunk_refresh_every=1,
+            cache_cross_attn_kv=False,
             **kwargs):
+        """Sample video latents, actions and states.
+
+        By default the video, action and state are denoised jointly over the
+        `S`-step schedule. Setting `action_ddim_steps` and/or
+        `trunk_refresh_every` switches to decoupled action sampling (see
+        `decoupled_action_sampling`), which is meant for action-only
+        inference: the returned video latent then comes from a coarser
+        schedule.
+
+        With `cache_cross_attn_kv` the cross-attention context tokens and
+        every layer's projected keys/values are computed once for the whole
+        call instead of at every step.
+
+        With classifier-free guidance, `fused_cfg` (default: the sampler's
+        `fused_cfg`) runs the conditional and unconditional branches as one
+        model pass over twice the batch, see `p_sample_ddim`.
+        """
+        if fused_cfg is None:
+            fused_cfg = self.fused_cfg
 
         # Check condition bs
         if conditioning is not None:
@@ -140,28 +222,37 @@ class DDIMSampler(object):
             C, T, H, W = shape
             size = (batch_size, C, T, H, W)
 
-        samples, actions, states, intermediates = self.ddim_sampling(
-            conditioning,
-            size,
-            callback=callback,
-            img_callback=img_callback,
-            quantize_denoised=quantize_x0,
-            mask=mask,
-            x0=x0,
-            ddim_use_original_steps=False,
-            noise_dropout=noise_dropout,
-            temperature=temperature,
-            score_corrector=score_corrector,
-            corrector_kwargs=corrector_kwargs,
-            x_T=x_T,
-            log_every_t=log_every_t,
-            unconditional_guidance_scale=unconditional_guidance_scale,
-            unconditional_conditioning=unconditional_conditioning,
-            verbose=verbose,
-            precision=precision,
-            fs=fs,
-            guidance_rescale=guidance_rescale,
-            **kwargs)
+        # The observation is fixed for the whole call, so the action/state
+        # heads only need to run their vision encoders once
+        kv_cache = (cache_cross_attention_context(self.model)
+                    if cache_cross_attn_kv else nullcontext())
+        with cache_global_cond(self.model), kv_cache, \
+                self._cfg_stack_scope():
+            samples, actions, states, intermediates = self.ddim_sampling(
+                conditioning,
+                size,
+                callback=callback,
+                img_callback=img_callback,
+                quantize_denoised=quantize_x0,
+                mask=mask,
+                x0=x0,
+                ddim_use_original_steps=False,
+                noise_dropout=noise_dropout,
+                temperature=temperature,
+                score_corrector=score_corrector,
+                corrector_kwargs=corrector_kwargs,
+                x_T=x_T,
+                log_every_t=log_every_t,
+                unconditional_guidance_scale=unconditional_guidance_scale,
+                unconditional_conditioning=unconditional_conditioning,
+                verbose=verbose,
+                precision=precision,
+                fs=fs,
+                guidance_rescale=guidance_rescale,
+                fused_cfg=fused_cfg,
+                action_ddim_steps=action_ddim_steps,
+                trunk_refresh_every=trunk_refresh_every,
+                **kwargs)
         return samples, actions, states, intermediates
 
     @torch.no_grad()
@@ -187,6 +278,9 @@ class DDIMSampler(object):
                       precision=None,
                       fs=None,
                       guidance_rescale=0.0,
+                      fused_cfg=False,
+                      action_ddim_steps=None,
+                      trunk_refresh_every=1,
                       **kwargs):
         device = self.model.betas.device
         dp_ddim_scheduler_action = self.model.dp_noise_scheduler_action
@@ -239,8 +333,31 @@ class DDIMSampler(object):
 
         clean_cond = kwargs.pop("clean_cond", False)
 
-        dp_ddim_scheduler_action.set_timesteps(len(timesteps))
-        dp_ddim_scheduler_state.set_timesteps(len(timesteps))
+        if action_ddim_steps is not None or trunk_refresh_every > 1:
+            assert not ddim_use_original_steps
+            assert unconditional_conditioning is None or unconditional_guidance_scale == 1., \
+                'Decoupled action sampling does not support classifier-free guidance'
+            return self.decoupled_action_sampling(
+                cond,
+                img,
+                action,
+                state,
+                action_ddim_steps=action_ddim_steps or len(timesteps),
+                trunk_refresh_every=trunk_refresh_every,
+                mask=mask,
+                x0=x0,
+                clean_cond=clean_cond,
+                temperature=temperature,
+                noise_dropout=noise_dropout,
+                log_every_t=log_every_t,
+                verbose=verbose,
+                fs=fs,
+                **kwargs)
+
+        for dp_ddim_scheduler in (dp_ddim_scheduler_action,
+                                  dp_ddim_scheduler_state):
+            if dp_ddim_scheduler.num_inference_steps != len(timesteps):
+                dp_ddim_scheduler.set_timesteps(len(timesteps))
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
             ts = torch.full((b, ), step, device=device, dtype=torch.long)
@@ -273,6 +390,7 @@ class DDIMSampler(object):
                 x0=x0,
                 fs=fs,
                 guidance_rescale=guidance_rescale,
+                fused_cfg=fused_cfg,
                 **kwargs)
 
             img, pred_x0, model_output_action, model_output_state = outs
@@ -301,6 +419,179 @@ class DDIMSampler(object):
 
         return img, action, state, intermediates
 
+    @torch.no_grad()
+    def decoupled_action_sampling(self,
+                                  cond,
+                                  img,
+                                  action,
+                                  state,
+                                  action_ddim_steps,
+                                  trunk_refresh_every=1,
+                                  mask=None,
+                                  x0=None,
+                                  clean_cond=False,
+                                  temperature=1.,
+                                  noise_dropout=0.,
+                                  log_every_t=100,
+                                  verbose=True,
+                                  fs=None,
+                                  **kwargs):
+        """Denoise actions/states on their own schedule, reusing trunk features.
+
+        The action and state heads take `action_ddim_steps` steps (same
+        discretization and eta as the current schedule). The video UNet trunk,
+        which dominates the cost of a step, is only run at every
+        `trunk_refresh_every`-th action timestep; the heads reuse its
+        features (`hs_a`) for the action steps in between, and the video
+        latent jumps directly between the trunk timesteps. The number of trunk
+        passes is therefore ceil(action_ddim_steps / trunk_refresh_every).
+        With `action_ddim_steps == S` and `trunk_refresh_every == 1` this is
+        the same computation as the joint loop in `ddim_sampling`.
+        """
+        b = img.shape[0]
+        device = self.model.betas.device
+        diffusion_model = self.model.model.diffusion_model
+        dp_ddim_scheduler_action = self.model.dp_noise_scheduler_action
+        dp_ddim_scheduler_state = self.model.dp_noise_scheduler_state
+
+        action_timesteps = make_ddim_timesteps(
+            ddim_discr_method=self.ddim_discretize,
+            num_ddim_timesteps=action_ddim_steps,
+            num_ddpm_timesteps=self.ddpm_num_timesteps,
+            verbose=False)
+        action_range = np.flip(action_timesteps)
+        trunk_timesteps = np.ascontiguousarray(
+            np.flip(action_range[::trunk_refresh_every]))
+        trunk_coefs = self.make_step_coefs(trunk_timesteps, self.ddim_eta)
+        num_trunk_steps = trunk_timesteps.shape[0]
+
+        for dp_ddim_scheduler in (dp_ddim_scheduler_action,
+                                  dp_ddim_scheduler_state):
+            if dp_ddim_scheduler.num_inference_steps != len(action_timesteps):
+                dp_ddim_scheduler.set_timesteps(len(action_timesteps))
+
+        intermediates = {
+            'x_inter': [img],
+            'pred_x0': [img],
+            'x_inter_action': [action],
+            'pred_x0_action': [action],
+            'x_inter_state': [state],
+            'pred_x0_state': [state],
+        }
+        if verbose:
+            iterator = tqdm(action_range,
+                            desc='DDIM Sampler (decoupled action)',
+                            total=len(action_range))
+        else:
+            iterator = action_range
+
+        hs_a = None
+        for i, step in enumerate(iterator):
+            ts = torch.full((b, ), step, device=device, dtype=torch.long)
+
+            if i % trunk_refresh_every == 0:
+                index = num_trunk_steps - i // trunk_refresh_every - 1
+                if mask is not None:
+                    assert x0 is not None
+                    img_orig = x0 if clean_cond else self.model.q_sample(
+                        x0, ts)
+                    img = img_orig * mask + (1. - mask) * img
+
+                img, pred_x0, model_output_action, model_output_state, hs_a = self.p_sample_ddim(
+                    img,
+                    action,
+                    state,
+                    cond,
+                    ts,
+                    index=index,
+                    temperature=temperature,
+                    noise_dropout=noise_dropout,
+                    step_coefs=trunk_coefs,
+                    fs=fs,
+                    return_action_features=True,
+                    **kwargs)
+                if index % log_every_t == 0 or index == num_trunk_steps - 1:
+                    intermediates['x_inter'].append(img)
+                    intermediates['pred_x0'].append(pred_x0)
+            else:
+                model_output_action, model_output_state = diffusion_model.forward_heads(
+                    action, state, ts, hs_a, cond['c_crossattn_action'],
+                    **kwargs)
+
+            action = dp_ddim_scheduler_action.step(
+                model_output_action,
+                step,
+                action,
+                generator=None,
+            ).prev_sample
+            state = dp_ddim_scheduler_state.step(
+                model_output_state,
+                step,
+                state,
+                generator=None,
+            ).prev_sample
+
+        intermediates['x_inter_action'].append(action)
+        intermediates['x_inter_state'].append(state)
+        return img, action, state, intermediates
+
+    @contextmanager
+    def _cfg_stack_scope(self):
+        """Keep the stacked CFG conditioning for one `sample` call only."""
+        try:
+            yield
+        finally:
+            self._cfg_stack = None
+
+    def _stacked_for_cfg(self, c, uc):
+        """`_cat_for_cfg`, computed once per conditioning pair.
+
+        Every step then hands the model the very same stacked context, so the
+        cross-attention context and K/V caches hit by identity instead of
+        comparing a freshly concatenated tensor by value.
+        """
+        if (self._cfg_stack is not None and self._cfg_stack[0] is c
+                and self._cfg_stack[1] is uc):
+            return self._cfg_stack[2]
+        stacked = self._cat_for_cfg(c, uc)
+        self._cfg_stack = (c, uc, stacked)
+        return stacked
+
+    @staticmethod
+    def _cat_for_cfg(c, uc):
+        """Stack conditional and unconditional inputs along the batch dim.
+
+        Tensors are concatenated, dicts/lists are handled per entry and other
+        values (flags, None) must be equal in both. Returns None when `c` and
+        `uc` do not have the same structure, so the caller falls back to two
+        separate model passes.
+        """
+        if isinstance(c, torch.Tensor):
+            if not isinstance(uc, torch.Tensor) or c.shape != uc.shape:
+                return None
+            return torch.cat([c, uc])
+        if isinstance(c, dict):
+            if not isinstance(uc, dict) or c.keys() != uc.keys():
+                return None
+            out = {}
+            for k in c:
+                out[k] = DDIMSampler._cat_for_cfg(c[k], uc[k])
+                if out[k] is None and c[k] is not None:
+                    return None
+            return out
+        if isinstance(c, (list, tuple)):
+            if not isinstance(uc, (list, tuple)) or len(c) != len(uc):
+                return None
+            out = []
+            for c_i, uc_i in zip(c, uc):
+                out.append(DDIMSampler._cat_for_cfg(c_i, uc_i))
+                if out[-1] is None and c_i is not None:
+                    return None
+            return out
+        if c is uc or (not isinstance(uc, torch.Tensor) and c == uc):
+            return c
+        return None
+
     @torch.no_grad()
     def p_sample_ddim(self,
                       x,
@@ -323,6 +614,8 @@ class DDIMSampler(object):
                       mask=None,
                       x0=None,
                       guidance_rescale=0.0,
+                      fused_cfg=False,
+                      step_coefs=None,
                       **kwargs):
         b, *_, device = *x.shape, x.device
         if x.dim() == 5:
@@ -330,17 +623,40 @@ class DDIMSampler(object):
         else:
             is_video = False
 
+        # With return_action_features=True in kwargs the model also returns
+        # the trunk features of the action/state heads, passed through below
+        action_features = []
         if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
-            model_output, model_output_action, model_output_state = self.model.apply_model(
+            model_output, model_output_action, model_output_state, *action_features = self.model.apply_model(
                 x, x_action, x_state, t, c, **kwargs)  # unet denoiser
         else:
             # do_classifier_free_guidance
             if isinstance(c, torch.Tensor) or isinstance(c, dict):
-                e_t_cond, e_t_cond_action, e_t_cond_state = self.model.apply_model(
-                    x, x_action, x_state, t, c, **kwargs)
-                e_t_uncond, e_t_uncond_action, e_t_uncond_state = self.model.apply_model(
-                    x, x_action, x_state, t, unconditional_conditioning,
-                    **kwargs)
+                c_in = self._stacked_for_cfg(
+                    c, unconditional_conditioning) if fused_cfg else None
+                if c_in is not None:
+                    # One pass over [cond; uncond] stacked along the batch
+
+                    def double(v):
+                        if isinstance(v, torch.Tensor) and v.shape[:1] == (b, ):
+                            return torch.cat([v, v])
+                        return v
+
+                    outs = self.model.apply_model(
+                        double(x), double(x_action), double(x_state),
+                        double(t), c_in,
+                        **{k: double(v)
+                           for k, v in kwargs.items()})
+                    (e_t_cond, e_t_uncond), (e_t_cond_action, e_t_uncond_action), \
+                        (e_t_cond_state, e_t_uncond_state) = [
+                            out.chunk(2) for out in outs
+                        ]
+                else:
+                    e_t_cond, e_t_cond_action, e_t_cond_state = self.model.apply_model(
+                        x, x_action, x_state, t, c, **kwargs)
+                    e_t_uncond, e_t_uncond_action, e_t_uncond_state = self.model.apply_model(
+                        x, x_action, x_state, t, unconditional_conditioning,
+                        **kwargs)
             else:
                 raise NotImplementedError
             model_output = e_t_uncond + unconditional_guidance_scale * (
@@ -372,51 +688,73 @@ class DDIMSampler(object):
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c,
                                                **corrector_kwargs)
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
-
         if is_video:
             size = (b, 1, 1, 1, 1)
         else:
             size = (b, 1, 1, 1)
 
-        a_t = torch.full(size, alphas[index], device=device)
-        a_prev = torch.full(size, alphas_prev[index], device=device)
-        sigma_t = torch.full(size, sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full(size,
-                                       sqrt_one_minus_alphas[index],
-                                       device=device)
+        if use_original_steps:
+            alphas = self.model.alphas_cumprod
+            alphas_prev = self.model.alphas_cumprod_prev
+            sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod
+            sigmas = self.ddim_sigmas_for_original_num_steps
+
+            a_t = torch.full(size, alphas[index], device=device)
+            a_prev = torch.full(size, alphas_prev[index], device=device)
+            sigma_t = torch.full(size, sigmas[index], device=device)
+            sqrt_one_minus_at = torch.full(size,
+                                           sqrt_one_minus_alphas[index],
+                                           device=device)
+            sqrt_a_t = a_t.sqrt()
+            sqrt_a_prev = a_prev.sqrt()
+            dir_xt_coef = (1. - a_prev - sigma_t**2).sqrt()
+        else:
+            # Precomputed in make_step_coefs; viewed as (1, 1, ...) so they
+            # broadcast and promote like the (b, 1, ...) tensors above
+            if step_coefs is None:
+                step_coefs = self.ddim_step_coefs
+
+            def step_coef(name):
+                return step_coefs[name][index].view([1] * len(size))
+
+            sigma_t = step_coef('sigma_t')
+            sqrt_one_minus_at = step_coef('sqrt_one_minus_at')
+            sqrt_a_t = step_coef('sqrt_a_t')
+            sqrt_a_prev = step_coef('sqrt_a_prev')
+            dir_xt_coef = step_coef('dir_xt')
 
         if self.model.parameterization != "v":
-            pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+            pred_x0 = (x - sqrt_one_minus_at * e_t) / sqrt_a_t
         else:
             pred_x0 = self.model.predict_start_from_z_and_v(x, t, model_output)
 
         if self.model.use_dynamic_rescale:
-            scale_t = torch.full(size,
-                                 self.ddim_scale_arr[index],
-                                 device=device)
-            prev_scale_t = torch.full(size,
-                                      self.ddim_scale_arr_prev[index],
-                                      device=device)
-            rescale = (prev_scale_t / scale_t)
+            if use_original_steps:
+                scale_t = torch.full(size,
+                                     self.ddim_scale_arr[index],
+                                     device=device)
+                prev_scale_t = torch.full(size,
+                                          self.ddim_scale_arr_prev[index],
+                                          device=device)
+                rescale = (prev_scale_t / scale_t)
+            else:
+                rescale = step_coef('rescale')
             pred_x0 *= rescale
 
         if quantize_denoised:
             pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
 
-        dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
+        dir_xt = dir_xt_coef * e_t
 
         noise = sigma_t * noise_like(x.shape, device,
                                      repeat_noise) * temperature
         if noise_dropout > 0.:
             noise = torch.nn.functional.dropout(noise, p=noise_dropout)
 
-        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+        x_prev = sqrt_a_prev * pred_x0 + dir_xt + noise
 
-        return x_prev, pred_x0, model_output_action, model_output_state
+        return (x_prev, pred_x0, model_output_action, model_output_state,
+                *action_features)
 
     @torch.no_grad()
     def decode(self,
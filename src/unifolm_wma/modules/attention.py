@@ -1,6 +1,8 @@
+import os
 import torch
 import torch.nn.functional as F
 
+from contextlib import contextmanager
 from torch import nn, einsum
 from einops import rearrange, repeat
 from functools import partial
@@ -19,6 +21,89 @@ from unifolm_wma.utils.common import (
 )
 from unifolm_wma.utils.basics import zero_module
 
+ATTENTION_BACKENDS = ('auto', 'xformers', 'sdpa', 'math')
+# Largest batch (times heads) some attention kernels launch in one grid
+MAX_KERNEL_BATCH = 65535
+_attention_backend = os.environ.get('UNIFOLM_ATTENTION_BACKEND', 'auto')
+
+
+def set_attention_backend(backend):
+    """Select the kernel used by `attention`: one of `ATTENTION_BACKENDS`.
+
+    'auto' (the default, or the `UNIFOLM_ATTENTION_BACKEND` environment
+    variable) uses xformers for CUDA tensors when it is installed and
+    `F.scaled_dot_product_attention` otherwise.
+    """
+    global _attention_backend
+    assert backend in ATTENTION_BACKENDS, backend
+    assert backend != 'xformers' or XFORMERS_IS_AVAILBLE, \
+        ">>> ERROR: xformers is not installed ..."
+    _attention_backend = backend
+
+
+def get_attention_backend():
+    return _attention_backend
+
+
+@contextmanager
+def attention_backend(backend):
+    """Use `backend` for the attention calls inside the block."""
+    previous = get_attention_backend()
+    set_attention_backend(backend)
+    try:
+        yield
+    finally:
+        set_attention_backend(previous)
+
+
+def attention(q, k, v, bias=None, backend=None):
+    """Softmax attention scaled by d**-0.5.
+
+    Takes (b*h, n, d) tensors, or (b, n, h, d) ones so the heads can stay in
+    the layout of the projections without a permute/contiguous copy; the
+    output has the layout of q.
+
+    Args:
+        q: queries (b*h, n_q, d) or (b, n_q, h, d).
+        k, v: keys and values (b*h, n_k, d) or (b, n_k, h, d).
+        bias: optional additive bias, e.g. -inf to mask, broadcastable to
+            (b*h, n_q, n_k), or to (b, h, n_q, n_k) for 4-D inputs.
+        backend: overrides the backend set by `set_attention_backend`.
+    """
+    backend = default(backend, _attention_backend)
+    if backend == 'auto':
+        if XFORMERS_IS_AVAILBLE and q.is_cuda:
+            backend = 'xformers'
+        else:
+            backend = 'sdpa'
+
+    if backend == 'xformers':
+        if bias is not None:
+            if q.dim() == 4:
+                shape = (q.shape[0], q.shape[2], q.shape[1], k.shape[1])
+            else:
+                shape = (q.shape[0], q.shape[1], k.shape[1])
+            # The kernel wants a materialized bias, not a stride-0
+            # broadcast, with rows aligned to 8 elements: pad, then slice
+            bias = F.pad(bias.expand(shape), (0, -k.shape[1] % 8))
+            bias = bias[..., :k.shape[1]]
+        return xformers.ops.memory_efficient_attention(q,
+                                                       k,
+                                                       v,
+                                                       attn_bias=bias,
+                                                       op=None)
+    if q.dim() == 4:
+        # (b, n, h, d) -> (b, h, n, d) views
+        q, k, v = (t.transpose(1, 2) for t in (q, k, v))
+    if backend == 'sdpa':
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=bias)
+    else:
+        sim = q @ k.transpose(-1, -2) * q.shape[-1]**-0.5
+        if bias is not None:
+            sim = sim + bias
+        out = sim.softmax(dim=-1) @ v
+    return out.transpose(1, 2) if out.dim() == 4 else out
+
 
 class RelativePosition(nn.Module):
     """ https://github.com/evelinehong/Transformer_Relative_Position_PyTorch/blob/master/relative_position.py """
@@ -87,7 +172,7 @@ class CrossAttention(nn.Module):
                 num_units=dim_head, max_relative_position=temporal_length)
         else:
             ## only used for spatial attention, while NOT for temporal attention
-            if XFORMERS_IS_AVAILBLE and temporal_length is None:
+            if temporal_length is None:
                 self.forward = self.efficient_forward
 
         self.video_length = video_length
@@ -113,55 +198,39 @@ class CrossAttention(nn.Module):
                                         nn.Parameter(torch.tensor(0.)))
                 self.register_parameter('alpha_caa',
                                         nn.Parameter(torch.tensor(0.)))
+        # Set by `cache_cross_attention_context` while sampling
+        self.kv_cache = None
 
     def forward(self, x, context=None, mask=None):
         spatial_self_attn = (context is None)
-        k_ip, v_ip, out_ip = None, None, None
-        k_as, v_as, out_as = None, None, None
-        k_aa, v_aa, out_aa = None, None, None
+        if self.image_cross_attention and not spatial_self_attn:
+            # The multi-stream split with the action block mask lives in one place
+            return self.efficient_forward(x, context, mask)
 
         h = self.heads
         q = self.to_q(x)
         context = default(context, x)
 
-        if self.image_cross_attention and not spatial_self_attn:
-            assert 1 > 2, ">>> ERROR: should setup xformers and use efficient_forward ..."
-            context_agent_state = context[:, :self.agent_state_context_len, :]
-            context_agent_action = context[:,
-                                           self.agent_state_context_len:self.
-                                           agent_state_context_len +
-                                           self.agent_action_context_len, :]
-            context_ins = context[:, self.agent_state_context_len +
-                                  self.agent_action_context_len:self.
-                                  agent_state_context_len +
-                                  self.agent_action_context_len +
-                                  self.text_context_len, :]
-            context_image = context[:, self.agent_state_context_len +
-                                    self.agent_action_context_len +
-                                    self.text_context_len:, :]
-
-            k = self.to_k(context_ins)
-            v = self.to_v(context_ins)
-            k_ip = self.to_k_ip(context_image)
-            v_ip = self.to_v_ip(context_image)
-            k_as = self.to_k_as(context_agent_state)
-            v_as = self.to_v_as(context_agent_state)
-            k_aa = self.to_k_aa(context_agent_action)
-            v_aa = self.to_v_aa(context_agent_action)
-        else:
-            if not spatial_self_attn:
-                context = context[:, :self.text_context_len, :]
-            k = self.to_k(context)
-            v = self.to_v(context)
-
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h),
-                      (q, k, v))
-
-        sim = torch.einsum('b i d, b j d -> b i j', q, k) * self.scale
+        if not spatial_self_attn:
+            context = context[:, :self.text_context_len, :]
+        k = self.to_k(context)
+        v = self.to_v(context)
+
+        # Consecutive rows of x may share one context row (x has g * r rows
+        # for a context of g rows): k and v are broadcast over each group
+        g = k.shape[0]
+        q = rearrange(q, '(g r) n (h d) -> g r h n d', g=g, h=h)
+        k, v = map(lambda t: rearrange(t, 'g n (h d) -> g h n d', h=h),
+                   (k, v))
+
+        sim = torch.einsum('g r h i d, g h j d -> g r h i j', q,
+                           k) * self.scale
+        sim = rearrange(sim, 'g r h i j -> (g r h) i j')
         if self.relative_position:
-            len_q, len_k, len_v = q.shape[1], k.shape[1], v.shape[1]
+            len_q, len_k, len_v = q.shape[-2], k.shape[-2], v.shape[-2]
             k2 = self.relative_position_k(len_q, len_k)
-            sim2 = einsum('b t d, t s d -> b t s', q,
+            sim2 = einsum('b t d, t s d -> b t s',
+                          rearrange(q, 'g r h n d -> (g r h) n d'),
                           k2) * self.scale  # TODO check
             sim += sim2
         del k
@@ -175,226 +244,151 @@ class CrossAttention(nn.Module):
         # attention, what we cannot get enough of
         sim = sim.softmax(dim=-1)
 
-        out = torch.einsum('b i j, b j d -> b i d', sim, v)
+        out = torch.einsum('g r h i j, g h j d -> g r h i d',
+                           rearrange(sim, '(g r h) i j -> g r h i j', g=g,
+                                     h=h), v)
         if self.relative_position:
             v2 = self.relative_position_v(len_q, len_v)
             out2 = einsum('b t s, t s d -> b t d', sim, v2)  # TODO check
-            out += out2
-        out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
-
-        if k_ip is not None and k_as is not None and k_aa is not None:
-            ## for image cross-attention
-            k_ip, v_ip = map(
-                lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h),
-                (k_ip, v_ip))
-            sim_ip = torch.einsum('b i d, b j d -> b i j', q,
-                                  k_ip) * self.scale
-            del k_ip
-            sim_ip = sim_ip.softmax(dim=-1)
-            out_ip = torch.einsum('b i j, b j d -> b i d', sim_ip, v_ip)
-            out_ip = rearrange(out_ip, '(b h) n d -> b n (h d)', h=h)
-
-            ## for agent state cross-attention
-            k_as, v_as = map(
-                lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h),
-                (k_as, v_as))
-            sim_as = torch.einsum('b i d, b j d -> b i j', q,
-                                  k_as) * self.scale
-            del k_as
-            sim_as = sim_as.softmax(dim=-1)
-            out_as = torch.einsum('b i j, b j d -> b i d', sim_as, v_as)
-            out_as = rearrange(out_as, '(b h) n d -> b n (h d)', h=h)
-
-            ## for agent action cross-attention
-            k_aa, v_aa = map(
-                lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h),
-                (k_aa, v_aa))
-            sim_aa = torch.einsum('b i d, b j d -> b i j', q,
-                                  k_aa) * self.scale
-            del k_aa
-            sim_aa = sim_aa.softmax(dim=-1)
-            out_aa = torch.einsum('b i j, b j d -> b i d', sim_aa, v_aa)
-            out_aa = rearrange(out_aa, '(b h) n d -> b n (h d)', h=h)
-
-        if out_ip is not None and out_as is not None and out_aa is not None:
-            if self.cross_attention_scale_learnable:
-                out = out + \
-                    self.image_cross_attention_scale * out_ip * (torch.tanh(self.alpha_ctx) + 1) + \
-                    self.agent_state_cross_attention_scale * out_as * (torch.tanh(self.alpha_cas) + 1) + \
-                    self.agent_action_cross_attention_scale * out_aa * (torch.tanh(self.alpha_caa) + 1)
-            else:
-                out = out + \
-                    self.image_cross_attention_scale * out_ip + \
-                    self.agent_state_cross_attention_scale * out_as + \
-                    self.agent_action_cross_attention_scale * out_aa
+            out += rearrange(out2, '(g r h) n d -> g r h n d', g=g, h=h)
+        out = rearrange(out, 'g r h n d -> (g r) n (h d)')
 
         return self.to_out(out)
 
     def efficient_forward(self, x, context=None, mask=None):
+        """Attention over every context stream with a shared, copy-free q.
+
+        With image cross-attention the context holds up to four streams
+        (text, image, agent state and agent action), each with its own K/V
+        projection and softmax, summed with per-stream scales. The stream
+        scale is applied to V, and q, k and v stay in the (b, n, h, d) layout
+        of the projections, so the per-stream head permutes and contiguous
+        copies are gone and the outputs are simply added.
+        """
         spatial_self_attn = (context is None)
-        k, v, out = None, None, None
-        k_ip, v_ip, out_ip = None, None, None
-        k_as, v_as, out_as = None, None, None
-        k_aa, v_aa, out_aa = None, None, None
+        if exists(mask):
+            raise NotImplementedError
 
         q = self.to_q(x)
         context = default(context, x)
 
         if self.image_cross_attention and not spatial_self_attn:
-            if context.shape[1] == self.text_context_len + self.video_length:
-                context_ins, context_image = context[:, :self.text_context_len, :], context[:,self.text_context_len:, :]
-                k = self.to_k(context)
-                v = self.to_v(context)
-                k_ip = self.to_k_ip(context_image)
-                v_ip = self.to_v_ip(context_image)
-            elif context.shape[1] == self.agent_state_context_len + self.text_context_len + self.video_length:
-                context_agent_state = context[:, :self.agent_state_context_len, :]
-                context_ins = context[:, self.agent_state_context_len:self.agent_state_context_len+self.text_context_len, :]
-                context_image = context[:, self.agent_state_context_len+self.text_context_len:, :]
-                k = self.to_k(context_ins)
-                v = self.to_v(context_ins)
-                k_ip = self.to_k_ip(context_image)
-                v_ip = self.to_v_ip(context_image)
-                k_as = self.to_k_as(context_agent_state)
-                v_as = self.to_v_as(context_agent_state)
-            else:
-                context_agent_state = context[:, :self.agent_state_context_len, :]
-                context_agent_action = context[:, self.agent_state_context_len:self.agent_state_context_len+self.agent_action_context_len, :]
-                context_ins = context[:, self.agent_state_context_len+self.agent_action_context_len:self.agent_state_context_len+self.agent_action_context_len+self.text_context_len, :]
-                context_image = context[:, self.agent_state_context_len+self.agent_action_context_len+self.text_context_len:, :]
-
-                k = self.to_k(context_ins)
-                v = self.to_v(context_ins)
-                k_ip = self.to_k_ip(context_image)
-                v_ip = self.to_v_ip(context_image)
-                k_as = self.to_k_as(context_agent_state)
-                v_as = self.to_v_as(context_agent_state)
-                k_aa = self.to_k_aa(context_agent_action)
-                v_aa = self.to_v_aa(context_agent_action)
-
-                attn_mask_aa = self._get_attn_mask_aa(x.shape[0],
-                                                      q.shape[1],
-                                                      k_aa.shape[1],
-                                                      block_size=16).to(k_aa.device)
+            streams_kv = self._get_cached_kv(context, q.shape[:2])
+            if streams_kv is None:
+                streams_kv = self._project_streams(
+                    self._context_streams(context))
+                if self.kv_cache is not None:
+                    self.kv_cache.append({
+                        'context': context,
+                        'version': context._version,
+                        'q_shape': q.shape[:2],
+                        'kv': streams_kv
+                    })
+                    if len(self.kv_cache) > 2:
+                        self.kv_cache.pop(0)
         else:
             if not spatial_self_attn:
-                assert 1 > 2, ">>> ERROR: you should never go into here ..."
                 context = context[:, :self.text_context_len, :]
-            k = self.to_k(context)
-            v = self.to_v(context)
-
-        b, _, _ = q.shape
-        q = q.unsqueeze(3).reshape(b, q.shape[1], self.heads, self.dim_head).permute(0, 2, 1, 3).reshape(b * self.heads, q.shape[1], self.dim_head).contiguous()
-        if k is not None:
-            k, v = map(
-                lambda t: t.unsqueeze(3).reshape(b, t.shape[
-                    1], self.heads, self.dim_head).permute(0, 2, 1, 3).reshape(
-                        b * self.heads, t.shape[1], self.dim_head).contiguous(),
-                (k, v),
-            )
-            out = xformers.ops.memory_efficient_attention(q,
-                                                          k,
-                                                          v,
-                                                          attn_bias=None,
-                                                          op=None)
-            out = (out.unsqueeze(0).reshape(
-                b, self.heads, out.shape[1],
-                self.dim_head).permute(0, 2, 1,
-                                       3).reshape(b, out.shape[1],
-                                                  self.heads * self.dim_head))
-
-        if k_ip is not None:
-            # For image cross-attention
-            k_ip, v_ip = map(
-                lambda t: t.unsqueeze(3).reshape(b, t.shape[
-                    1], self.heads, self.dim_head).permute(0, 2, 1, 3).reshape(
-                        b * self.heads, t.shape[1], self.dim_head).contiguous(
-                        ),
-                (k_ip, v_ip),
-            )
-            out_ip = xformers.ops.memory_efficient_attention(q,
-                                                             k_ip,
-                                                             v_ip,
-                                                             attn_bias=None,
-                                                             op=None)
-            out_ip = (out_ip.unsqueeze(0).reshape(
-                b, self.heads, out_ip.shape[1],
-                self.dim_head).permute(0, 2, 1,
-                                       3).reshape(b, out_ip.shape[1],
-                                                  self.heads * self.dim_head))
-
-        if k_as is not None:
-            # For agent state cross-attention
-            k_as, v_as = map(
-                lambda t: t.unsqueeze(3).reshape(b, t.shape[
-                    1], self.heads, self.dim_head).permute(0, 2, 1, 3).reshape(
-                        b * self.heads, t.shape[1], self.dim_head).contiguous(
-                        ),
-                (k_as, v_as),
-            )
-            out_as = xformers.ops.memory_efficient_attention(q,
-                                                             k_as,
-                                                             v_as,
-                                                             attn_bias=None,
-                                                             op=None)
-            out_as = (out_as.unsqueeze(0).reshape(
-                b, self.heads, out_as.shape[1],
-                self.dim_head).permute(0, 2, 1,
-                                       3).reshape(b, out_as.shape[1],
-                                                  self.heads * self.dim_head))
-        if k_aa is not None:
-            # For agent action cross-attention
-            k_aa, v_aa = map(
-                lambda t: t.unsqueeze(3).reshape(b, t.shape[
-                    1], self.heads, self.dim_head).permute(0, 2, 1, 3).reshape(
-                        b * self.heads, t.shape[1], self.dim_head).contiguous(
-                        ),
-                (k_aa, v_aa),
-            )
-
-            attn_mask_aa = attn_mask_aa.unsqueeze(1).repeat(1,self.heads,1,1).reshape(
-                    b * self.heads, attn_mask_aa.shape[1], attn_mask_aa.shape[2])
-            attn_mask_aa = attn_mask_aa.to(q.dtype)
-
-            out_aa = xformers.ops.memory_efficient_attention(
-                q, k_aa, v_aa, attn_bias=attn_mask_aa, op=None)
-
-            out_aa = (out_aa.unsqueeze(0).reshape(
-                b, self.heads, out_aa.shape[1],
-                self.dim_head).permute(0, 2, 1,
-                                       3).reshape(b, out_aa.shape[1],
-                                                  self.heads * self.dim_head))
-        if exists(mask):
-            raise NotImplementedError
-
-        out = 0.0 if out is None else out
-        out_ip = 0.0 if out_ip is None else out_ip
-        out_as = 0.0 if out_as is None else out_as
-        out_aa = 0.0 if out_aa is None else out_aa
-
+            streams_kv = self._project_streams(
+                [(context, self.to_k, self.to_v, 1.0)])
+
+        # When consecutive rows of x share a context row, their queries are
+        # folded into one sequence against that row's keys and values
+        b, n, _ = q.shape
+        q = q.view(streams_kv[0][0].shape[0], -1, self.heads, self.dim_head)
+        out = None
+        for k, v, bias in streams_kv:
+            if bias is not None:
+                bias = bias.to(q.dtype)
+            out_stream = attention(q, k, v, bias=bias)
+            out = out_stream if out is None else out + out_stream
+        return self.to_out(out.reshape(b, n, self.heads * self.dim_head))
+
+    def _context_streams(self, context):
+        """Split the context into (context, to_k, to_v, scale) streams.
+
+        The layouts are [text, image], [state, text, image] and
+        [state, action, text, image]; only the last one has the agent action
+        stream, which `_project_streams` expects last.
+        """
+        s = self.agent_state_context_len
+        a = self.agent_action_context_len
+        t = self.text_context_len
+        image_scale = self.image_cross_attention_scale
+        state_scale = self.agent_state_cross_attention_scale
+        action_scale = self.agent_action_cross_attention_scale
         if self.cross_attention_scale_learnable:
-            out = out + \
-                self.image_cross_attention_scale * out_ip * (torch.tanh(self.alpha_ctx) + 1) + \
-                self.agent_state_cross_attention_scale * out_as * (torch.tanh(self.alpha_cas) + 1) + \
-                self.agent_action_cross_attention_scale * out_aa * (torch.tanh(self.alpha_caa) + 1)
-
-        else:
-            out = out + \
-                self.image_cross_attention_scale * out_ip + \
-                self.agent_state_cross_attention_scale * out_as + \
-                self.agent_action_cross_attention_scale * out_aa
-
-        return self.to_out(out)
-
-    def _get_attn_mask_aa(self, b, l1, l2, block_size=16):
+            image_scale = image_scale * (torch.tanh(self.alpha_ctx) + 1)
+            state_scale = state_scale * (torch.tanh(self.alpha_cas) + 1)
+            action_scale = action_scale * (torch.tanh(self.alpha_caa) + 1)
+
+        if context.shape[1] == t + self.video_length:
+            return [(context, self.to_k, self.to_v, 1.0),
+                    (context[:, t:], self.to_k_ip, self.to_v_ip, image_scale)]
+        if context.shape[1] == s + t + self.video_length:
+            return [(context[:, s:s + t], self.to_k, self.to_v, 1.0),
+                    (context[:, s + t:], self.to_k_ip, self.to_v_ip,
+                     image_scale),
+                    (context[:, :s], self.to_k_as, self.to_v_as, state_scale)]
+        return [(context[:, s + a:s + a + t], self.to_k, self.to_v, 1.0),
+                (context[:, s + a + t:], self.to_k_ip, self.to_v_ip,
+                 image_scale),
+                (context[:, :s], self.to_k_as, self.to_v_as, state_scale),
+                (context[:, s:s + a], self.to_k_aa, self.to_v_aa, action_scale)]
+
+    def _project_streams(self, streams):
+        """Project each stream's keys and values.
+
+        Args:
+            streams: (context, to_k, to_v, scale) per stream, see
+                `_context_streams`.
+
+        Returns:
+            (k, v, bias) per stream: k and v are (b, len, heads, dim_head)
+            views, v already multiplied by the stream scale; bias is the
+            agent action block mask, broadcastable to (b, heads, n, len), for
+            the fourth stream and None otherwise.
+        """
+        streams_kv = []
+        for i, (ctx, to_k, to_v, scale) in enumerate(streams):
+            # Two matmuls rather than one against the stacked weights, which
+            # would be a fresh copy of them per stream and call; the scale
+            # goes on v, which is only as long as the stream
+            k = to_k(ctx).unflatten(-1, (self.heads, self.dim_head))
+            v = to_v(ctx).unflatten(-1, (self.heads, self.dim_head))
+            if torch.is_tensor(scale) or scale != 1:
+                v = v * scale
+            bias = None
+            if i == 3:
+                bias = self._get_attn_bias_aa(ctx.shape[0], ctx.shape[1],
+                                              k.device)
+            streams_kv.append((k, v, bias))
+        return streams_kv
+
+    def _get_attn_bias_aa(self, b, l2, device, block_size=16):
+        """Additive (b, 1, 1, l2) mask: frame i sees the first
+        (i % block_size + 1) blocks of l2 // block_size action tokens."""
         num_token = l2 // block_size
-        start_positions = ((torch.arange(b) % block_size) + 1) * num_token
-        col_indices = torch.arange(l2)
-        mask_2d = col_indices.unsqueeze(0) >= start_positions.unsqueeze(1)
-        mask = mask_2d.unsqueeze(1).expand(b, l1, l2)
-        attn_mask = torch.zeros_like(mask, dtype=torch.float)
-        attn_mask[mask] = float('-inf')
-        return attn_mask
+        start_positions = ((torch.arange(b, device=device) % block_size) +
+                           1) * num_token
+        col_indices = torch.arange(l2, device=device)
+        mask = col_indices.unsqueeze(0) >= start_positions.unsqueeze(1)
+        bias = torch.zeros(b, l2, device=device).masked_fill_(
+            mask, float('-inf'))
+        return bias.view(b, 1, 1, l2)
+
+    def _get_cached_kv(self, context, q_shape):
+        if self.kv_cache is None:
+            return None
+        # Identity check only: WMAModel hands out the same context tensor
+        # while its own cache hits, and comparing values here would cost a
+        # device sync per layer
+        for entry in self.kv_cache:
+            if (entry['context'] is context
+                    and entry['version'] == context._version
+                    and entry['q_shape'] == q_shape):
+                return entry['kv']
+        return None
 
 
 class BasicTransformerBlock(nn.Module):
@@ -670,18 +664,23 @@ class TemporalTransformer(nn.Module):
                 x = block(x, mask=mask)
             x = rearrange(x, '(b hw) t c -> b hw t c', b=b).contiguous()
         else:
-            x = rearrange(x, '(b hw) t c -> b hw t c', b=b).contiguous()
-            context = rearrange(context, '(b t) l con -> b t l con',
-                                t=t).contiguous()
+            # Row i of sample j attends to context frame i // r. The rows
+            # sharing a frame are consecutive, so each block call takes as
+            # many whole groups as the kernel batch limit allows and the
+            # attention broadcasts the frame's keys and values over them.
+            assert (h * w) % t == 0, \
+                f'{h * w} spatial rows do not split over {t} context frames'
+            r = (h * w) // t
+            heads = self.transformer_blocks[0].attn1.heads
+            chunk = max(1, MAX_KERNEL_BATCH // (heads * r)) * r
             for i, block in enumerate(self.transformer_blocks):
-                # Calculate each batch one by one (since number in shape could not greater then 65,535 for some package)
-                for j in range(b):
-                    context_j = repeat(context[j],
-                                       't l con -> (t r) l con',
-                                       r=(h * w) // t,
-                                       t=t).contiguous()
-                    # Note: causal mask will not applied in cross-attention case
-                    x[j] = block(x[j], context=context_j)
+                # Note: causal mask will not applied in cross-attention case
+                x = torch.cat([
+                    block(x[start:start + chunk],
+                          context=context[start // r:(start + chunk) // r])
+                    for start in range(0, x.shape[0], chunk)
+                ])
+            x = rearrange(x, '(b hw) t c -> b hw t c', b=b).contiguous()
 
         if self.use_linear:
             x = self.proj_out(x)
@@ -5,6 +5,7 @@ import torch.nn.functional as F
 from torch import Tensor
 from functools import partial
 from abc import abstractmethod
+from contextlib import contextmanager
 from einops import rearrange
 from omegaconf import OmegaConf
 from typing import Optional, Sequence, Any, Tuple, Union, List, Dict
@@ -14,9 +15,47 @@ from unifolm_wma.utils.diffusion import timestep_embedding
 from unifolm_wma.utils.common import checkpoint
 from unifolm_wma.utils.basics import (zero_module, conv_nd, linear,
                                       avg_pool_nd, normalization)
-from unifolm_wma.modules.attention import SpatialTransformer, TemporalTransformer
+from unifolm_wma.modules.attention import (SpatialTransformer,
+                                           TemporalTransformer, CrossAttention)
+from unifolm_wma.utils.cache import same_tensor
 from unifolm_wma.utils.utils import instantiate_from_config
 
+# Entries kept per cache: conditional and unconditional context
+CONTEXT_CACHE_SIZE = 2
+
+
+@contextmanager
+def cache_cross_attention_context(model, compare_values=False):
+    """
+    Reuse the cross-attention context of every WMAModel in `model` while it
+    stays the same, e.g. for one sampling trajectory: the expanded context
+    tokens, each CrossAttention layer's projected keys/values and the agent
+    action attention mask are computed once instead of at every step.
+
+    A context matches when it is the tensor seen before and unchanged since.
+    With `compare_values`, other tensors are compared by value too, at the
+    cost of a full comparison and a device sync per call.
+    """
+    modules = [
+        m for m in model.modules()
+        if isinstance(m, WMAModel) and m.context_cache is None
+        or isinstance(m, CrossAttention) and m.kv_cache is None
+    ]
+    for m in modules:
+        if isinstance(m, WMAModel):
+            m.context_cache = []
+            m.context_cache_compare_values = compare_values
+        else:
+            m.kv_cache = []
+    try:
+        yield
+    finally:
+        for m in modules:
+            if isinstance(m, WMAModel):
+                m.context_cache = None
+            else:
+                m.kv_cache = None
+
 
 class TimestepBlock(nn.Module):
     """
@@ -685,6 +724,10 @@ class WMAModel(nn.Module):
         self.action_token_projector = instantiate_from_config(
             stem_process_config)
 
+        # Set by `cache_cross_attention_context` while sampling
+        self.context_cache = None
+        self.context_cache_compare_values = False
+
     def forward(self,
                 x: Tensor,
                 x_action: Tensor,
@@ -694,6 +737,7 @@ class WMAModel(nn.Module):
                 context_action: Tensor | None = None,
                 features_adapter: Any = None,
                 fs: Tensor | None = None,
+                return_action_features: bool = False,
                 **kwargs) -> Tensor | tuple[Tensor, ...]:
 
         """
@@ -708,6 +752,8 @@ class WMAModel(nn.Module):
             context_action: conditioning context specific to action/state (implementation-specific).
             features_adapter: module or dict to adapt intermediate features.
             fs: frame-stride / fps conditioning.
+            return_action_features: also return the UNet features consumed by
+                the action/state heads, so they can be reused with `forward_heads`.
 
         Returns:
             Tuple of Tensors for predictions:
@@ -720,58 +766,7 @@ class WMAModel(nn.Module):
                                    repeat_only=False).type(x.dtype)
         emb = self.time_embed(t_emb)
 
-        bt, l_context, _ = context.shape
-        if self.base_model_gen_only:
-            assert l_context == 77 + self.n_obs_steps * 16, ">>> ERROR Context dim 1 ..."  ## NOTE HANDCODE
-        else:
-            if l_context == self.n_obs_steps + 77 + t * 16:
-                context_agent_state = context[:, :self.n_obs_steps]
-                context_text = context[:, self.n_obs_steps:self.n_obs_steps +
-                                       77, :]
-                context_img = context[:, self.n_obs_steps + 77:, :]
-                context_agent_state = context_agent_state.repeat_interleave(
-                    repeats=t, dim=0)
-                context_text = context_text.repeat_interleave(repeats=t, dim=0)
-                context_img = rearrange(context_img,
-                                        'b (t l) c -> (b t) l c',
-                                        t=t)
-                context = torch.cat(
-                    [context_agent_state, context_text, context_img], dim=1)
-            elif l_context == self.n_obs_steps + 16 + 77 + t * 16:
-                context_agent_state = context[:, :self.n_obs_steps]
-                context_agent_action = context[:, self.
-                                               n_obs_steps:self.n_obs_steps +
-                                               16, :]
-                context_agent_action = rearrange(
-                    context_agent_action.unsqueeze(2), 'b t l d -> (b t) l d')
-                context_agent_action = self.action_token_projector(
-                    context_agent_action)
-                context_agent_action = rearrange(context_agent_action,
-                                                 '(b o) l d -> b o l d',
-                                                 o=t)
-                context_agent_action = rearrange(context_agent_action,
-                                                 'b o (t l) d -> b o t l d',
-                                                 t=t)
-                context_agent_action = context_agent_action.permute(
-                    0, 2, 1, 3, 4)
-                context_agent_action = rearrange(context_agent_action,
-                                                 'b t o l d -> (b t) (o l) d')
-
-                context_text = context[:, self.n_obs_steps +
-                                       16:self.n_obs_steps + 16 + 77, :]
-                context_text = context_text.repeat_interleave(repeats=t, dim=0)
-
-                context_img = context[:, self.n_obs_steps + 16 + 77:, :]
-                context_img = rearrange(context_img,
-                                        'b (t l) c -> (b t) l c',
-                                        t=t)
-                context_agent_state = context_agent_state.repeat_interleave(
-                    repeats=t, dim=0)
-                context = torch.cat([
-                    context_agent_state, context_agent_action, context_text,
-                    context_img
-                ],
-                                    dim=1)
+        context = self.get_context(context, t)
 
         emb = emb.repeat_interleave(repeats=t, dim=0)
 
@@ -831,18 +826,136 @@ class WMAModel(nn.Module):
         y = rearrange(y, '(b t) c h w -> b c t h w', b=b)
 
         if not self.base_model_gen_only:
-            ba, _, _ = x_action.shape
-            a_y = self.action_unet(x_action, timesteps[:ba], hs_a,
-                                   context_action[:2], **kwargs)
-            # Predict state
-            if b > 1:
-                s_y = self.state_unet(x_state, timesteps[:ba], hs_a,
-                                      context_action[:2], **kwargs)
-            else:
-                s_y = self.state_unet(x_state, timesteps, hs_a,
-                                      context_action[:2], **kwargs)
+            a_y, s_y = self.forward_heads(x_action, x_state, timesteps, hs_a,
+                                          context_action, **kwargs)
         else:
             a_y = torch.zeros_like(x_action)
             s_y = torch.zeros_like(x_state)
 
+        if return_action_features:
+            return y, a_y, s_y, hs_a
         return y, a_y, s_y
+
+    def build_context(self, context: Tensor, t: int) -> Tensor:
+        """
+        Expand the conditioning context to the per-frame token layout used by
+        the transformer blocks: agent state, agent action (if any), text and
+        image tokens for every one of the `t` frames.
+        """
+        bt, l_context, _ = context.shape
+        if self.base_model_gen_only:
+            assert l_context == 77 + self.n_obs_steps * 16, ">>> ERROR Context dim 1 ..."  ## NOTE HANDCODE
+        else:
+            if l_context == self.n_obs_steps + 77 + t * 16:
+                context_agent_state = context[:, :self.n_obs_steps]
+                context_text = context[:, self.n_obs_steps:self.n_obs_steps +
+                                       77, :]
+                context_img = context[:, self.n_obs_steps + 77:, :]
+                context_agent_state = context_agent_state.repeat_interleave(
+                    repeats=t, dim=0)
+                context_text = context_text.repeat_interleave(repeats=t, dim=0)
+                context_img = rearrange(context_img,
+                                        'b (t l) c -> (b t) l c',
+                                        t=t)
+                context = torch.cat(
+                    [context_agent_state, context_text, context_img], dim=1)
+            elif l_context == self.n_obs_steps + 16 + 77 + t * 16:
+                context_agent_state = context[:, :self.n_obs_steps]
+                context_agent_action = context[:, self.
+                                               n_obs_steps:self.n_obs_steps +
+                                               16, :]
+                context_agent_action = rearrange(
+                    context_agent_action.unsqueeze(2), 'b t l d -> (b t) l d')
+                context_agent_action = self.action_token_projector(
+                    context_agent_action)
+                context_agent_action = rearrange(context_agent_action,
+                                                 '(b o) l d -> b o l d',
+                                                 o=t)
+                context_agent_action = rearrange(context_agent_action,
+                                                 'b o (t l) d -> b o t l d',
+                                                 t=t)
+                context_agent_action = context_agent_action.permute(
+                    0, 2, 1, 3, 4)
+                context_agent_action = rearrange(context_agent_action,
+                                                 'b t o l d -> (b t) (o l) d')
+
+                context_text = context[:, self.n_obs_steps +
+                                       16:self.n_obs_steps + 16 + 77, :]
+                context_text = context_text.repeat_interleave(repeats=t, dim=0)
+
+                context_img = context[:, self.n_obs_steps + 16 + 77:, :]
+                context_img = rearrange(context_img,
+                                        'b (t l) c -> (b t) l c',
+                                        t=t)
+                context_agent_state = context_agent_state.repeat_interleave(
+                    repeats=t, dim=0)
+                context = torch.cat([
+                    context_agent_state, context_agent_action, context_text,
+                    context_img
+                ],
+                                    dim=1)
+
+        return context
+
+    def get_context(self, context: Tensor, t: int) -> Tensor:
+        """
+        `build_context`, reusing the result while `context_cache` is enabled
+        (see `cache_cross_attention_context`) and the context is unchanged.
+        Returning the very same tensor lets every CrossAttention layer reuse
+        its projected keys and values as well.
+        """
+        cache = self.context_cache
+        if cache is not None:
+            for entry in cache:
+                if entry['t'] != t:
+                    continue
+                if entry['raw'] is context:
+                    hit = context._version == entry['version']
+                else:
+                    hit = self.context_cache_compare_values and same_tensor(
+                        context, entry['raw'], entry['version'])
+                if hit:
+                    return entry['context']
+        built = self.build_context(context, t)
+        if cache is not None:
+            cache.append({
+                'raw': context,
+                'version': context._version,
+                't': t,
+                'context': built
+            })
+            # Conditional and unconditional context under classifier-free
+            # guidance
+            if len(cache) > CONTEXT_CACHE_SIZE:
+                cache.pop(0)
+        return built
+
+    def forward_heads(self, x_action: Tensor, x_state: Tensor,
+                      timesteps: Tensor, hs_a: List[Tensor],
+                      context_action: Any,
+                      **kwargs) -> tuple[Tensor, Tensor]:
+        """
+        Run only the action and state heads on given UNet features.
+
+        Args:
+            x_action: action stream input.
+            x_state: state stream input.
+            timesteps: Diffusion timesteps, shape (B,).
+            hs_a: UNet features as returned with `return_action_features=True`.
+            context_action: conditioning context specific to action/state.
+
+        Returns:
+            Tuple of action and state predictions.
+        """
+        b = hs_a[0].shape[0]
+        ba, _, _ = x_action.shape
+        a_y = self.action_unet(x_action, timesteps[:ba], hs_a,
+                               context_action[:2], **kwargs)
+        # Predict state
+        if b > 1:
+            s_y = self.state_unet(x_state, timesteps[:ba], hs_a,
+                                  context_action[:2], **kwargs)
+        else:
+            s_y = self.state_unet(x_state, timesteps, hs_a,
+                                  context_action[:2], **kwargs)
+        return a_y, s_y
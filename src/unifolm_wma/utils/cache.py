@@ -0,0 +1,136 @@
+import threading
+import torch
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+def same_tensor(a: torch.Tensor, b: torch.Tensor, b_version: int) -> bool:
+    """Whether `a` holds the same values as `b` did when its version counter
+    was `b_version`. The same object is checked by version only, since
+    in-place writes bump it; other tensors are compared by value."""
+    if a is b:
+        return a._version == b_version
+    return (a.shape == b.shape and a.device == b.device
+            and torch.equal(a, b))
+
+
+class LRUCache:
+    """Bounded least-recently-used mapping with hit/miss counters.
+
+    Args:
+        capacity (int): Maximum number of entries. A capacity of 0 disables
+            the cache: `put` is a no-op and every `get` is a miss.
+        on_evict (Optional[Callable[[Hashable, Any], None]]): Called with the
+            key and value of every entry that is evicted or cleared, e.g. to
+            close a file handle.
+    """
+
+    def __init__(self,
+                 capacity: int,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None
+                 ) -> None:
+        self.capacity = max(0, capacity)
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.capacity == 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                old_key, old_value = self.entries.popitem(last=False)
+                self.evictions += 1
+                if self.on_evict is not None:
+                    self.on_evict(old_key, old_value)
+
+    def clear(self) -> None:
+        with self.lock:
+            if self.on_evict is not None:
+                for key, value in self.entries.items():
+                    self.on_evict(key, value)
+            self.entries.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters since creation; `hit_rate` is None before any lookup."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+                'capacity': self.capacity
+            }
+
+
+class FrameLatentCache:
+    """Latents of individual video frames, for incremental conditioning.
+
+    A frame hits if it is the very tensor encoded before and has not been
+    written to since, or if it holds the same values; consecutive control
+    steps that share observation history then never re-encode a frame.
+
+    Args:
+        capacity (int): Number of frames kept, least recently used first out.
+    """
+
+    def __init__(self, capacity: int = 8) -> None:
+        self.capacity = max(0, capacity)
+        self.entries = []
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, encode_fn: Callable[[torch.Tensor], torch.Tensor],
+               frame: torch.Tensor) -> torch.Tensor:
+        """Return `encode_fn(frame)`, computing it only on a miss."""
+        for i, (cached_frame, version, latent) in enumerate(self.entries):
+            if same_tensor(frame, cached_frame, version):
+                self.entries.append(self.entries.pop(i))
+                self.hits += 1
+                return latent
+        self.misses += 1
+        latent = encode_fn(frame)
+        if self.capacity > 0:
+            self.entries.append((frame, frame._version, latent))
+            if len(self.entries) > self.capacity:
+                self.entries.pop(0)
+        return latent
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'size': len(self.entries),
+            'capacity': self.capacity
+        }
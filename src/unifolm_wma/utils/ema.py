@@ -36,19 +36,41 @@ class LitEma(nn.Module):
         one_minus_decay = 1.0 - decay
 
         with torch.no_grad():
-            m_param = dict(model.named_parameters())
-            shadow_params = dict(self.named_buffers())
+            shadows, params = self._get_param_lists(model)
+            params = [
+                p if p.dtype == s.dtype else p.to(s.dtype)
+                for s, p in zip(shadows, params)
+            ]
+            # shadow -= (1 - decay) * (shadow - param), for all at once
+            torch._foreach_lerp_(shadows, params, float(one_minus_decay))
 
-            for key in m_param:
-                if m_param[key].requires_grad:
-                    sname = self.m_name2s_name[key]
-                    shadow_params[sname] = shadow_params[sname].type_as(
-                        m_param[key])
-                    shadow_params[sname].sub_(
-                        one_minus_decay *
-                        (shadow_params[sname] - m_param[key]))
-                else:
-                    assert not key in self.m_name2s_name
+    def _apply(self, fn, *args, **kwargs):
+        # Moving or casting replaces the buffers the cached lists point at
+        self._param_lists_key = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def _get_param_lists(self, model):
+        """
+        Matching lists of shadow buffers and trained parameters, built once
+        per model. They are dropped whenever `_apply` (`.to()`, `.half()`, ...)
+        replaces the buffers; the key also holds the storage of the `decay`
+        buffer, which object ids alone can't tell apart after a reuse.
+        """
+        lists_key = (id(model), self.decay.data_ptr())
+        if getattr(self, '_param_lists_key', None) == lists_key:
+            return self._param_lists
+        m_param = dict(model.named_parameters())
+        shadow_params = dict(self.named_buffers())
+        shadows, params = [], []
+        for key in m_param:
+            if m_param[key].requires_grad:
+                shadows.append(shadow_params[self.m_name2s_name[key]])
+                params.append(m_param[key])
+            else:
+                assert not key in self.m_name2s_name
+        self._param_lists = (shadows, params)
+        self._param_lists_key = lists_key
+        return self._param_lists
 
     def copy_to(self, model):
         m_param = dict(model.named_parameters())
@@ -0,0 +1,224 @@
+"""Parity tests for the pluggable attention backends."""
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+attention_module = pytest.importorskip('unifolm_wma.modules.attention')
+
+from unifolm_wma.modules.attention import (CrossAttention, attention,  # noqa: E402
+                                           attention_backend)
+
+BACKENDS = ['math', 'sdpa']
+if attention_module.XFORMERS_IS_AVAILBLE and torch.cuda.is_available():
+    BACKENDS.append('xformers')
+
+TEXT_LEN, IMAGE_LEN, STATE_LEN, ACTION_LEN = 77, 16, 2, 16
+
+
+def make_cross_attention(**kwargs):
+    torch.manual_seed(0)
+    return CrossAttention(query_dim=64,
+                          context_dim=32,
+                          heads=4,
+                          dim_head=16,
+                          video_length=IMAGE_LEN,
+                          agent_state_context_len=STATE_LEN,
+                          agent_action_context_len=ACTION_LEN,
+                          text_context_len=TEXT_LEN,
+                          image_cross_attention=True,
+                          image_cross_attention_scale=0.5,
+                          agent_state_cross_attention_scale=0.3,
+                          agent_action_cross_attention_scale=0.2,
+                          **kwargs).eval()
+
+
+def action_block_bias(b, n):
+    """Frame i of every 16 sees only the first i + 1 action tokens."""
+    visible = torch.arange(ACTION_LEN)[None] <= (torch.arange(b) % 16)[:, None]
+    bias = torch.zeros(b, ACTION_LEN).masked_fill(~visible, float('-inf'))
+    return bias[:, None].expand(b, n, ACTION_LEN)
+
+
+def stream_scales(attn):
+    scales = [
+        attn.image_cross_attention_scale,
+        attn.agent_state_cross_attention_scale,
+        attn.agent_action_cross_attention_scale
+    ]
+    if attn.cross_attention_scale_learnable:
+        gates = [attn.alpha_ctx, attn.alpha_cas, attn.alpha_caa]
+        scales = [s * (torch.tanh(g) + 1) for s, g in zip(scales, gates)]
+    return scales
+
+
+def reference_four_way(attn, x, context):
+    """Each stream attended separately with an explicit softmax."""
+    splits = torch.split(context, [STATE_LEN, ACTION_LEN, TEXT_LEN, IMAGE_LEN],
+                         dim=1)
+    context_as, context_aa, context_ins, context_ip = splits
+    q = attn.to_q(x)
+    image_scale, state_scale, action_scale = stream_scales(attn)
+
+    def stream(to_k, to_v, ctx, bias=None):
+        heads = attn.heads
+        qh, k, v = (t.unflatten(-1, (heads, -1)).transpose(1, 2)
+                    for t in (q, to_k(ctx), to_v(ctx)))
+        sim = qh @ k.transpose(-1, -2) * attn.scale
+        if bias is not None:
+            sim = sim + bias[:, None]
+        out = sim.softmax(dim=-1) @ v
+        return out.transpose(1, 2).flatten(2)
+
+    bias = action_block_bias(x.shape[0], x.shape[1])
+    out = stream(attn.to_k, attn.to_v, context_ins)
+    out = out + image_scale * stream(attn.to_k_ip, attn.to_v_ip, context_ip)
+    out = out + state_scale * stream(attn.to_k_as, attn.to_v_as, context_as)
+    out = out + action_scale * stream(attn.to_k_aa, attn.to_v_aa, context_aa,
+                                      bias)
+    return attn.to_out(out)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('with_bias', [False, True])
+def test_attention_kernels_agree(backend, with_bias):
+    device = 'cuda' if backend == 'xformers' else 'cpu'
+    torch.manual_seed(0)
+    q, k, v = (torch.randn(6, 20, 16, device=device) for _ in range(3))
+    bias = None
+    if with_bias:
+        bias = torch.zeros(6, 20, 20, device=device)
+        bias[:, :, 10:] = float('-inf')
+
+    expected = attention(q, k, v, bias=bias, backend='math')
+    out = attention(q, k, v, bias=bias, backend=backend)
+
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('q_shape, bias_shape', [((6, 20, 16), (6, 1, 19)),
+                                               ((2, 20, 3, 16),
+                                                (2, 1, 1, 19))])
+def test_xformers_gets_a_materialized_aligned_bias(monkeypatch, q_shape,
+                                                   bias_shape):
+    """xformers rejects stride-0 biases and rows not aligned to 8."""
+    biases = []
+
+    def memory_efficient_attention(q, k, v, attn_bias=None, op=None):
+        biases.append(attn_bias)
+        return attention(q, k, v, bias=attn_bias, backend='math')
+
+    fake = SimpleNamespace(ops=SimpleNamespace(
+        memory_efficient_attention=memory_efficient_attention))
+    monkeypatch.setattr(attention_module, 'xformers', fake, raising=False)
+    torch.manual_seed(0)
+    kv_shape = (q_shape[0], 19) + q_shape[2:]
+    q = torch.randn(q_shape)
+    k, v = torch.randn(kv_shape), torch.randn(kv_shape)
+    bias = torch.zeros(bias_shape)
+    bias[..., 10:] = float('-inf')
+
+    out = attention(q, k, v, bias=bias, backend='xformers')
+
+    (passed, ) = biases
+    assert 0 not in passed.stride()
+    assert passed.stride(-2) % 8 == 0
+    torch.testing.assert_close(out, attention(q, k, v, bias, backend='math'))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('learnable', [False, True])
+@torch.no_grad()
+def test_four_way_cross_attention_matches_reference(backend, learnable):
+    """Text, image, agent-state and block-masked agent-action streams."""
+    device = 'cuda' if backend == 'xformers' else 'cpu'
+    attn = make_cross_attention(
+        cross_attention_scale_learnable=learnable).to(device)
+    if learnable:
+        for alpha in (attn.alpha_ctx, attn.alpha_cas, attn.alpha_caa):
+            alpha.fill_(torch.randn(()).item())
+    x = torch.randn(20, 24, 64, device=device)
+    context = torch.randn(20, STATE_LEN + ACTION_LEN + TEXT_LEN + IMAGE_LEN,
+                          32,
+                          device=device)
+
+    with attention_backend(backend):
+        out = attn(x, context)
+
+    torch.testing.assert_close(out,
+                               reference_four_way(attn, x, context),
+                               rtol=1e-4,
+                               atol=1e-5)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@torch.no_grad()
+def test_self_attention_backends_agree(backend):
+    device = 'cuda' if backend == 'xformers' else 'cpu'
+    torch.manual_seed(0)
+    attn = CrossAttention(query_dim=64, heads=4, dim_head=16).to(device)
+    x = torch.randn(3, 24, 64, device=device)
+
+    with attention_backend('math'):
+        expected = attn(x)
+    with attention_backend(backend):
+        out = attn(x)
+
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_action_head_cross_attention_runs_without_xformers():
+    unet1d = pytest.importorskip(
+        'unifolm_wma.models.diffusion_head.conditional_unet1d')
+    torch.manual_seed(0)
+    attn = unet1d.CrossAttention(query_dim=32,
+                                 context_dim=48,
+                                 heads=2,
+                                 dim_head=16).eval()
+    x, context = torch.randn(2, 8, 32), torch.randn(2, 12, 48)
+
+    with torch.no_grad(), attention_backend('math'):
+        expected = attn(x, context)
+    with torch.no_grad(), attention_backend('sdpa'):
+        out = attn(x, context)
+
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_four_way_gradients_match_reference():
+    attn = make_cross_attention(cross_attention_scale_learnable=True)
+    x = torch.randn(4, 10, 64)
+    context = torch.randn(4, STATE_LEN + ACTION_LEN + TEXT_LEN + IMAGE_LEN,
+                          32,
+                          requires_grad=True)
+
+    with attention_backend('sdpa'):
+        attn(x, context).square().sum().backward()
+    grads = [p.grad.clone() for p in attn.parameters()] + [context.grad]
+    attn.zero_grad()
+    context.grad = None
+    reference_four_way(attn, x, context).square().sum().backward()
+    expected = [p.grad for p in attn.parameters()] + [context.grad]
+
+    for grad, ref in zip(grads, expected):
+        torch.testing.assert_close(grad, ref, rtol=1e-4, atol=1e-5)
+
+
+@torch.no_grad()
+def test_cached_keys_values_are_reused():
+    """With a kv cache the projections of an unchanged context are reused."""
+    attn = make_cross_attention()
+    x = torch.randn(4, 10, 64)
+    context = torch.randn(4, STATE_LEN + ACTION_LEN + TEXT_LEN + IMAGE_LEN,
+                          32)
+    expected = attn(x, context)
+
+    attn.kv_cache = []
+    first = attn(x, context)
+    assert len(attn.kv_cache) == 1
+    second = attn(x, context)
+    assert len(attn.kv_cache) == 1
+
+    torch.testing.assert_close(first, expected)
+    torch.testing.assert_close(second, expected)
@@ -0,0 +1,125 @@
+"""Round trip of the binary observation format, client to server."""
+
+import importlib.util
+from collections import deque
+from pathlib import Path
+
+import pytest
+import torch
+
+eval_utils = pytest.importorskip('unitree_deploy.utils.eval_utils')
+for _name in ('fastapi', 'uvicorn', 'imageio', 'matplotlib', 'torchvision',
+              'pytorch_lightning'):
+    pytest.importorskip(_name)
+
+from safetensors.torch import save as save_safetensors  # noqa: E402
+from unitree_deploy.utils.observation_buffer import ObservationRingBuffer  # noqa: E402
+
+_SERVER = (Path(__file__).resolve().parents[1] / 'scripts' / 'evaluation' /
+           'real_eval_server.py')
+_spec = importlib.util.spec_from_file_location('real_eval_server', _SERVER)
+real_eval_server = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(real_eval_server)
+decode_observation_payload = real_eval_server.decode_observation_payload
+
+IMAGE, STATE = 'observation.images.top', 'observation.state'
+
+
+def make_batch():
+    torch.manual_seed(0)
+    # HWC frames permuted to CHW and float64 states sliced out of a wider
+    # array: neither is contiguous nor in the wire dtype
+    frames = [
+        torch.randint(0, 256, (4, 5, 3), dtype=torch.uint8).permute(2, 0, 1)
+        for _ in range(2)
+    ]
+    states = [torch.randn(7, 2, dtype=torch.float64)[:, 0] for _ in range(2)]
+    actions = [torch.randn(6) for _ in range(16)]
+    return {
+        IMAGE: deque(frames, maxlen=2),
+        STATE: deque(states, maxlen=2),
+        'action': deque(actions, maxlen=16),
+    }
+
+
+def test_encode_decode_round_trip():
+    batch = make_batch()
+    assert not batch[IMAGE][0].is_contiguous()
+    assert not batch[STATE][0].is_contiguous()
+    client = eval_utils.LongConnectionClient('http://server',
+                                             return_video=True)
+
+    tensors, metadata = decode_observation_payload(
+        client.encode_binary('pick up the cup', batch))
+
+    assert set(tensors) == {IMAGE, STATE, 'action'}
+    assert tensors[IMAGE].dtype == torch.uint8
+    assert tensors[STATE].dtype == tensors['action'].dtype == torch.float32
+    assert tensors[IMAGE].shape == (2, 3, 4, 5)
+    assert tensors[STATE].shape == (2, 7)
+    assert tensors['action'].shape == (16, 6)
+    assert torch.equal(tensors[IMAGE], torch.stack(list(batch[IMAGE])))
+    assert torch.equal(tensors[STATE],
+                       torch.stack(list(batch[STATE])).float())
+    assert torch.equal(tensors['action'], torch.stack(list(batch['action'])))
+    assert metadata == {
+        'language_instruction': 'pick up the cup',
+        'return_video': 'true'
+    }
+
+
+def test_session_step_carries_new_entries_and_counts():
+    batch = make_batch()
+    batch['counts'] = {IMAGE: 9, STATE: 8}
+    client = eval_utils.LongConnectionClient('http://server',
+                                             session_id='g1')
+
+    tensors, metadata = decode_observation_payload(
+        client.encode_binary('wave', batch, {IMAGE: 1, STATE: 5}))
+
+    assert set(tensors) == {IMAGE, STATE}
+    assert torch.equal(tensors[IMAGE], batch[IMAGE][-1][None])
+    # no more than the history is sent
+    assert tensors[STATE].shape == (2, 7)
+    assert metadata['session_id'] == 'g1'
+    assert metadata['return_video'] == 'false'
+    assert metadata[f'count.{IMAGE}'] == '9'
+    assert metadata[f'count.{STATE}'] == '8'
+    assert real_eval_server.ObservationSession.counts_from_metadata(
+        metadata) == batch['counts']
+
+
+def test_ring_buffer_window_round_trip():
+    buffer = ObservationRingBuffer({IMAGE: 2, STATE: 2, 'action': 16},
+                                   image_keys=[IMAGE])
+    for step in range(3):
+        buffer.push({
+            IMAGE: torch.full((4, 5, 3), step, dtype=torch.uint8),
+            STATE: torch.full((7, ), float(step)),
+            'action': torch.full((6, ), float(step)),
+        })
+    client = eval_utils.LongConnectionClient('http://server')
+
+    tensors, _ = decode_observation_payload(client.encode_binary('', buffer))
+
+    for key in (IMAGE, STATE, 'action'):
+        assert torch.equal(tensors[key], buffer.window(key))
+
+
+@pytest.mark.parametrize('dtype',
+                         list(real_eval_server.SAFETENSORS_DTYPES.values()))
+def test_decode_every_dtype(dtype):
+    torch.manual_seed(0)
+    tensors = {
+        'x': (torch.randn(3, 4) * 10).to(dtype),
+        'scalar': torch.ones((), dtype=dtype),
+        'empty': torch.empty(0, 5, dtype=dtype),
+    }
+
+    decoded, metadata = decode_observation_payload(save_safetensors(tensors))
+
+    assert metadata == {}
+    for key, tensor in tensors.items():
+        assert decoded[key].dtype == dtype
+        assert decoded[key].shape == tensor.shape
+        assert torch.equal(decoded[key], tensor)
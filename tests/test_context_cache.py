@@ -0,0 +1,62 @@
+"""The WMAModel cross-attention context cache."""
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+wma_model = pytest.importorskip('unifolm_wma.modules.networks.wma_model')
+
+
+def make_model(compare_values=False):
+    """Just the state `WMAModel.get_context` uses, counting builds."""
+    model = SimpleNamespace(context_cache=[],
+                            context_cache_compare_values=compare_values,
+                            builds=0)
+
+    def build_context(context, t):
+        model.builds += 1
+        return context.repeat_interleave(t, dim=0)
+
+    model.build_context = build_context
+    return model
+
+
+def get_context(model, context, t=2):
+    return wma_model.WMAModel.get_context(model, context, t)
+
+
+def test_same_tensor_hits_without_comparing_values(monkeypatch):
+    model = make_model()
+    context = torch.randn(2, 5, 8)
+    built = get_context(model, context)
+
+    def no_equal(*args):
+        raise AssertionError('compared by value')
+
+    monkeypatch.setattr(torch, 'equal', no_equal)
+    assert get_context(model, context) is built
+    # A copy only matches when value comparison is asked for
+    assert get_context(model, context.clone()) is not built
+    assert model.builds == 2
+
+
+def test_in_place_change_misses():
+    model = make_model()
+    context = torch.randn(2, 5, 8)
+    get_context(model, context)
+
+    context.add_(1)
+
+    torch.testing.assert_close(get_context(model, context),
+                               context.repeat_interleave(2, dim=0))
+    assert model.builds == 2
+
+
+def test_value_comparison_fallback():
+    model = make_model(compare_values=True)
+    context = torch.randn(2, 5, 8)
+    built = get_context(model, context)
+
+    assert get_context(model, context.clone()) is built
+    assert model.builds == 1
@@ -0,0 +1,154 @@
+"""Decoupled action sampling against the joint DDIM loop."""
+
+import math
+
+import pytest
+import torch
+import torch.nn as nn
+
+ddim = pytest.importorskip('unifolm_wma.models.samplers.ddim')
+diffusers = pytest.importorskip('diffusers')
+
+from unifolm_wma.utils.diffusion import make_ddim_timesteps  # noqa: E402
+
+B, C, T, H, W = 2, 4, 3, 4, 4
+ACTION_DIM, STATE_DIM = 6, 5
+
+
+class StubTrunk(nn.Module):
+    """Action/state heads reading the trunk features, like WMAModel."""
+
+    def __init__(self):
+        super().__init__()
+        self.head_calls = 0
+
+    @staticmethod
+    def heads(x_action, x_state, timesteps, hs_a, context_action):
+        images, states = context_action[:2]
+        t = timesteps.float().view(-1, 1, 1) / 1000
+        a_y = 0.5 * x_action + hs_a[0] * t + images.mean()
+        s_y = 0.5 * x_state - hs_a[0] * t + states.mean(dim=1, keepdim=True)
+        return a_y, s_y
+
+    def forward_heads(self, x_action, x_state, timesteps, hs_a,
+                      context_action, **kwargs):
+        self.head_calls += 1
+        return self.heads(x_action, x_state, timesteps, hs_a, context_action)
+
+
+class StubModel(nn.Module):
+    """The parts of LatentVisualDiffusion that DDIMSampler uses."""
+
+    parameterization = 'eps'
+    use_dynamic_rescale = False
+    num_timesteps = 1000
+    agent_action_dim = ACTION_DIM
+    agent_state_dim = STATE_DIM
+
+    def __init__(self):
+        super().__init__()
+        betas = torch.linspace(1e-4, 2e-2, self.num_timesteps,
+                               dtype=torch.float64)
+        alphas_cumprod = torch.cumprod(1. - betas, dim=0)
+        alphas_cumprod_prev = torch.cat([alphas_cumprod.new_ones(1),
+                                         alphas_cumprod[:-1]])
+        self.register_buffer('betas', betas.float())
+        self.register_buffer('alphas_cumprod', alphas_cumprod.float())
+        self.register_buffer('alphas_cumprod_prev',
+                             alphas_cumprod_prev.float())
+        self.model = nn.Module()
+        self.model.diffusion_model = StubTrunk()
+        self.dp_noise_scheduler_action, self.dp_noise_scheduler_state = (
+            diffusers.DDIMScheduler(num_train_timesteps=1000,
+                                    beta_schedule='squaredcos_cap_v2',
+                                    clip_sample=True,
+                                    set_alpha_to_one=True,
+                                    steps_offset=0,
+                                    prediction_type='epsilon')
+            for _ in range(2))
+        self.trunk_calls = 0
+
+    @property
+    def device(self):
+        return self.betas.device
+
+    def apply_model(self, x, x_action, x_state, t, cond,
+                    return_action_features=False, **kwargs):
+        self.trunk_calls += 1
+        context = cond['c_crossattn'][0].mean(dim=(1, 2))
+        e_t = 0.1 * x + cond['c_concat'][0] * context.view(-1, 1, 1, 1, 1)
+        hs_a = [x.mean(dim=(1, 2, 3, 4)).view(-1, 1, 1).expand(-1, 16, 1)]
+        a_y, s_y = StubTrunk.heads(x_action, x_state, t, hs_a,
+                                   cond['c_crossattn_action'])
+        if return_action_features:
+            return e_t, a_y, s_y, hs_a
+        return e_t, a_y, s_y
+
+
+def make_conditioning():
+    torch.manual_seed(0)
+    return {
+        'c_concat': [torch.randn(B, C, T, H, W)],
+        'c_crossattn': [torch.randn(B, 7, 16)],
+        'c_crossattn_action':
+        [torch.randn(B, 3, 2, 8, 8),
+         torch.randn(B, 2, STATE_DIM)],
+    }
+
+
+def sample(model, ddim_steps, **kwargs):
+    sampler = ddim.DDIMSampler(model)
+    cond = make_conditioning()
+    torch.manual_seed(1)
+    x_T = torch.randn(B, C, T, H, W)
+    samples, actions, states, _ = sampler.sample(S=ddim_steps,
+                                                 batch_size=B,
+                                                 shape=(C, T, H, W),
+                                                 conditioning=cond,
+                                                 eta=1.0,
+                                                 verbose=False,
+                                                 x_T=x_T,
+                                                 **kwargs)
+    return samples, actions, states
+
+
+def test_full_schedule_matches_joint_loop_bit_for_bit():
+    """action_ddim_steps == S with trunk_refresh_every=1 is the joint loop."""
+    model = StubModel()
+    expected = sample(model, 10)
+    assert model.trunk_calls == 10
+
+    model = StubModel()
+    result = sample(model, 10, action_ddim_steps=10, trunk_refresh_every=1)
+
+    assert model.trunk_calls == 10
+    assert model.model.diffusion_model.head_calls == 0
+    for out, ref in zip(result, expected):
+        assert torch.equal(out, ref)
+
+
+@pytest.mark.parametrize('action_ddim_steps, trunk_refresh_every',
+                         [(4, 1), (4, 2), (5, 2), (6, 4)])
+def test_fewer_action_steps(action_ddim_steps, trunk_refresh_every):
+    model = StubModel()
+
+    samples, actions, states = sample(model,
+                                      10,
+                                      action_ddim_steps=action_ddim_steps,
+                                      trunk_refresh_every=trunk_refresh_every)
+
+    assert samples.shape == (B, C, T, H, W)
+    assert actions.shape == (B, 16, ACTION_DIM)
+    assert states.shape == (B, 16, STATE_DIM)
+    # The uniform discretization can add a step (6 -> 7 timesteps)
+    action_steps = len(
+        make_ddim_timesteps('uniform', action_ddim_steps, 1000,
+                            verbose=False))
+    trunk_steps = math.ceil(action_steps / trunk_refresh_every)
+    assert model.trunk_calls == trunk_steps
+    assert model.model.diffusion_model.head_calls == action_steps - trunk_steps
+    assert (model.dp_noise_scheduler_action.num_inference_steps ==
+            model.dp_noise_scheduler_state.num_inference_steps ==
+            action_steps)
+    for out in (samples, actions, states):
+        assert torch.isfinite(out).all()
@@ -0,0 +1,126 @@
+"""Tests for the vectorized EMA updates."""
+
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from torch.nn.modules.batchnorm import _BatchNorm
+
+from unifolm_wma.models.diffusion_head.ema_model import EMAModel
+from unifolm_wma.utils.ema import LitEma
+
+
+def make_model():
+    model = nn.Sequential(nn.Linear(8, 16), nn.BatchNorm1d(16), nn.ReLU(),
+                          nn.Linear(16, 4))
+    model[3].bias.requires_grad_(False)
+    return model
+
+
+def perturb_(model):
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p))
+
+
+def reference_step(ema_model, new_model, decay):
+    """The per-parameter loop EMAModel.step used before vectorizing."""
+    with torch.no_grad():
+        for module, ema_module in zip(new_model.modules(),
+                                      ema_model.modules()):
+            for param, ema_param in zip(module.parameters(recurse=False),
+                                        ema_module.parameters(recurse=False)):
+                if isinstance(module, _BatchNorm) or not param.requires_grad:
+                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
+                else:
+                    ema_param.mul_(decay)
+                    ema_param.add_(param.data.to(dtype=ema_param.dtype),
+                                   alpha=1 - decay)
+
+
+@pytest.mark.parametrize('device', [None, 'cpu'])
+def test_ema_model_matches_reference_loop(device):
+    """The foreach update gives bit-identical averaged weights."""
+    torch.manual_seed(0)
+    model = make_model()
+    ema = EMAModel(copy.deepcopy(model), power=0.75, device=device)
+    reference = copy.deepcopy(model)
+
+    for _ in range(5):
+        perturb_(model)
+        decay = ema.get_decay(ema.optimization_step)
+        ema.step(model)
+        reference_step(reference, model, decay)
+
+    for p, ref in zip(ema.averaged_model.parameters(),
+                      reference.parameters()):
+        assert torch.equal(p, ref)
+
+
+def test_ema_model_update_every():
+    """Updating every N steps applies the decay of all N steps at once."""
+    torch.manual_seed(0)
+    model = make_model()
+    ema = EMAModel(copy.deepcopy(model), min_value=0.9, update_every=3)
+    reference = copy.deepcopy(model)
+
+    for step in range(7):
+        perturb_(model)
+        decay = ema.get_decay(ema.optimization_step)
+        ema.step(model)
+        if step % 3 == 0:
+            reference_step(reference, model, decay**3)
+
+    for p, ref in zip(ema.averaged_model.parameters(),
+                      reference.parameters()):
+        assert torch.equal(p, ref)
+
+
+def test_lit_ema_matches_reference_loop():
+    """LitEma's foreach update matches the per-parameter formula."""
+    torch.manual_seed(0)
+    model = make_model()
+    lit_ema = LitEma(model)
+    shadows = {
+        name: p.clone()
+        for name, p in model.named_parameters() if p.requires_grad
+    }
+
+    for num_updates in range(1, 5):
+        perturb_(model)
+        lit_ema(model)
+        decay = min(0.9999, (1 + num_updates) / (10 + num_updates))
+        for name, p in model.named_parameters():
+            if p.requires_grad:
+                shadows[name].sub_((1.0 - decay) * (shadows[name] - p.data))
+
+    buffers = dict(lit_ema.named_buffers())
+    for name, shadow in shadows.items():
+        torch.testing.assert_close(buffers[lit_ema.m_name2s_name[name]],
+                                   shadow)
+
+
+def test_lit_ema_updates_its_buffers_after_a_move():
+    """Cached parameter lists must not outlive the buffers they point at."""
+    torch.manual_seed(0)
+    model = make_model()
+    lit_ema = LitEma(model, use_num_upates=False)
+    lit_ema(model)
+
+    lit_ema.to(torch.float64)
+    buffers = dict(lit_ema.named_buffers())
+    expected = {
+        name: buffers[s_name].clone()
+        for name, s_name in lit_ema.m_name2s_name.items()
+    }
+    perturb_(model)
+    lit_ema(model)
+
+    params = dict(model.named_parameters())
+    buffers = dict(lit_ema.named_buffers())
+    for name, s_name in lit_ema.m_name2s_name.items():
+        expected[name].lerp_(params[name].data.double(), 1 - 0.9999)
+        assert buffers[s_name].dtype == torch.float64
+        torch.testing.assert_close(buffers[s_name], expected[name])
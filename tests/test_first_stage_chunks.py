@@ -0,0 +1,88 @@
+"""Tests for chunked first-stage encoding/decoding."""
+
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn as nn
+
+ddpms = pytest.importorskip('unifolm_wma.models.ddpms')
+
+
+class CountingNet(nn.Module):
+    """Per-sample network standing in for the autoencoder."""
+
+    def __init__(self):
+        super().__init__()
+        self.net = nn.Sequential(nn.Conv2d(3, 8, 3, padding=1),
+                                 nn.GroupNorm(4, 8), nn.SiLU())
+        self.calls = []
+
+    def forward(self, x):
+        self.calls.append(x.shape[0])
+        return self.net(x)
+
+
+def make_model(perframe_ae, chunk_size):
+    model = SimpleNamespace(perframe_ae=perframe_ae,
+                            en_and_decode_n_samples_a_time=chunk_size,
+                            ae_chunk_sizes={})
+    model._measure_chunk_size = partial(
+        ddpms.LatentDiffusion._measure_chunk_size, model)
+    return model
+
+
+def run_in_chunks(model, net, x):
+    return ddpms.LatentDiffusion._first_stage_in_chunks(
+        model, 'encode', net, x)
+
+
+@pytest.mark.parametrize('perframe_ae, chunk_size, calls',
+                         [(False, None, [7]), (True, None, [1] * 7),
+                          (True, 3, [3, 3, 1]), (True, 'auto', [7])])
+@torch.no_grad()
+def test_chunks_match_single_call(perframe_ae, chunk_size, calls):
+    """Every chunking gives the result of one call over all frames."""
+    torch.manual_seed(0)
+    net = CountingNet().eval()
+    x = torch.randn(7, 3, 16, 16)
+    expected = net.net(x)
+
+    result = run_in_chunks(make_model(perframe_ae, chunk_size), net, x)
+
+    torch.testing.assert_close(result, expected)
+    assert net.calls == calls
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs CUDA')
+@torch.no_grad()
+def test_auto_chunk_size_is_measured_once_per_shape():
+    """'auto' probes one frame, then reuses the tuned size for that shape."""
+    net = CountingNet().cuda().eval()
+    model = make_model(True, 'auto')
+    x = torch.randn(9, 3, 16, 16, device='cuda')
+
+    result = run_in_chunks(model, net, x)
+    assert net.calls[0] == 1
+    (chunk_size, ) = model.ae_chunk_sizes.values()
+    assert chunk_size >= 1
+
+    net.calls.clear()
+    torch.testing.assert_close(run_in_chunks(model, net, x), result)
+    assert net.calls[0] == min(chunk_size, 9)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs CUDA')
+@torch.no_grad()
+def test_measuring_keeps_the_peak_memory_counter():
+    """Training logs the process-wide peak, so probing must not reset it."""
+    net = CountingNet().cuda().eval()
+    model = make_model(True, 'auto')
+    big = torch.empty(64, 2**20, device='cuda')
+    del big
+    peak = torch.cuda.max_memory_allocated()
+
+    run_in_chunks(model, net, torch.randn(2, 3, 16, 16, device='cuda'))
+
+    assert torch.cuda.max_memory_allocated() >= peak
@@ -0,0 +1,139 @@
+"""The fused classifier-free guidance pass against two separate passes."""
+
+import pytest
+import torch
+
+ddim = pytest.importorskip('unifolm_wma.models.samplers.ddim')
+
+B, C, T, H, W = 2, 4, 3, 4, 4
+
+
+class StubModel:
+    """Deterministic per-sample stand-in for `apply_model`."""
+
+    parameterization = 'eps'
+    use_dynamic_rescale = False
+    num_timesteps = 1000
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def apply_model(self, x, x_action, x_state, t, cond, fs=None):
+        self.batch_sizes.append(x.shape[0])
+        context = cond['c_crossattn'][0].mean(dim=(1, 2))
+        images, states, *_ = cond['c_crossattn_action']
+        per_sample = (context + images.flatten(1).mean(-1) +
+                      1e-3 * t.float() + 1e-2 * fs.float())
+        e_t = x * per_sample.view(-1, 1, 1, 1, 1).tanh() + cond['c_concat'][0]
+        e_action = x_action * per_sample.view(-1, 1, 1).cos()
+        e_state = x_state.sin() + states.mean(dim=1, keepdim=True)
+        return e_t, e_action, e_state
+
+
+def make_conditionings():
+    torch.manual_seed(0)
+    concat = torch.randn(B, C, T, H, W)
+    images = torch.randn(B, 3, 2, 8, 8)
+    states = torch.randn(B, 2, 5)
+    cond = {
+        'c_concat': [concat],
+        'c_crossattn': [torch.randn(B, 7, 16)],
+        'c_crossattn_action': [images, states, False, False],
+    }
+    uc = {**cond, 'c_crossattn': [torch.randn(B, 7, 16)]}
+    return cond, uc
+
+
+def step_coefs():
+    names = ['sigma_t', 'sqrt_one_minus_at', 'sqrt_a_t', 'sqrt_a_prev',
+             'dir_xt']
+    return {name: torch.tensor([0.5]) for name in names}
+
+
+def p_sample(sampler, fused_cfg, guidance_rescale):
+    torch.manual_seed(1)
+    x = torch.randn(B, C, T, H, W)
+    x_action, x_state = torch.randn(B, 16, 6), torch.randn(B, 16, 5)
+    cond, uc = make_conditionings()
+    return sampler.p_sample_ddim(x,
+                                 x_action,
+                                 x_state,
+                                 cond,
+                                 torch.full((B, ), 500),
+                                 index=0,
+                                 unconditional_guidance_scale=3.0,
+                                 unconditional_conditioning=uc,
+                                 guidance_rescale=guidance_rescale,
+                                 fused_cfg=fused_cfg,
+                                 step_coefs=step_coefs(),
+                                 temperature=0.,
+                                 fs=torch.full((B, ), 10))
+
+
+@pytest.mark.parametrize('guidance_rescale', [0.0, 0.7])
+def test_fused_pass_matches_separate_passes(guidance_rescale):
+    model = StubModel()
+    sampler = ddim.DDIMSampler(model)
+
+    separate = p_sample(sampler, False, guidance_rescale)
+    assert model.batch_sizes == [B, B]
+    model.batch_sizes.clear()
+    fused = p_sample(sampler, True, guidance_rescale)
+    assert model.batch_sizes == [2 * B]
+
+    for out, expected in zip(fused, separate):
+        torch.testing.assert_close(out, expected)
+
+
+def test_cat_for_cfg_stacks_dict_conditionings_per_key():
+    cond, uc = make_conditionings()
+
+    stacked = ddim.DDIMSampler._cat_for_cfg(cond, uc)
+
+    torch.testing.assert_close(stacked['c_crossattn'][0],
+                               torch.cat([cond['c_crossattn'][0],
+                                          uc['c_crossattn'][0]]))
+    torch.testing.assert_close(stacked['c_concat'][0],
+                               cond['c_concat'][0].repeat(2, 1, 1, 1, 1))
+    images, states, *flags = stacked['c_crossattn_action']
+    assert images.shape[0] == states.shape[0] == 2 * B
+    assert flags == [False, False]
+
+
+def test_mismatched_conditionings_fall_back_to_separate_passes():
+    cond, uc = make_conditionings()
+    uc['c_crossattn_action'] = uc['c_crossattn_action'][:2] + [True, False]
+    assert ddim.DDIMSampler._cat_for_cfg(cond, uc) is None
+    del uc['c_concat']
+    assert ddim.DDIMSampler._cat_for_cfg(cond, uc) is None
+
+    model = StubModel()
+    sampler = ddim.DDIMSampler(model)
+    cond, uc = make_conditionings()
+    uc['c_crossattn'] = [torch.randn(B, 5, 16)]
+    x = torch.randn(B, C, T, H, W)
+    sampler.p_sample_ddim(x,
+                          torch.randn(B, 16, 6),
+                          torch.randn(B, 16, 5),
+                          cond,
+                          torch.full((B, ), 500),
+                          index=0,
+                          unconditional_guidance_scale=3.0,
+                          unconditional_conditioning=uc,
+                          fused_cfg=True,
+                          step_coefs=step_coefs(),
+                          fs=torch.full((B, ), 10))
+    assert model.batch_sizes == [B, B]
+
+
+def test_stacked_conditioning_is_reused_within_a_sample_call():
+    """The model sees one stacked context per call, so its caches can hit."""
+    sampler = ddim.DDIMSampler(StubModel())
+    cond, uc = make_conditionings()
+
+    with sampler._cfg_stack_scope():
+        stacked = sampler._stacked_for_cfg(cond, uc)
+        assert sampler._stacked_for_cfg(cond, uc) is stacked
+        other_uc = {**uc}
+        assert sampler._stacked_for_cfg(cond, other_uc) is not stacked
+    assert sampler._cfg_stack is None
@@ -0,0 +1,84 @@
+"""Tests for incremental conditioning: encoding only the conditioning frame."""
+
+import pytest
+import torch
+import torch.nn as nn
+
+from einops import rearrange
+
+from unifolm_wma.utils.cache import FrameLatentCache
+
+
+class CountingEncoder(nn.Module):
+    """Deterministic stand-in for the first-stage encoder."""
+
+    def __init__(self):
+        super().__init__()
+        self.net = nn.Sequential(nn.Conv2d(3, 8, 3, stride=2, padding=1),
+                                 nn.GroupNorm(4, 8), nn.SiLU(),
+                                 nn.Conv2d(8, 4, 3, stride=2, padding=1))
+        self.frames_encoded = 0
+
+    def forward(self, x):
+        self.frames_encoded += x.shape[0]
+        return self.net(x)
+
+
+@pytest.fixture
+def encoder():
+    torch.manual_seed(0)
+    return CountingEncoder().eval()
+
+
+def full_history_latent(encoder, videos):
+    """The previous conditioning path: encode every observed frame and keep
+    the last one."""
+    b, c, t, h, w = videos.shape
+    z = encoder(rearrange(videos, 'b c t h w -> (b t) c h w'))
+    z = rearrange(z, '(b t) c h w -> b c t h w', b=b, t=t)
+    return z[:, :, -1:, :, :]
+
+
+@torch.no_grad()
+def test_conditioning_frame_latent_matches_full_history(encoder):
+    """Encoding only the last frame gives the latent the full-history path
+    kept."""
+    videos = torch.randn(2, 3, 4, 32, 32)
+
+    expected = full_history_latent(encoder, videos)
+    cache = FrameLatentCache()
+    latent = cache.encode(encoder, videos[:, :, -1]).unsqueeze(2)
+
+    torch.testing.assert_close(latent, expected)
+
+
+@torch.no_grad()
+def test_frames_shared_across_steps_are_not_reencoded(encoder):
+    """A frame already encoded is reused, whether it is the same tensor or
+    an equal copy, and stays identical to a fresh encoding."""
+    history = [torch.randn(1, 3, 32, 32) for _ in range(3)]
+    cache = FrameLatentCache(capacity=2)
+
+    first = cache.encode(encoder, history[-1])
+    assert encoder.frames_encoded == 1
+    assert cache.encode(encoder, history[-1]) is first
+    assert cache.encode(encoder, history[-1].clone()) is first
+    assert encoder.frames_encoded == 1
+
+    torch.testing.assert_close(first, encoder(history[-1]), rtol=0, atol=0)
+    assert cache.stats()['hits'] == 2
+
+
+@torch.no_grad()
+def test_modified_frame_is_reencoded(encoder):
+    """Writing to a frame in place invalidates its cached latent."""
+    frame = torch.randn(1, 3, 32, 32)
+    cache = FrameLatentCache()
+
+    before = cache.encode(encoder, frame)
+    frame.add_(1.0)
+    after = cache.encode(encoder, frame)
+
+    assert encoder.frames_encoded == 2
+    assert not torch.equal(before, after)
+    torch.testing.assert_close(after, encoder(frame), rtol=0, atol=0)
@@ -0,0 +1,114 @@
+"""Parity tests for Normalize/Unnormalize against the plain formulas."""
+
+import pickle
+
+import pytest
+import torch
+
+normalize = pytest.importorskip('unifolm_wma.data.normalize')
+Normalize, Unnormalize = normalize.Normalize, normalize.Unnormalize
+
+STATS = {
+    # zero-range dims (an unused gripper, padded arm dims) next to a
+    # regular one and a large offset
+    'observation.state': {
+        'min': torch.tensor([0.5, -1., 1000.]),
+        'max': torch.tensor([0.5, 1., 1000.25]),
+        'mean': torch.tensor([0.5, 0., 1000.1]),
+        'std': torch.tensor([0., 0.5, 1e-3]),
+    },
+    'action': {
+        'min': torch.tensor([0., -3.]),
+        'max': torch.tensor([0., 4.]),
+        'mean': torch.tensor([0., 0.5]),
+        'std': torch.tensor([1., 2.]),
+    },
+}
+SHAPES = {'observation.state': [3], 'action': [2]}
+
+
+def reference(batch, modes, inverse):
+    """The per-key formulas Normalize/Unnormalize are expected to match."""
+    out = dict(batch)
+    for key, mode in modes.items():
+        x, stats = batch[key], STATS[key]
+        if mode == 'mean_std' and not inverse:
+            out[key] = (x - stats['mean']) / (stats['std'] + 1e-8)
+        elif mode == 'mean_std':
+            out[key] = x * stats['std'] + stats['mean']
+        elif not inverse:
+            x = (x - stats['min']) / (stats['max'] - stats['min'] + 1e-8)
+            out[key] = x * 2 - 1
+        else:
+            x = (x + 1) / 2
+            out[key] = x * (stats['max'] - stats['min']) + stats['min']
+    return out
+
+
+def make_batch():
+    torch.manual_seed(0)
+    state = STATS['observation.state']['min'] + torch.rand(4, 6, 3) * 0.25
+    return {'observation.state': state, 'action': torch.randn(4, 6, 2)}
+
+
+@pytest.mark.parametrize('mode', ['mean_std', 'min_max'])
+@pytest.mark.parametrize('cls, inverse', [(Normalize, False),
+                                          (Unnormalize, True)])
+def test_matches_reference_formulas(mode, cls, inverse):
+    modes = {key: mode for key in SHAPES}
+    module = cls(SHAPES, modes, STATS)
+    batch = make_batch()
+
+    out = module(batch)
+
+    expected = reference(batch, modes, inverse)
+    for key in SHAPES:
+        torch.testing.assert_close(out[key], expected[key])
+
+
+def test_constant_dim_maps_to_minus_one():
+    module = Normalize({'action': [2]}, {'action': 'min_max'},
+                       {'action': {
+                           'min': torch.tensor([0.5, -1.]),
+                           'max': torch.tensor([0.5, 1.]),
+                       }})
+
+    out = module({'action': torch.tensor([[0.5, 0.3]])})
+
+    torch.testing.assert_close(out['action'], torch.tensor([[-1., 0.3]]))
+
+
+def test_stats_changed_in_place_are_checked_and_used():
+    module = Normalize(SHAPES, {key: 'min_max' for key in SHAPES}, STATS)
+    batch = make_batch()
+    module(batch)
+    assert module.stats_validated
+
+    with torch.no_grad():
+        module.buffer_action['max'].mul_(2)
+    assert not module.stats_validated
+    out = module(batch)
+    expected = (batch['action'] - STATS['action']['min']) / (
+        STATS['action']['max'] * 2 - STATS['action']['min'] + 1e-8) * 2 - 1
+    torch.testing.assert_close(out['action'], expected)
+
+    with torch.no_grad():
+        module.buffer_action['min'].fill_(float('inf'))
+    with pytest.raises(AssertionError):
+        module(batch)
+
+
+@pytest.mark.parametrize('cls', [Normalize, Unnormalize])
+def test_pickle_round_trip(cls):
+    """DataLoader workers under spawn and torch.save pickle the modules."""
+    module = cls(SHAPES, {key: 'min_max' for key in SHAPES}, STATS)
+    batch = make_batch()
+    expected = module(batch)
+
+    restored = pickle.loads(pickle.dumps(module))
+    out = restored(batch)
+
+    for key in SHAPES:
+        torch.testing.assert_close(out[key], expected[key])
+    restored.load_state_dict(module.state_dict())
+    assert not restored.stats_validated
@@ -0,0 +1,79 @@
+"""ObservationRingBuffer against the deque history it replaces."""
+
+import gc
+from collections import deque
+
+import numpy as np
+import pytest
+import torch
+
+observation_buffer = pytest.importorskip(
+    'unitree_deploy.utils.observation_buffer')
+ObservationRingBuffer = observation_buffer.ObservationRingBuffer
+
+IMAGE, STATE = 'observation.images.top', 'observation.state'
+
+
+def observations(n, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(n):
+        # BGR (H, W, C) frames and float states, as the robot writes them
+        yield {
+            IMAGE: rng.integers(0, 256, (4, 5, 3), dtype=np.uint8),
+            STATE: torch.from_numpy(rng.standard_normal(7).astype(np.float32)),
+        }
+
+
+def deque_push(queues, observation):
+    """The deque history: RGB (C, H, W) frames, the first entry fills it."""
+    observation = {
+        IMAGE: torch.from_numpy(observation[IMAGE]).permute(2, 0, 1).flip(0),
+        STATE: observation[STATE],
+    }
+    for key, queue in queues.items():
+        if len(queue) == 0:
+            queue.extend([observation[key]] * queue.maxlen)
+        else:
+            queue.append(observation[key])
+
+
+@pytest.mark.parametrize('shared', [False, True])
+@pytest.mark.parametrize('horizon', [1, 2, 3])
+def test_window_matches_deque(horizon, shared):
+    buffer = ObservationRingBuffer({IMAGE: horizon, STATE: horizon},
+                                   image_keys=[IMAGE],
+                                   shared=shared)
+    queues = {IMAGE: deque(maxlen=horizon), STATE: deque(maxlen=horizon)}
+
+    for observation in observations(3 * horizon + 2):
+        buffer.push(observation)
+        deque_push(queues, observation)
+        for key, queue in queues.items():
+            window = buffer.window(key)
+            assert window.is_contiguous()
+            assert torch.equal(window, torch.stack(list(queue)))
+    del window
+
+    buffer.reset()
+    queues = {IMAGE: deque(maxlen=horizon), STATE: deque(maxlen=horizon)}
+    observation = next(observations(1, seed=1))
+    buffer.push(observation)
+    deque_push(queues, observation)
+    for key, queue in queues.items():
+        assert torch.equal(buffer.window(key), torch.stack(list(queue)))
+    buffer.close()
+
+
+def test_close_with_live_views():
+    buffer = ObservationRingBuffer({STATE: 2}, shared=True)
+    buffer.write(STATE, np.zeros(3, dtype=np.float32))
+    window = buffer.window(STATE)
+
+    buffer.close()
+
+    assert buffer.shm_names == {}
+    assert len(buffer._unclosed) == 1
+    del window
+    gc.collect()
+    buffer.close()
+    assert buffer._unclosed == []
@@ -0,0 +1,92 @@
+"""Tests for the eval server's observation sessions."""
+
+import importlib.util
+from pathlib import Path
+
+import pytest
+import torch
+
+for _name in ('fastapi', 'uvicorn', 'imageio', 'matplotlib', 'torchvision',
+              'pytorch_lightning'):
+    pytest.importorskip(_name)
+
+_SERVER = (Path(__file__).resolve().parents[1] / 'scripts' / 'evaluation' /
+           'real_eval_server.py')
+_spec = importlib.util.spec_from_file_location('real_eval_server', _SERVER)
+real_eval_server = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(real_eval_server)
+ObservationSession = real_eval_server.ObservationSession
+
+T, D = 2, 3
+KEYS = ObservationSession.HISTORY_KEYS
+
+
+def frames(*values):
+    return torch.tensor(values, dtype=torch.float32).view(-1, 1, 1, 1).expand(
+        -1, 3, 2, 2).clone()
+
+
+def states(*values):
+    return torch.tensor(values, dtype=torch.float32)[:, None].expand(-1,
+                                                                     D).clone()
+
+
+def open_session(counts):
+    observation = {
+        'observation.images.top': frames(0, 1)[None],
+        'observation.state': states(0, 1)[None],
+        'action': torch.zeros(1, 16, D)
+    }
+    return ObservationSession(observation, torch.ones(D), counts)
+
+
+def windows(session):
+    return {key: session.window(key).clone() for key in KEYS}
+
+
+def test_replayed_step_is_not_pushed_twice():
+    session = open_session({key: 2 for key in KEYS})
+    counts = {key: 3 for key in KEYS}
+    session.step(frames(2), states(2), counts)
+    expected = windows(session)
+
+    # Same body again, e.g. resent by the client after a timeout
+    observation = session.step(frames(2), states(2), counts)
+
+    for key in KEYS:
+        torch.testing.assert_close(session.window(key), expected[key])
+        torch.testing.assert_close(observation[key][0], expected[key])
+    assert session.counts['observation.state'] == 1
+
+
+def test_step_after_lost_response_pushes_only_new_entries():
+    """The client resends entries the server applied before a lost response."""
+    session = open_session({key: 2 for key in KEYS})
+    session.step(frames(2), states(2), {key: 3 for key in KEYS})
+
+    session.step(frames(2, 3), states(2, 3), {key: 4 for key in KEYS})
+
+    torch.testing.assert_close(session.window('observation.state'),
+                               states(2, 3))
+    torch.testing.assert_close(session.window('observation.images.top'),
+                               frames(2, 3))
+
+
+def test_steps_without_counts_push_everything():
+    session = open_session(None)
+    session.step(frames(2), states(2))
+    session.step(frames(2), states(2))
+
+    assert session.counts['observation.state'] == 2
+    torch.testing.assert_close(session.window('observation.state'),
+                               states(2, 2))
+
+
+def test_counts_from_metadata():
+    metadata = {'count.observation.state': '7', 'session_id': 'g1'}
+    assert ObservationSession.counts_from_metadata(metadata) is None
+    metadata['count.observation.images.top'] = '5'
+    assert ObservationSession.counts_from_metadata(metadata) == {
+        'observation.state': 7,
+        'observation.images.top': 5
+    }
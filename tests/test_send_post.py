@@ -0,0 +1,141 @@
+"""Retries, deadlines and latency bookkeeping of the policy client."""
+
+import json
+
+import pytest
+
+eval_utils = pytest.importorskip('unitree_deploy.utils.eval_utils')
+requests = pytest.importorskip('requests')
+
+DEADLINE = 0.5
+
+
+class FakeClock:
+    """Stands in for the `time` module: sleeping advances the clock."""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        assert seconds >= 0
+        self.now += seconds
+
+
+def make_response(status_code, body=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body or {}).encode()
+    response.url = 'http://server/predict_action'
+    return response
+
+
+class FakeSession:
+    """Replays `replies` to `post`: responses, or exceptions to raise."""
+
+    def __init__(self, clock, replies, latency=0.01):
+        self.clock = clock
+        self.replies = list(replies)
+        self.latency = latency
+        self.calls = []
+
+    def post(self, url, json=None, data=None, headers=None, timeout=None):
+        self.calls.append({'json': json, 'data': data, 'timeout': timeout})
+        reply = self.replies.pop(0) if self.replies else requests.Timeout()
+        if isinstance(reply, requests.Timeout):
+            self.clock.sleep(timeout)
+            raise reply
+        self.clock.sleep(self.latency)
+        return reply
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(eval_utils, 'time', clock)
+    return clock
+
+
+def make_client(clock, replies, **kwargs):
+    client = eval_utils.LongConnectionClient('http://server',
+                                             deadline=DEADLINE,
+                                             **kwargs)
+    client.session = FakeSession(clock, replies)
+    return client
+
+
+def test_deadline_fires_when_every_attempt_times_out(clock):
+    client = make_client(clock, [], timeout=0.2)
+    start = clock.now
+
+    with pytest.raises(eval_utils.DeadlineExceeded):
+        client.send_post('/predict_action', {'x': 1})
+
+    calls = client.session.calls
+    assert len(calls) > 1
+    assert all(0 < call['timeout'] <= 0.2 for call in calls)
+    assert clock.now - start == pytest.approx(DEADLINE)
+    assert client.latency['/predict_action'].failures == 1
+    assert client.latency['/predict_action'].count == 0
+
+
+def test_client_error_is_raised_without_retry(clock):
+    client = make_client(clock, [make_response(404), make_response(200)])
+
+    with pytest.raises(requests.HTTPError) as excinfo:
+        client.send_post('/session/step', data=b'payload')
+
+    assert excinfo.value.response.status_code == 404
+    assert len(client.session.calls) == 1
+    assert client.latency['/session/step'].failures == 1
+
+
+def test_server_errors_are_retried(clock):
+    ok = {'result': 'ok', 'action': [[0.0]]}
+    client = make_client(clock, [make_response(503), make_response(200, ok)])
+
+    assert client.send_post('/predict_action', {'x': 1}) == ok
+    assert len(client.session.calls) == 2
+
+
+def test_error_result_is_retried_with_the_same_payload(clock):
+    busy = {'result': 'error', 'desc': 'busy'}
+    ok = {'result': 'ok', 'action': [[0.0]]}
+    client = make_client(clock,
+                         [make_response(200, busy),
+                          make_response(200, ok)])
+
+    result = client.send_post('/predict_action_binary', data=b'payload')
+
+    assert result == ok
+    assert [call['data'] for call in client.session.calls] == [b'payload'] * 2
+    histogram = client.latency['/predict_action_binary']
+    assert histogram.count == 1 and histogram.failures == 0
+
+
+def test_latency_percentiles_use_bucket_upper_bounds():
+    histogram = eval_utils.LatencyHistogram()
+    assert histogram.percentile(50) != histogram.percentile(50)  # nan
+
+    for seconds in [0.0015] * 90 + [0.015] * 9 + [0.3]:
+        histogram.record(seconds)
+
+    assert histogram.counts[1] == 90  # (1, 2] ms
+    assert histogram.counts[4] == 9  # (10, 20] ms
+    assert histogram.percentile(50) == 2
+    assert histogram.percentile(90) == 2
+    assert histogram.percentile(99) == 20
+    # the last bucket is capped by the largest sample
+    assert histogram.percentile(100) == pytest.approx(300)
+    assert histogram.max == pytest.approx(300)
+    assert histogram.summary().startswith('n=100 ')
+
+
+def test_latency_beyond_the_last_bound():
+    histogram = eval_utils.LatencyHistogram()
+    histogram.record(60.0)
+
+    assert histogram.counts[-1] == 1
+    assert histogram.percentile(50) == pytest.approx(60000)
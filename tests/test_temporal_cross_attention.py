@@ -0,0 +1,84 @@
+"""Chunked TemporalTransformer cross-attention against the per-sample loop."""
+
+import pytest
+import torch
+import torch.nn as nn
+
+attention_module = pytest.importorskip('unifolm_wma.modules.attention')
+
+from einops import rearrange, repeat  # noqa: E402
+
+from unifolm_wma.modules.attention import CrossAttention, TemporalTransformer  # noqa: E402
+
+
+def make_temporal_transformer(relative_position, temporal_length=4):
+    torch.manual_seed(0)
+    module = TemporalTransformer(64,
+                                 n_heads=4,
+                                 d_head=16,
+                                 depth=2,
+                                 context_dim=32,
+                                 use_checkpoint=False,
+                                 use_linear=True,
+                                 only_self_att=False,
+                                 relative_position=relative_position,
+                                 temporal_length=temporal_length).eval()
+    # proj_out starts at zero, which would hide the attention output
+    nn.init.normal_(module.proj_out.weight, std=0.1)
+    return module
+
+
+def reference_forward(module, x, context):
+    """The original loop: one block call per sample on a repeated context."""
+    b, c, t, h, w = x.shape
+    x_in = x
+    x = rearrange(module.norm(x), 'b c t h w -> b (h w) t c')
+    x = module.proj_in(x).clone()
+    context = rearrange(context, '(b t) l con -> b t l con', t=t)
+    for block in module.transformer_blocks:
+        for j in range(b):
+            context_j = repeat(context[j],
+                               't l con -> (t r) l con',
+                               r=(h * w) // t)
+            x[j] = block(x[j], context=context_j)
+    x = module.proj_out(x)
+    return rearrange(x, 'b (h w) t c -> b c t h w', h=h, w=w) + x_in
+
+
+@pytest.mark.parametrize('relative_position', [False, True])
+@pytest.mark.parametrize('max_kernel_batch', [65535, 4 * 2 * 3])
+@torch.no_grad()
+def test_chunked_cross_attention_matches_loop(monkeypatch, relative_position,
+                                              max_kernel_batch):
+    """Any chunking (here 1 or 3 context frames per call) gives the loop."""
+    monkeypatch.setattr(attention_module, 'MAX_KERNEL_BATCH',
+                        max_kernel_batch)
+    module = make_temporal_transformer(relative_position)
+    x = torch.randn(3, 64, 4, 2, 4)
+    context = torch.randn(3 * 4, 77, 32)
+
+    torch.testing.assert_close(module(x, context),
+                               reference_forward(module, x, context),
+                               rtol=1e-4,
+                               atol=1e-5)
+
+
+@pytest.mark.parametrize('temporal_length', [None, 4])
+@torch.no_grad()
+def test_cross_attention_broadcasts_shared_context(temporal_length):
+    """Rows sharing a context row match the repeated context."""
+    torch.manual_seed(0)
+    attn = CrossAttention(query_dim=64,
+                          context_dim=32,
+                          heads=4,
+                          dim_head=16,
+                          temporal_length=temporal_length).eval()
+    x = torch.randn(6, 4, 64)
+    context = torch.randn(2, 77, 32)
+
+    expected = attn(x, context.repeat_interleave(3, dim=0))
+
+    torch.testing.assert_close(attn(x, context),
+                               expected,
+                               rtol=1e-4,
+                               atol=1e-5)
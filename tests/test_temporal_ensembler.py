@@ -0,0 +1,156 @@
+"""Tests for ACTTemporalEnsembler, including late chunks merged late."""
+
+import pytest
+import torch
+
+eval_utils = pytest.importorskip('unitree_deploy.utils.eval_utils')
+ACTTemporalEnsembler = eval_utils.ACTTemporalEnsembler
+
+CHUNK, DIM = 16, 3
+
+
+class BaselineEnsembler:
+    """The previous `update`, where every chunk arrives on time."""
+
+    def __init__(self, coeff, chunk_size, exe_steps):
+        self.chunk_size = chunk_size
+        self.weights = torch.exp(-coeff * torch.arange(chunk_size))
+        self.weights_cumsum = torch.cumsum(self.weights, dim=0)
+        self.exe_steps = exe_steps
+        self.actions = None
+        self.count = None
+
+    def update(self, actions):
+        if self.actions is None:
+            self.actions = actions.clone()
+            self.count = torch.ones((self.chunk_size, 1), dtype=torch.long)
+        else:
+            self.actions *= self.weights_cumsum[self.count - 1]
+            self.actions += actions[:, :-self.exe_steps] * self.weights[
+                self.count]
+            self.actions /= self.weights_cumsum[self.count]
+            self.count = torch.clamp(self.count + 1, max=self.chunk_size)
+            self.actions = torch.cat(
+                [self.actions, actions[:, -self.exe_steps:]], dim=1)
+            self.count = torch.cat(
+                [self.count,
+                 torch.ones((self.exe_steps, 1), dtype=torch.long)])
+        out = self.actions[:, :self.exe_steps]
+        self.actions = self.actions[:, self.exe_steps:]
+        self.count = self.count[self.exe_steps:]
+        return out
+
+
+def chunks(n, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.randn(2, CHUNK, DIM, generator=generator) for _ in range(n)]
+
+
+def average(ensembled, count, new, ensembler):
+    """One online step of the weighted average."""
+    weights = ensembler.ensemble_weights
+    cumsum = ensembler.ensemble_weights_cumsum
+    return (ensembled * cumsum[count - 1] +
+            new * weights[count]) / cumsum[count]
+
+
+@pytest.mark.parametrize('coeff', [0.01, -0.1])
+@pytest.mark.parametrize('exe_steps', [2, 4, 8])
+def test_update_matches_baseline(coeff, exe_steps):
+    ensembler = ACTTemporalEnsembler(coeff, CHUNK, exe_steps)
+    baseline = BaselineEnsembler(coeff, CHUNK, exe_steps)
+
+    for actions in chunks(12):
+        torch.testing.assert_close(ensembler.update(actions),
+                                   baseline.update(actions))
+        assert len(ensembler) == CHUNK - exe_steps
+
+
+def test_count_stays_a_valid_weight_index():
+    """With one action per step a time step collects chunk_size chunks."""
+    ensembler = ACTTemporalEnsembler(0.01, CHUNK, 1)
+
+    for actions in chunks(3 * CHUNK):
+        ensembler.update(actions)
+
+    assert ensembler.ensembled_actions_count.max() == CHUNK - 1
+
+
+def test_merge_offset_zero_into_empty_ensemble():
+    ensembler = ACTTemporalEnsembler(0.01, CHUNK, 4)
+    (actions, ) = chunks(1)
+
+    ensembler.merge(actions)
+
+    assert len(ensembler) == CHUNK
+    torch.testing.assert_close(ensembler.pop(CHUNK), actions)
+
+
+def test_merge_offset_inside_chunk():
+    """A chunk predicted before the last 4 pops lines up with the ensemble."""
+    ensembler = ACTTemporalEnsembler(0.01, CHUNK, 4)
+    first, late = chunks(2)
+    ensembler.merge(first)
+    ensembler.pop(4)
+
+    ensembler.merge(late, offset=4)
+
+    assert len(ensembler) == CHUNK - 4
+    expected = average(first[:, 4:], 1, late[:, 4:], ensembler)
+    torch.testing.assert_close(ensembler.pop(CHUNK), expected)
+
+
+def test_merge_chunk_longer_than_the_ensemble():
+    """The chunk's tail beyond the pending actions is appended as is."""
+    ensembler = ACTTemporalEnsembler(0.01, CHUNK, 4)
+    first, late = chunks(2)
+    ensembler.merge(first)
+    ensembler.pop(4)
+
+    ensembler.merge(late, offset=2)
+
+    assert len(ensembler) == CHUNK - 2
+    counts = ensembler.ensembled_actions_count.flatten().tolist()
+    assert counts == [2] * 12 + [1] * 2
+    expected = torch.cat(
+        [average(first[:, 4:], 1, late[:, 2:14], ensembler), late[:, 14:]],
+        dim=1)
+    torch.testing.assert_close(ensembler.pop(CHUNK), expected)
+
+
+def test_merge_chunk_ending_before_the_ensemble():
+    """The ensemble's tail past the late chunk keeps its average."""
+    ensembler = ACTTemporalEnsembler(0.01, CHUNK, 4)
+    first, second, late = chunks(3)
+    ensembler.merge(first)
+    ensembler.pop(4)
+    ensembler.merge(second, offset=4)
+
+    ensembler.merge(late, offset=10)
+
+    assert len(ensembler) == CHUNK - 4
+    counts = ensembler.ensembled_actions_count.flatten().tolist()
+    assert counts == [3] * 6 + [2] * 6
+    pending = average(first[:, 4:], 1, second[:, 4:], ensembler)
+    expected = torch.cat(
+        [average(pending[:, :6], 2, late[:, 10:], ensembler), pending[:, 6:]],
+        dim=1)
+    torch.testing.assert_close(ensembler.pop(CHUNK), expected)
+
+
+def test_merge_offset_past_the_chunk():
+    """A chunk whose whole horizon is already in the past changes nothing."""
+    ensembler = ACTTemporalEnsembler(0.01, CHUNK, 4)
+    first, late = chunks(2)
+    ensembler.merge(first)
+    ensembler.pop(4)
+    pending = ensembler.ensembled_actions.clone()
+
+    ensembler.merge(late, offset=CHUNK)
+
+    assert len(ensembler) == CHUNK - 4
+    torch.testing.assert_close(ensembler.ensembled_actions, pending)
+
+    empty = ACTTemporalEnsembler(0.01, CHUNK, 4)
+    empty.merge(late, offset=CHUNK + 3)
+    assert len(empty) == 0
@@ -26,21 +26,20 @@ Dla początkujących:
 import argparse
 import os
 import time
-import cv2
 import numpy as np
 import torch
 import tqdm
 
-from typing import Any, Deque, MutableMapping, OrderedDict
-from collections import deque
+from typing import Any
 from pathlib import Path
 
 from unitree_deploy.real_unitree_env import make_real_env
 from unitree_deploy.utils.eval_utils import (
     ACTTemporalEnsembler,
+    DeadlineExceeded,
     LongConnectionClient,
-    populate_queues,
 )
+from unitree_deploy.utils.observation_buffer import ObservationRingBuffer
 
 # -----------------------------------------------------------------------------
 # Konfiguracja sieci i środowiska
@@ -93,52 +92,56 @@ CAM_KEY = {
 # fmt: on
 
 
-def prepare_observation(args: argparse.Namespace, obs: Any) -> OrderedDict:
+def record_observation(args: argparse.Namespace, obs: Any,
+                       obs_buffer: ObservationRingBuffer) -> None:
     """
-    Przygotowuje obserwację do wysłania do serwera polityki.
-    
-    Konwertuje surowe dane z robota na format oczekiwany przez model AI.
+    Zapisuje obserwację z robota bezpośrednio do bufora pierścieniowego.
     
     Args:
         args: Argumenty linii poleceń zawierające konfigurację robota
         obs: Surowa obserwacja z robota zawierająca:
-            - obs.observation["images"][cam_key]: obraz BGR z kamery
+            - obs.observation["images"][cam_key]: obraz z kamery (H, W, C)
             - obs.observation["qpos"]: pozycje przegubów (joint positions)
-    
-    Returns:
-        OrderedDict: Słownik uporządkowany zawierający:
-            - "observation.images.top": obraz RGB jako tensor (C, H, W)
-            - "observation.state": stan przegubów jako tensor
-            - "action": akcja zerowa (placeholder)
+        obs_buffer: Bufor historii obserwacji (prealokowany)
     
     Wyjaśnienie dla początkujących:
-        Modele AI oczekują danych w konkretnym formacie. Ta funkcja:
+        Modele AI oczekują danych w konkretnym formacie. Bufor sam:
         1. Konwertuje obraz z BGR (format OpenCV) na RGB (format standardowy)
         2. Zmienia układ wymiarów z (H, W, C) na (C, H, W) dla PyTorch
-        3. Pakuje wszystko w słownik z odpowiednimi kluczami
+        Obie operacje odbywają się w jednym kopiowaniu do gotowego slotu
+        bufora, więc pętla sterowania nie alokuje nowych tablic w każdym kroku.
     """
-    # Konwersja obrazu z BGR (OpenCV) na RGB (standardowy format)
-    # BGR to kolejność kolorów używana przez OpenCV, ale modele AI oczekują RGB
-    rgb_image = cv2.cvtColor(
-        obs.observation["images"][CAM_KEY[args.robot_type]], cv2.COLOR_BGR2RGB)
-    
-    # Tworzenie słownika obserwacji w formacie oczekiwanym przez model
-    observation = {
-        # Obraz: Konwersja na tensor i zmiana układu wymiarów
-        # permute(2, 0, 1) zmienia (Height, Width, Channels) na (Channels, Height, Width)
-        "observation.images.top":
-        torch.from_numpy(rgb_image).permute(2, 0, 1),
-        
-        # Stan robota: Pozycje wszystkich przegubów (qpos = joint positions)
-        "observation.state":
-        torch.from_numpy(obs.observation["qpos"]),
-        
-        # Akcja: Początkowo zerowa (zostanie zastąpiona przez przewidywania)
-        "action": ZERO_ACTION[args.robot_type],
-    }
+    # Obraz: kopiowany do slotu bufora jako RGB (C, H, W)
+    obs_buffer.write("observation.images.top",
+                     obs.observation["images"][CAM_KEY[args.robot_type]])
     
-    # OrderedDict zachowuje kolejność elementów (ważne dla niektórych modeli)
-    return OrderedDict(observation)
+    # Stan robota: Pozycje wszystkich przegubów (qpos = joint positions)
+    obs_buffer.write("observation.state", obs.observation["qpos"])
+
+
+def fallback_actions(args: argparse.Namespace,
+                     temporal_ensembler: ACTTemporalEnsembler,
+                     last_action: np.ndarray):
+    """
+    Akcje do wykonania, gdy serwer nie odpowiedział przed terminem (deadline).
+
+    Tryby (--fallback):
+        - "replay": wykonaj kolejne exe_steps akcji, które zostały jeszcze
+          w buforze ensemblera; gdy bufor jest pusty - jak "hold"
+        - "hold": odrzuć nieaktualny plan i utrzymaj ostatnią akcję
+          przez jeden okres sterowania
+        - "stop": bezpieczne zatrzymanie - zwraca None i epizod się kończy
+          (robot zostaje w ostatniej zadanej pozycji)
+
+    Returns:
+        Tensor (n, action_dim) z akcjami do wykonania albo None dla "stop".
+    """
+    if args.fallback == "stop":
+        return None
+    if args.fallback == "replay" and len(temporal_ensembler) > 0:
+        return temporal_ensembler.pop(args.exe_steps)[0]
+    temporal_ensembler.reset()
+    return torch.from_numpy(last_action).unsqueeze(0)
 
 
 def run_policy(
@@ -146,7 +149,7 @@ def run_policy(
     env: Any,
     client: LongConnectionClient,
     temporal_ensembler: ACTTemporalEnsembler,
-    cond_obs_queues: MutableMapping[str, Deque[torch.Tensor]],
+    obs_buffer: ObservationRingBuffer,
     output_dir: Path,
 ) -> None:
     """
@@ -164,7 +167,7 @@ def run_policy(
         env: Środowisko robota (interfejs do sprzętu)
         client: Klient HTTP do komunikacji z serwerem polityki
         temporal_ensembler: Obiekt wygładzający akcje w czasie
-        cond_obs_queues: Kolejki przechowujące historię obserwacji
+        obs_buffer: Bufor pierścieniowy przechowujący historię obserwacji
         output_dir: Katalog do zapisywania wyników (opcjonalnie)
     
     Wyjaśnienie Temporal Ensembling:
@@ -190,6 +193,8 @@ def run_policy(
     
     # Licznik kroków czasowych
     t = 0
+    # Ostatnia wysłana akcja (dla trybu awaryjnego "hold")
+    last_action = INIT_POSE[args.robot_type]
 
     # --- FAZA 2: GŁÓWNA PĘTLA STEROWANIA ---
     while True:
@@ -197,36 +202,41 @@ def run_policy(
         # Pobierz bieżący stan robota (obrazy, pozycje przegubów)
         obs = env.get_observation(t)
         
-        # Przekonwertuj obserwację na format dla modelu
-        obs = prepare_observation(args, obs)
-        
-        # Dodaj obserwację do kolejek historycznych
+        # Zapisz obserwację w buforze historii (w formacie dla modelu)
         # Model może używać kilku ostatnich obserwacji (observation_horizon)
-        cond_obs_queues = populate_queues(cond_obs_queues, obs)
+        record_observation(args, obs, obs_buffer)
         
         # --- Krok B: ZAPYTANIE SERWERA O AKCJE ---
         # Wyślij obserwacje i instrukcję językową do serwera polityki
         # Serwer uruchomi model AI i zwróci przewidywane akcje
-        pred_actions = client.predict_action(
-            args.language_instruction,  # Np. "pack black camera into box"
-            cond_obs_queues             # Historia obserwacji
-        ).unsqueeze(0)  # Dodaj wymiar batch
-        
-        # --- Krok C: WYGŁADZANIE CZASOWE ---
-        # Zastosuj temporal ensembling, aby uczynić akcje płynniejszymi
-        # Bierzemy tylko pierwsze action_horizon akcji z przewidywanej sekwencji
-        actions = temporal_ensembler.update(
-            pred_actions[:, :args.action_horizon]
-        )[0]  # Usuń wymiar batch
+        # Jeśli serwer nie zdąży przed terminem (--deadline_steps),
+        # przechodzimy w tryb awaryjny (--fallback)
+        try:
+            pred_actions = client.predict_action(
+                args.language_instruction,  # Np. "pack black camera into box"
+                obs_buffer                  # Historia obserwacji (widok bez kopii)
+            ).unsqueeze(0)  # Dodaj wymiar batch
+        except DeadlineExceeded as e:
+            print(f"!!! {e} - tryb awaryjny: {args.fallback}")
+            actions = fallback_actions(args, temporal_ensembler, last_action)
+            if actions is None:
+                return
+        else:
+            # --- Krok C: WYGŁADZANIE CZASOWE ---
+            # Zastosuj temporal ensembling, aby uczynić akcje płynniejszymi
+            # Bierzemy tylko pierwsze action_horizon akcji z przewidywanej sekwencji
+            actions = temporal_ensembler.update(
+                pred_actions[:, :args.action_horizon]
+            )[0]  # Usuń wymiar batch
 
         # --- Krok D: WYKONYWANIE AKCJI ---
-        # Wykonaj kolejne exe_steps akcji z przewidywanej sekwencji
-        for n in range(args.exe_steps):
+        # Wykonaj kolejne akcje (zwykle exe_steps) z przewidywanej sekwencji
+        for n in range(len(actions)):
             # Konwertuj akcję z tensora PyTorch na tablicę NumPy
             action = actions[n].cpu().numpy()
             
             # Wyświetl akcję dla celów debugowania
-            print(f">>> Wykonuję krok {n} z {args.exe_steps}")
+            print(f">>> Wykonuję krok {n} z {len(actions)}")
             print(f"    Akcja: {action}")
             print("---------------------------------------------")
 
@@ -236,6 +246,7 @@ def run_policy(
             
             # Wykonaj akcję na robocie
             obs = env.step(action)
+            last_action = action
             
             # Oblicz ile czasu zajęło wykonanie
             elapsed = time.time() - t1
@@ -250,11 +261,114 @@ def run_policy(
             t += 1
 
             # --- Aktualizacja kolejek obserwacji ---
-            # Przygotuj kolejki na następną iterację (z wyjątkiem ostatniego kroku)
+            # Zapisz obserwację na następną iterację (z wyjątkiem ostatniego kroku)
             # W ostatnim kroku tego fragmentu i tak zapytamy serwer o nowe akcje
-            if n < args.exe_steps - 1:
-                obs = prepare_observation(args, obs)
-                cond_obs_queues = populate_queues(cond_obs_queues, obs)
+            if n < len(actions) - 1:
+                record_observation(args, obs, obs_buffer)
+
+
+def run_policy_async(
+    args: argparse.Namespace,
+    env: Any,
+    client: LongConnectionClient,
+    temporal_ensembler: ACTTemporalEnsembler,
+    obs_buffer: ObservationRingBuffer,
+    output_dir: Path,
+) -> None:
+    """
+    Potokowa pętla wykonywania polityki: inferencja równolegle z ruchem robota.
+
+    W run_policy robot stoi w miejscu przez cały czas zapytania do serwera.
+    Tutaj zapytanie o kolejny fragment akcji (chunk k+1) jest wysyłane w tle,
+    gdy w buforze ensemblera zostało jeszcze lead_steps akcji z fragmentu k,
+    a robot w tym czasie dalej je wykonuje.
+
+    Argumenty jak w run_policy.
+
+    Wyrównanie w czasie:
+        Przewidywania dotyczą chwili zrobienia obserwacji, a docierają
+        później. Zanim zostaną dołączone, robot wykonał już steps_since_obs
+        akcji, więc tyle pierwszych akcji nowego fragmentu jest pomijanych
+        (ACTTemporalEnsembler.merge z offset). Pozostałe są uśredniane
+        z akcjami poprzedniego fragmentu dla tych samych kroków czasowych.
+
+    Wyjaśnienie Lead Steps:
+        Jeśli lead_steps / control_freq jest dłuższe niż czas odpowiedzi
+        serwera, robot nigdy nie czeka: częstotliwość sterowania zależy
+        tylko od wykonania akcji, a nie od opóźnienia inferencji.
+        Robot czeka tylko wtedy, gdy skończą się wszystkie akcje.
+    """
+
+    # --- FAZA 1: INICJALIZACJA (WARM START) ---
+    print("Przesuwanie robota do pozycji startowej...")
+    _ = env.step(INIT_POSE[args.robot_type])
+    time.sleep(2.0)
+    print("Robot gotowy. Rozpoczynam potokową pętlę sterowania...")
+
+    # Akcje z poprzedniego epizodu nie mogą zostać wykonane w nowym
+    temporal_ensembler.reset()
+
+    target_dt = 1 / args.control_freq
+    obs = env.get_observation(0)
+    record_observation(args, obs, obs_buffer)
+
+    # Zapytanie w toku (Future) i liczba akcji wykonanych od jego obserwacji
+    pending = None
+    steps_since_obs = 0
+    t = 0
+    last_action = INIT_POSE[args.robot_type]
+
+    # --- FAZA 2: GŁÓWNA PĘTLA STEROWANIA ---
+    while True:
+        # --- Krok A: ZAPYTANIE W TLE ---
+        # Gdy w buforze zostało lead_steps akcji, wyślij bieżącą historię
+        # obserwacji; klient kopiuje ją od razu, więc pętla może pisać dalej
+        if pending is None and len(temporal_ensembler) <= args.lead_steps:
+            pending = client.predict_action_async(
+                args.language_instruction, obs_buffer)
+            steps_since_obs = 0
+
+        # --- Krok B: DOŁĄCZENIE PRZEWIDYWAŃ ---
+        # Czekamy na odpowiedź tylko wtedy, gdy nie ma już nic do wykonania
+        # Po przekroczeniu terminu (--deadline_steps) - tryb awaryjny (--fallback)
+        failed = False
+        if pending is not None and (pending.done() or len(temporal_ensembler) == 0):
+            try:
+                pred_actions = pending.result().unsqueeze(0)  # Dodaj wymiar batch
+            except DeadlineExceeded as e:
+                print(f"!!! {e} - tryb awaryjny: {args.fallback}")
+                failed = True
+            else:
+                # Pomiń akcje, których czas już minął (wyrównanie w czasie)
+                temporal_ensembler.merge(
+                    pred_actions[:, :args.action_horizon], offset=steps_since_obs)
+            pending = None
+            if failed and args.fallback == "stop":
+                return
+            if failed and args.fallback == "hold":
+                temporal_ensembler.reset()
+
+        # --- Krok C: WYKONANIE JEDNEJ AKCJI ---
+        if len(temporal_ensembler) > 0:
+            action = temporal_ensembler.pop(1)[0, 0].cpu().numpy()
+        elif failed:
+            # Nie ma czego powtórzyć: utrzymaj ostatnią akcję
+            action = last_action
+        else:
+            # Odpowiedź przyszła później niż cały horyzont akcji
+            continue
+
+        t1 = time.time()
+        obs = env.step(action)
+        last_action = action
+        elapsed = time.time() - t1
+        time.sleep(max(0, target_dt - elapsed))
+
+        t += 1
+        steps_since_obs += 1
+
+        # Historia obserwacji jest aktualizowana w każdym kroku, tak jak w run_policy
+        record_observation(args, obs, obs_buffer)
 
 
 def run_eval(args: argparse.Namespace) -> None:
@@ -264,7 +378,7 @@ def run_eval(args: argparse.Namespace) -> None:
     Ta funkcja:
     1. Inicjalizuje klienta HTTP do komunikacji z serwerem
     2. Tworzy obiekt temporal ensembler do wygładzania akcji
-    3. Przygotowuje kolejki do przechowywania historii obserwacji
+    3. Przygotowuje bufor do przechowywania historii obserwacji
     4. Tworzy środowisko robota i łączy się z nim
     5. Uruchamia określoną liczbę epizodów (rollouts)
     6. Zamyka połączenie po zakończeniu
@@ -281,8 +395,21 @@ def run_eval(args: argparse.Namespace) -> None:
     # --- FAZA 1: INICJALIZACJA KLIENTA ---
     # Utwórz klienta HTTP do komunikacji z serwerem polityki
     # LongConnectionClient utrzymuje trwałe połączenie dla lepszej wydajności
+    # W trybie "binary" obserwacje są wysyłane jako surowe bajty tensorów
+    # (klatki uint8 zamiast list liczb w JSON), co skraca serializację
     print(f"Łączenie z serwerem polityki pod adresem: {BASE_URL}")
-    client = LongConnectionClient(BASE_URL)
+    # return_video: serwer dodatkowo dekoduje i zapisuje przewidziane wideo
+    # (w tle, nie opóźnia zwrócenia akcji)
+    # deadline: maksymalny czas zapytania (z ponowieniami) w okresach sterowania
+    client = LongConnectionClient(
+        BASE_URL,
+        binary=args.transport == "binary",
+        return_video=args.return_video,
+        deadline=(None if args.deadline_steps is None
+                  else args.deadline_steps / args.control_freq),
+        # Sesja po stronie serwera: wysyłamy tylko nowe klatki i stany
+        session_id=args.session_id if args.transport == "binary" else None,
+    )
 
     # --- FAZA 2: INICJALIZACJA TEMPORAL ENSEMBLER ---
     # ACTTemporalEnsembler wygładza akcje poprzez uśrednianie eksponencjalne
@@ -296,20 +423,30 @@ def run_eval(args: argparse.Namespace) -> None:
     )
     temporal_ensembler.reset()  # Zresetuj stan początkowy
 
-    # --- FAZA 3: INICJALIZACJA KOLEJEK OBSERWACJI ---
-    # Kolejki (deques) przechowują historię ostatnich obserwacji
+    # --- FAZA 3: INICJALIZACJA BUFORA OBSERWACJI ---
+    # Bufor pierścieniowy przechowuje historię ostatnich obserwacji
     # Model może używać wielu ostatnich klatek do lepszego zrozumienia dynamiki
-    cond_obs_queues = {
-        # Kolejka obrazów: przechowuje observation_horizon ostatnich obrazów
-        "observation.images.top": deque(maxlen=args.observation_horizon),
-        
-        # Kolejka stanów: przechowuje observation_horizon ostatnich stanów przegubów
-        "observation.state": deque(maxlen=args.observation_horizon),
-        
-        # Kolejka akcji: przechowuje 16 ostatnich akcji
-        # UWAGA: Na sztywno zakodowane na 16, ponieważ model przewiduje 16 kroków do przodu
-        "action": deque(maxlen=16),
-    }
+    # Pamięć jest alokowana raz (przy pierwszym zapisie), a ostatnie
+    # observation_horizon wpisów jest zawsze ciągłym widokiem, wysyłanym
+    # do serwera bez torch.stack i bez kopiowania
+    obs_buffer = ObservationRingBuffer(
+        horizons={
+            # Obrazy: observation_horizon ostatnich klatek
+            "observation.images.top": args.observation_horizon,
+
+            # Stany: observation_horizon ostatnich stanów przegubów
+            "observation.state": args.observation_horizon,
+
+            # Akcje: 16 ostatnich akcji
+            # UWAGA: Na sztywno zakodowane na 16, ponieważ model przewiduje 16 kroków do przodu
+            "action": 16,
+        },
+        # Klatki z kamery są w formacie BGR (H, W, C)
+        image_keys=("observation.images.top",),
+    )
+
+    # Akcja: zerowa (placeholder), zapisywana raz - nie zmienia się między krokami
+    obs_buffer.write("action", ZERO_ACTION[args.robot_type])
 
     # --- FAZA 4: INICJALIZACJA ŚRODOWISKA ROBOTA ---
     # Tworzy interfejs do rzeczywistego robota
@@ -339,8 +476,10 @@ def run_eval(args: argparse.Namespace) -> None:
             print(f"\n=== Rozpoczynam epizod {episode_idx + 1}/{args.num_rollouts_planned} ===")
             
             # Uruchom pojedynczy epizod (rollout)
-            run_policy(args, env, client, temporal_ensembler, cond_obs_queues,
-                      output_dir)
+            # W trybie async inferencja odbywa się równolegle z ruchem robota
+            rollout = run_policy_async if args.async_inference else run_policy
+            rollout(args, env, client, temporal_ensembler, obs_buffer,
+                    output_dir)
             
             print(f"=== Zakończono epizod {episode_idx + 1} ===\n")
             
@@ -350,6 +489,9 @@ def run_eval(args: argparse.Namespace) -> None:
         # Zamyka połączenie z robotem (ważne dla bezpieczeństwa!)
         print("Zamykanie połączenia z robotem...")
         env.close()
+        # Histogram opóźnień zapytań (p50/p90/p99) - widać ogon opóźnień
+        print(f"Opóźnienia serwera:\n{client.latency_summary()}")
+        client.close()
         print("Połączenie zamknięte. Program zakończony.")
 
 
@@ -446,6 +588,77 @@ def get_parser() -> argparse.ArgumentParser:
              "Za niska: ruchy będą szarpane."
     )
     
+    # Format przesyłania obserwacji
+    parser.add_argument(
+        "--transport",
+        type=str,
+        default="binary",
+        choices=["binary", "json"],
+        help="Format przesyłania obserwacji do serwera. "
+             "binary: surowe bajty tensorów (endpoint /predict_action_binary), "
+             "json: listy liczb w JSON (endpoint /predict_action, wolniejszy)."
+    )
+
+    # Zapisywanie przewidzianego wideo po stronie serwera
+    parser.add_argument(
+        "--return_video",
+        action="store_true",
+        help="Poproś serwer o zdekodowanie i zapisanie przewidzianego wideo. "
+             "Domyślnie wyłączone: serwer zwraca tylko akcje (szybciej)."
+    )
+
+    # Potokowe (asynchroniczne) odpytywanie serwera
+    parser.add_argument(
+        "--async_inference",
+        action="store_true",
+        help="Wysyłaj zapytanie o kolejny fragment akcji w tle, podczas "
+             "wykonywania bieżącego (run_policy_async). Robot nie czeka na "
+             "serwer, o ile odpowiedź przyjdzie przed końcem akcji w buforze."
+    )
+
+    # Wyprzedzenie obserwacji w trybie async
+    parser.add_argument(
+        "--lead_steps",
+        type=int,
+        default=8,
+        help="Tryb async: nowe zapytanie (z bieżącą obserwacją) jest wysyłane, "
+             "gdy do wykonania zostało tyle akcji. Powinno pokrywać opóźnienie "
+             "serwera: lead_steps / control_freq > czas odpowiedzi."
+    )
+
+    # Sesja obserwacji po stronie serwera
+    parser.add_argument(
+        "--session_id",
+        type=str,
+        default=None,
+        help="Otwórz na serwerze sesję obserwacji o tym identyfikatorze "
+             "(np. nazwa robota). Serwer trzyma historię klatek i stanów "
+             "na GPU, a klient wysyła tylko obserwacje nowe od poprzedniego "
+             "zapytania. Tylko z --transport binary."
+    )
+
+    # Termin odpowiedzi serwera
+    parser.add_argument(
+        "--deadline_steps",
+        type=int,
+        default=None,
+        help="Maksymalny czas zapytania do serwera (z ponowieniami) w okresach "
+             "sterowania, np. 30 przy 30 Hz = 1 s. Po jego przekroczeniu "
+             "klient przechodzi w tryb --fallback. Domyślnie brak limitu."
+    )
+
+    # Tryb awaryjny
+    parser.add_argument(
+        "--fallback",
+        type=str,
+        default="hold",
+        choices=["hold", "replay", "stop"],
+        help="Co robić, gdy serwer nie odpowie przed terminem. "
+             "hold: utrzymaj ostatnią akcję, "
+             "replay: wykonuj akcje pozostałe w buforze ensemblera, "
+             "stop: zakończ epizod (bezpieczne zatrzymanie)."
+    )
+
     return parser
 
 
@@ -466,6 +679,10 @@ if __name__ == "__main__":
     print("=" * 70)
     print(f"Typ robota:             {args.robot_type}")
     print(f"Serwer polityki:        {BASE_URL}")
+    print(f"Transport:              {args.transport}")
+    print(f"Sesja serwera:          {args.session_id}")
+    print(f"Termin / awaria:        {args.deadline_steps} kroków / {args.fallback}")
+    print(f"Tryb async:             {args.async_inference} (lead_steps={args.lead_steps})")
     print(f"Instrukcja:             {args.language_instruction}")
     print(f"Częstotliwość:          {args.control_freq} Hz")
     print(f"Horyzont akcji:         {args.action_horizon}")
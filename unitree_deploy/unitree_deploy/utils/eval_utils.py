@@ -1,8 +1,13 @@
+import bisect
 import logging
+import random
 import sys
 import time
 import traceback
 import warnings
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import defaultdict
+from contextlib import nullcontext
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any, ClassVar
@@ -17,49 +22,224 @@ import torchvision
 from datasets import load_from_disk
 from datasets.features.features import register_feature
 from safetensors.torch import load_file
+from safetensors.torch import save as save_safetensors
+
+from unitree_deploy.utils.observation_buffer import ObservationRingBuffer
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
 
+def stack_history(batch, key) -> torch.Tensor:
+    """(T, ...) history of `key` from deques of tensors, already stacked tensors or an
+    ObservationRingBuffer.
+
+    The ring buffer already holds the history contiguously and is returned as a view;
+    callers serializing it should hold `batch.lock` (see `history_lock`).
+    """
+    if isinstance(batch, ObservationRingBuffer):
+        return batch.window(key)
+    if isinstance(batch[key], torch.Tensor):
+        return batch[key]
+    return torch.stack(list(batch[key]))
+
+
+def history_lock(batch):
+    return batch.lock if isinstance(batch, ObservationRingBuffer) else nullcontext()
+
+
+def history_counts(batch):
+    """Number of entries written per key so far, when the history keeps track of it."""
+    if isinstance(batch, ObservationRingBuffer):
+        return dict(batch.counts)
+    return batch.get("counts") if isinstance(batch, dict) else None
+
+
+class DeadlineExceeded(TimeoutError):
+    """No successful server response within the request deadline."""
+
+
+class LatencyHistogram:
+    """Request latencies bucketed on a 1-2-5 millisecond scale, plus failure counts.
+
+    Percentiles are reported as the upper bound of the bucket they fall in, which is
+    enough to see the tail on the robot PC without keeping every sample.
+    """
+
+    BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.failures = 0
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        """Upper bound (ms) of the bucket holding the q-th percentile (0 < q <= 100)."""
+        if self.count == 0:
+            return float("nan")
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS_MS + [self.max], self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return f"n=0 failures={self.failures}"
+        return (
+            f"n={self.count} mean={self.total / self.count:.1f}ms "
+            f"p50<={self.percentile(50):.0f}ms p90<={self.percentile(90):.0f}ms "
+            f"p99<={self.percentile(99):.0f}ms max={self.max:.1f}ms failures={self.failures}"
+        )
+
+
 class LongConnectionClient:
-    def __init__(self, base_url):
+    def __init__(
+        self,
+        base_url,
+        binary=False,
+        return_video=False,
+        deadline=None,
+        timeout=None,
+        backoff=0.1,
+        max_backoff=2.0,
+        log_every=100,
+        session_id=None,
+    ):
+        """
+        Args:
+            base_url: address of the inference server, e.g. "http://127.0.0.1:8000".
+            binary: send observations to `/predict_action_binary` as raw tensor bytes
+                (uint8 frames, float32 state/action) instead of nested JSON lists.
+            return_video: ask the server to also decode and save the predicted video. This
+                happens in the background on the server, but costs GPU time.
+            deadline: seconds a request may take, retries included, before `send_post` raises
+                `DeadlineExceeded`; tie it to the control period. None retries forever.
+            timeout: seconds a single attempt may take (capped by what is left of the
+                deadline). None waits as long as the deadline allows.
+            backoff, max_backoff: retries wait a random time in [0, min(max_backoff,
+                backoff * 2**attempt)] seconds (exponential backoff with full jitter).
+            log_every: log the latency histogram of an endpoint every this many requests.
+            session_id: use a server-side observation session under this id (e.g. the robot's
+                name), so binary requests only carry the observations new since the previous
+                one (see `predict_action_session`).
+        """
         self.session = requests.Session()
         self.base_url = base_url
-
-    def send_post(self, endpoint, json_data):
-        """send POST request to  endpoint"""
+        self.binary = binary
+        self.return_video = return_video
+        self.deadline = deadline
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.log_every = log_every
+        # per-endpoint latency of successful requests, retries included
+        self.latency = defaultdict(LatencyHistogram)
+        self.session_id = session_id
+        # history write counts at the last session request; None while no session is open
+        self.session_counts = None
+        # single worker: requests go out one at a time over the same session
+        self.executor = None
+
+    def send_post(self, endpoint, json_data=None, data=None, headers=None):
+        """send POST request to endpoint, retrying with backoff until `self.deadline`"""
         url = f"{self.base_url}{endpoint}"
-        response = None
+        histogram = self.latency[endpoint]
+        start = time.monotonic()
+        end = None if self.deadline is None else start + self.deadline
+        attempt = 0
         while True:
+            timeout = self.timeout
+            if end is not None:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                timeout = remaining if timeout is None else min(timeout, remaining)
             try:
-                response = self.session.post(url, json=json_data)
+                response = self.session.post(
+                    url, json=json_data, data=data, headers=headers, timeout=timeout
+                )
                 if response.status_code == 200:
-                    data = response.json()
-                    if data["result"] == "ok":
-                        response = data
-                        break
+                    result = response.json()
+                    if result["result"] == "ok":
+                        histogram.record(time.monotonic() - start)
+                        if histogram.count % self.log_every == 0:
+                            logging.info(f"{endpoint} latency: {histogram.summary()}")
+                        return result
                     else:
-                        logging.info(data["desc"])
-
-                time.sleep(1)
+                        logging.info(result["desc"])
+                elif 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                    # the request itself is rejected (e.g. unknown session): retrying won't help
+                    histogram.failures += 1
+                    response.raise_for_status()
+                else:
+                    logging.warning(f"{url} returned HTTP {response.status_code}")
+            except requests.exceptions.HTTPError:
+                raise
+            except requests.exceptions.Timeout:
+                logging.warning(f"{url} timed out after {timeout:.3f}s")
             except Exception as e:
                 logging.error(f"An error occurred: {e}")
                 logging.error(traceback.format_exc())
 
-        return response
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+            attempt += 1
+            if end is not None:
+                delay = min(delay, max(0.0, end - time.monotonic()))
+            time.sleep(delay)
+
+        histogram.failures += 1
+        raise DeadlineExceeded(
+            f"{endpoint}: no response within {self.deadline:.3f}s ({attempt} attempts)"
+        )
+
+    def latency_summary(self):
+        return "\n".join(
+            f"{endpoint}: {histogram.summary()}" for endpoint, histogram in self.latency.items()
+        )
 
     def close(self):
         """ "close session"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        if self.session_counts is not None:
+            try:
+                self.session.post(
+                    f"{self.base_url}/session/close",
+                    json={"session_id": self.session_id},
+                    timeout=1.0,
+                )
+            except Exception as e:
+                logging.warning(f"Could not close session {self.session_id}: {e}")
+            self.session_counts = None
         self.session.close()
 
     def predict_action(self, language_instruction, batch) -> torch.Tensor:
+        if self.binary and self.session_id is not None:
+            return self.predict_action_session(language_instruction, batch)
+        if self.binary:
+            return self.predict_action_binary(language_instruction, batch)
+
         # collect data
-        data = {
-            "language_instruction": language_instruction,
-            "observation.state": torch.stack(list(batch["observation.state"])).tolist(),
-            "observation.images.top": torch.stack(list(batch["observation.images.top"])).tolist(),
-            "action": torch.stack(list(batch["action"])).tolist(),
-        }
+        with history_lock(batch):
+            data = {
+                "language_instruction": language_instruction,
+                "observation.state": stack_history(batch, "observation.state").tolist(),
+                "observation.images.top": stack_history(batch, "observation.images.top").tolist(),
+                "action": stack_history(batch, "action").tolist(),
+                "return_video": self.return_video,
+            }
 
         # send data
         endpoint = "/predict_action"
@@ -68,6 +248,112 @@ class LongConnectionClient:
         action = torch.tensor(response["action"])
         return action
 
+    def encode_binary(self, language_instruction, batch, new_entries=None) -> bytes:
+        """Serialize the observation history for the binary endpoints.
+
+        The safetensors framing carries dtype/shape so the server can view the tensors directly
+        in the request body. Ring-buffer windows are already contiguous with the right dtype, so
+        they are serialized without a copy. With `new_entries` ({key: n}), only the newest n
+        entries of the state and frame histories are sent, and no action history.
+        """
+        with history_lock(batch):
+            tensors = {
+                "observation.state": stack_history(batch, "observation.state").to(torch.float32),
+                "observation.images.top": stack_history(batch, "observation.images.top").to(
+                    torch.uint8
+                ),
+            }
+            if new_entries is None:
+                tensors["action"] = stack_history(batch, "action").to(torch.float32)
+            else:
+                tensors = {
+                    key: value[len(value) - min(new_entries[key], len(value)) :]
+                    for key, value in tensors.items()
+                }
+            metadata = {
+                "language_instruction": language_instruction,
+                "return_video": "true" if self.return_video else "false",
+            }
+            if self.session_id is not None:
+                metadata["session_id"] = str(self.session_id)
+                counts = history_counts(batch)
+                if counts is not None:
+                    # absolute write counts, so the server skips entries it got from an
+                    # earlier try
+                    for key in ("observation.state", "observation.images.top"):
+                        metadata[f"count.{key}"] = str(counts[key])
+            return save_safetensors(
+                {key: value.contiguous() for key, value in tensors.items()}, metadata=metadata
+            )
+
+    def predict_action_binary(self, language_instruction, batch) -> torch.Tensor:
+        # collect data
+        data = self.encode_binary(language_instruction, batch)
+
+        # send data
+        endpoint = "/predict_action_binary"
+        response = self.send_post(
+            endpoint, data=data, headers={"Content-Type": "application/octet-stream"}
+        )
+        action = torch.tensor(response["action"])
+        return action
+
+    def predict_action_session(self, language_instruction, batch) -> torch.Tensor:
+        """Binary request against a server-side observation session.
+
+        The first request opens the session with the full history (`/session/open`). After
+        that, `/session/step` only carries the states and frames written since the previous
+        request, at most one history length; the server keeps the rest on the GPU, along with
+        the encodings of frames it has seen. Finding out what is new needs the history's write
+        counts, so this pays off with an ObservationRingBuffer (or its `predict_action_async`
+        snapshot); other batches reopen the session every time. A 404 from the server (session
+        evicted, server restarted) also reopens it. The write counts go along with every
+        request, so `send_post` can safely resend a step the server may already have applied.
+        """
+        headers = {"Content-Type": "application/octet-stream"}
+        with history_lock(batch):
+            counts = history_counts(batch)
+            new_entries = None
+            if counts is not None and self.session_counts is not None:
+                new_entries = {
+                    key: counts[key] - self.session_counts[key]
+                    for key in ("observation.state", "observation.images.top")
+                }
+                if any(n < 0 for n in new_entries.values()):
+                    # the history was reset since the last request
+                    new_entries = None
+            data = self.encode_binary(language_instruction, batch, new_entries)
+
+        endpoint = "/session/open" if new_entries is None else "/session/step"
+        try:
+            response = self.send_post(endpoint, data=data, headers=headers)
+        except requests.exceptions.HTTPError as e:
+            if endpoint != "/session/step" or e.response.status_code != 404:
+                raise
+            logging.warning(f"Session {self.session_id} is gone on the server, opening it again")
+            self.session_counts = None
+            return self.predict_action_session(language_instruction, batch)
+        self.session_counts = counts
+        action = torch.tensor(response["action"])
+        return action
+
+    def predict_action_async(self, language_instruction, batch) -> Future:
+        """Like `predict_action`, but returns at once with a Future of the action chunk.
+
+        The history is copied before returning, so the caller can keep writing observations
+        (and executing actions) while the request is in flight. Don't mix with blocking
+        `predict_action` calls while a Future is pending: both use the same session.
+        """
+        with history_lock(batch):
+            snapshot = {
+                key: stack_history(batch, key).clone()
+                for key in ("observation.state", "observation.images.top", "action")
+            }
+            snapshot["counts"] = history_counts(batch)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="policy-client")
+        return self.executor.submit(self.predict_action, language_instruction, snapshot)
+
 
 class ACTTemporalEnsembler:
     def __init__(self, temporal_ensemble_coeff: float, chunk_size: int, exe_steps: int) -> None:
@@ -129,44 +415,66 @@ class ACTTemporalEnsembler:
         Takes a (batch, chunk_size, action_dim) sequence of actions, update the temporal ensemble for all
         time steps, and pop/return the next batch of actions in the sequence.
         """
+        self.merge(actions)
+        # "Consume" the first action.
+        return self.pop(self.exe_steps)
+
+    def merge(self, actions, offset=0):
+        """
+        Adds a (batch, chunk_size, action_dim) chunk to the ensemble without consuming anything.
+
+        `offset` is the number of actions popped since the observation the chunk was predicted
+        from: its first `offset` actions are already in the past and are dropped, so action
+        `offset` of the chunk is averaged with the next action to be popped. This lets a chunk
+        that arrives late (see `LongConnectionClient.predict_action_async`) be merged at the
+        right time step.
+        """
         self.ensemble_weights = self.ensemble_weights.to(device=actions.device)
         self.ensemble_weights_cumsum = self.ensemble_weights_cumsum.to(device=actions.device)
-        if self.ensembled_actions is None:
+        actions = actions[:, offset:]
+        if self.ensembled_actions is None or self.ensembled_actions.shape[1] == 0:
             # Initializes `self._ensembled_action` to the sequence of actions predicted during the first
             # time step of the episode.
             self.ensembled_actions = actions.clone()
             # Note: The last dimension is unsqueeze to make sure we can broadcast properly for tensor
             # operations later.
             self.ensembled_actions_count = torch.ones(
-                (self.chunk_size, 1), dtype=torch.long, device=self.ensembled_actions.device
+                (actions.shape[1], 1), dtype=torch.long, device=self.ensembled_actions.device
             )
+            return
+
+        # Online update for the time steps both the ensemble and the new chunk cover.
+        overlap = min(self.ensembled_actions.shape[1], actions.shape[1])
+        count = self.ensembled_actions_count[:overlap]
+        ensembled = self.ensembled_actions[:, :overlap] * self.ensemble_weights_cumsum[count - 1]
+        ensembled += actions[:, :overlap] * self.ensemble_weights[count]
+        ensembled /= self.ensemble_weights_cumsum[count]
+        count = torch.clamp(count + 1, max=self.chunk_size - 1)
+        # Steps only one of them covers are taken as they are: the tail of the ensemble if the
+        # chunk arrived so late that it ends first, otherwise the tail of the chunk, which has no
+        # prior online average.
+        if self.ensembled_actions.shape[1] > overlap:
+            tail = self.ensembled_actions[:, overlap:]
+            tail_count = self.ensembled_actions_count[overlap:]
         else:
-            # self.ensembled_actions will have shape (batch_size, chunk_size - 1, action_dim). Compute
-            # the online update for those entries.
-            self.ensembled_actions *= self.ensemble_weights_cumsum[self.ensembled_actions_count - 1]
-            self.ensembled_actions += (
-                actions[:, : -self.exe_steps] * self.ensemble_weights[self.ensembled_actions_count]
-            )
-            self.ensembled_actions /= self.ensemble_weights_cumsum[self.ensembled_actions_count]
-            self.ensembled_actions_count = torch.clamp(self.ensembled_actions_count + 1, max=self.chunk_size)
-            # The last action, which has no prior online average, needs to get concatenated onto the end.
-            self.ensembled_actions = torch.cat([self.ensembled_actions, actions[:, -self.exe_steps :]], dim=1)
-            self.ensembled_actions_count = torch.cat(
-                # [self.ensembled_actions_count, torch.ones_like(self.ensembled_actions_count[-self.exe_steps:])]
-                [
-                    self.ensembled_actions_count,
-                    torch.ones((self.exe_steps, 1), dtype=torch.long, device=self.ensembled_actions_count.device),
-                ]
-            )
-        # "Consume" the first action.
+            tail = actions[:, overlap:]
+            tail_count = torch.ones((tail.shape[1], 1), dtype=torch.long, device=count.device)
+        self.ensembled_actions = torch.cat([ensembled, tail], dim=1)
+        self.ensembled_actions_count = torch.cat([count, tail_count])
 
+    def pop(self, n):
+        """Consumes and returns the next (batch, n, action_dim) ensembled actions."""
         actions, self.ensembled_actions, self.ensembled_actions_count = (
-            self.ensembled_actions[:, : self.exe_steps],
-            self.ensembled_actions[:, self.exe_steps :],
-            self.ensembled_actions_count[self.exe_steps :],
+            self.ensembled_actions[:, :n],
+            self.ensembled_actions[:, n:],
+            self.ensembled_actions_count[n:],
         )
         return actions
 
+    def __len__(self):
+        """Number of ensembled actions left to pop."""
+        return 0 if self.ensembled_actions is None else self.ensembled_actions.shape[1]
+
 
 @dataclass
 class VideoFrame:
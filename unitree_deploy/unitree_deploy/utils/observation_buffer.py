@@ -0,0 +1,131 @@
+import logging
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+
+
+class ObservationRingBuffer:
+    """Preallocated observation history for the control loop.
+
+    Every key keeps its last `horizon` entries in a buffer of `2 * horizon` slots, and each
+    write goes to slot `i` and its mirror `i + horizon`. The last `horizon` entries are
+    then always one contiguous slice, so `window(key)` is a zero-copy tensor view shaped
+    like the `torch.stack` of the old deque, ready to be serialized as-is.
+
+    Buffers are allocated on the first write of each key, from the shape of that entry,
+    and that first entry is repeated over the whole history (like `populate_queues`).
+    After that, writes only copy into the existing slots.
+
+    Writers in other threads (camera or arm readers) can call `write` directly. Whoever
+    reads or serializes the window must hold `lock` so a write can't land halfway through.
+    With `shared=True` the buffers live in `multiprocessing.shared_memory` blocks
+    (see `shm_names`), so a device process can map them without copying frames. Drop the
+    `window` views before `close`, since a block can't be unmapped while they are alive.
+    """
+
+    def __init__(self, horizons, image_keys=(), shared=False):
+        """
+        Args:
+            horizons: number of entries to keep per key, e.g.
+                {"observation.images.top": 2, "observation.state": 2, "action": 16}.
+            image_keys: keys written as BGR (H, W, C) camera frames. They are stored as RGB
+                (C, H, W), the layout the server expects, with the channel flip and the
+                transpose done in the single copy into the slot.
+            shared: allocate the buffers in shared memory.
+        """
+        self.horizons = dict(horizons)
+        self.image_keys = set(image_keys)
+        self.shared = shared
+        # re-entrant, so a reader holding it can call helpers that take it again
+        self.lock = threading.RLock()
+        self.buffers = {}
+        self.counts = {key: 0 for key in self.horizons}
+        self._shms = {}
+        # blocks whose mapping was still exported at `close`
+        self._unclosed = []
+
+    def __contains__(self, key):
+        return key in self.horizons
+
+    def _allocate(self, key, shape, dtype):
+        size = 2 * self.horizons[key]
+        if not self.shared:
+            return np.empty((size, *shape), dtype=dtype)
+        count = size * int(np.prod(shape))
+        shm = shared_memory.SharedMemory(create=True, size=max(count * np.dtype(dtype).itemsize, 1))
+        self._shms[key] = shm
+        # frombuffer holds a buffer export on the mapping (np.ndarray(buffer=...) does not),
+        # so closing the block under a live view raises instead of leaving it dangling
+        return np.frombuffer(shm.buf, dtype=dtype, count=count).reshape(size, *shape)
+
+    def write(self, key, value):
+        """Append one entry (array or tensor) to the history of `key`."""
+        if isinstance(value, torch.Tensor):
+            value = value.numpy()
+        if key in self.image_keys:
+            # BGR (H, W, C) -> RGB (C, H, W) as a strided view, copied once below
+            value = value.transpose(2, 0, 1)[::-1]
+
+        horizon = self.horizons[key]
+        with self.lock:
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                buffer = self.buffers[key] = self._allocate(key, value.shape, value.dtype)
+            if self.counts[key] == 0:
+                # initialize by copying the first observation over the whole history
+                buffer[:] = value
+            else:
+                pos = self.counts[key] % horizon
+                np.copyto(buffer[pos], value)
+                buffer[pos + horizon] = buffer[pos]
+            self.counts[key] += 1
+
+    def push(self, batch):
+        """Write every key of `batch` the buffer tracks; the others are ignored."""
+        for key, value in batch.items():
+            if key in self.horizons:
+                self.write(key, value)
+        return self
+
+    def window(self, key):
+        """Zero-copy (horizon, ...) tensor view of the last `horizon` entries, oldest first."""
+        horizon = self.horizons[key]
+        start = self.counts[key] % horizon
+        return torch.from_numpy(self.buffers[key][start:start + horizon])
+
+    def windows(self):
+        return {key: self.window(key) for key in self.buffers}
+
+    @property
+    def shm_names(self):
+        return {key: shm.name for key, shm in self._shms.items()}
+
+    def reset(self):
+        """Forget the history; the next write of each key fills it again."""
+        with self.lock:
+            self.counts = {key: 0 for key in self.horizons}
+
+    def close(self):
+        """Release the shared-memory blocks, if any.
+
+        The blocks are unlinked right away. If `window` views (or tensors sharing their
+        memory) are still alive, their mapping can't be closed yet: it is kept, with a
+        warning, and closed by a later `close` once the views are gone.
+        """
+        self.buffers = {}
+        for shm in self._shms.values():
+            shm.unlink()
+        pending, self._unclosed = self._unclosed + list(self._shms.values()), []
+        self._shms = {}
+        for shm in pending:
+            try:
+                shm.close()
+            except BufferError:
+                self._unclosed.append(shm)
+        if self._unclosed:
+            logging.warning(
+                f"{len(self._unclosed)} shared-memory block(s) still have views; "
+                "drop them and call close() again to unmap"
+            )